@@ -2,8 +2,6 @@ import dxfwrite
 import os
 import sys
 import numpy
-import random
-import math
 #import elionix_alignment as eal
 from dxfwrite import DXFEngine as dxf
 
@@ -22,62 +20,29 @@ coord_topright = (1143,-50)
 nw_1 = (741,-518)
 nw_2 = (742,-487)
 
-#centering on the bottom left corner of the rectangle
-new_botleft = (0,0)
-new_botright = tuple(numpy.subtract(coord_botright, coord_botleft))
-new_topright = tuple(numpy.subtract(coord_topright, coord_botleft))
-new_topleft = tuple(numpy.subtract(coord_topleft, coord_botleft))
-#transforming the nanowire coordinates as well
-new_nw1 = tuple(numpy.subtract(nw_1, coord_botleft))
-new_nw2 = tuple(numpy.subtract(nw_2, coord_botleft))
+#the transforms library lives in the top level of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import transforms
 
-#calculating the x transform
-theta_x = math.atan(new_topleft[0]/(new_topleft[1]))
-x_skew_matrix = numpy.matrix([[1, -1*math.tan(theta_x)], [0, 1]])
+markers = numpy.array((coord_topleft, coord_topright, coord_botleft, coord_botright), dtype=float)
+nw_coords = numpy.array((nw_1, nw_2), dtype=float)
 
-#run the coordinate transform for x first
-new_botright = numpy.matmul(x_skew_matrix, [new_botright[0],new_botright[1]])
-new_topright = numpy.matmul(x_skew_matrix, [new_topright[0],new_topright[1]])
-new_topleft = numpy.matmul(x_skew_matrix, [new_topleft[0],new_topleft[1]])
-#nanowire
-new_nw1 = numpy.matmul(x_skew_matrix, [new_nw1[0],new_nw1[1]])
-new_nw2= numpy.matmul(x_skew_matrix, [new_nw2[0],new_nw2[1]])
-
-#print(new_botright.item(1))
-theta_y = math.atan(new_botright.item(1)/(new_botright.item(0)))
-y_skew_matrix = numpy.matrix([[1, 0], [-math.tan(theta_y), 1]])
-#run the coordinate transform for y skew
-new_botleft = numpy.matrix([0,0])
-new_botright = numpy.matmul(y_skew_matrix, [new_botright.item(0),new_botright.item(1)])
-print("nbr =", new_botright)
-new_topright = numpy.matmul(y_skew_matrix, [new_topright.item(0),new_topright.item(1)])
-print("ntr =", new_topright)
-new_topleft = numpy.matmul(y_skew_matrix, [new_topleft.item(0),new_topleft.item(1)])
-print("ntl =", new_topleft)
-
-#nanowire coordinate tranform for y skew
-new_nw1 = numpy.matmul(y_skew_matrix, [new_nw1.item(0),new_nw1.item(1)])
-print("nw1 =", new_nw1)
-new_nw2= numpy.matmul(y_skew_matrix, [new_nw2.item(0),new_nw2.item(1)])
-print("nw2 =", new_nw2)
-
-
-#now that everything is aligned, find the average height and width
-equiv_width = (abs(new_botright.item(0)-new_botleft.item(0))+abs(new_topright.item(0)-new_topleft.item(0)))/2
-equiv_height = (abs(new_topright.item(1)-new_botright.item(1))+abs(new_topleft.item(1)-new_botleft.item(1)))/2
-#print("equiv_width =", equiv_width)
-#print("equiv_height =", equiv_height)
-
-#x coordinate of the nanowire
-new_nw1[0,0] = (die_width/equiv_width)*new_nw1.item(0)
-new_nw1[0,1] = (die_height/equiv_height)*new_nw1.item(1)
+#deskew x, then y, then scale by the average height and width (see transforms.fit_skew_scale)
+skew_transform, skew_residuals = transforms.fit_skew_scale(markers, (die_width, die_height))
+print("skew transform =", skew_transform)
+new_nw1, new_nw2 = transforms.apply_transform(skew_transform, nw_coords)
 print("nw1_coords =", new_nw1)
-
-new_nw2[0,0] = (die_width/equiv_width)*new_nw2.item(0)
-new_nw2[0,1] = (die_height/equiv_height)*new_nw2.item(1)
 print("nw2_coords =", new_nw2)
 #THESE ARE THE COORDINATES WITH RESPECT TO THE BOTTOM LEFT HAND CORNER OF THE DIE
 
+#compare against the projective transform used by coordinate_transform.py
+die_corners = numpy.array(((0, die_height), (die_width, die_height), (0, 0), (die_width, 0)), dtype=float)
+proj_transform, proj_residuals = transforms.fit_projective(markers, die_corners)
+print("projective nw coords =", transforms.apply_transform(proj_transform, nw_coords))
+print("skew/scale marker residuals =", skew_residuals)
+print("projective marker residuals =", proj_residuals)
+print("RMS residuals by model =", transforms.compare_fits(markers, die_corners))
+
 
 #can sanity check by calculating the length of the nanowire
 
@@ -0,0 +1,119 @@
+import hashlib
+
+import numpy
+from dxfwrite import DXFEngine as dxf
+
+import large_gates
+
+# Pre-rotated device blocks that have already been added to a drawing, keyed by
+# (drawing, geometry, angle bin)
+_rotated_blocks = {}
+
+def field_index(fields, nw_x=2, nw_y=2):
+    """
+    Convert field labels ("a", "b", ...) into (column, row) indices in the nanowire grid.
+    Labels are assigned the same way as the grid text labels: chr(97 + i*nw_x + (nw_y-j-1))
+    for column i and row j, so "a" is the top left field and "b" the one below it.
+    Those labels are only unique for square grids, so other grids are rejected.
+    """
+    if nw_x != nw_y:
+        raise ValueError("field labels are only unique for a square nanowire grid, not %d x %d" % (nw_x, nw_y))
+    fields = numpy.asarray(fields)
+    if fields.dtype.kind in "US":
+        fields = numpy.array([ord(f) - 97 for f in fields.ravel()]).reshape(fields.shape)
+    fields = fields.astype(int)
+    if numpy.any((fields < 0) | (fields >= nw_x*nw_y)):
+        raise ValueError("field out of range for a %d x %d nanowire grid" % (nw_x, nw_y))
+    col = fields//nw_y
+    row = nw_y - 1 - fields % nw_y
+    return col, row
+
+def place_devices(wires, fields, nw_x=2, nw_y=2, nw_die_width=300, nw_die_height=300, nw_grid_spacing=150):
+    """
+    Calculate where to insert the device blocks for a set of nanowires, in one pass.
+
+    wires is an (N, 2, 2) array of nanowire endpoints ((x1, y1), (x2, y2)), relative to the
+    bottom left corner of the field they are in, and fields gives the field of each
+    wire (either as labels "a", "b", ... or as indices).
+
+    Returns (anchors, rotations, offsets), where anchors is an (N, 2) array of the insert
+    point of each device (the first endpoint of the wire in drawing coordinates),
+    rotations is an (N,) array of the wire angle in degrees (as needed by dxfengine),
+    and offsets is an (N, 2) array of the bottom left corner of each field.
+    """
+    wires = numpy.asarray(wires, dtype=float)
+    if wires.ndim != 3 or wires.shape[1:] != (2, 2):
+        raise ValueError("wires should be an (N, 2, 2) array of nanowire endpoints")
+    col, row = field_index(fields, nw_x, nw_y)
+
+    nw_grid_width = nw_die_width*nw_x + (nw_x-1)*nw_grid_spacing
+    nw_grid_height = nw_die_height*nw_y + (nw_y-1)*nw_grid_spacing
+    offsets = numpy.stack((-nw_grid_width/2 + col*(nw_die_width+nw_grid_spacing),
+                           -nw_grid_height/2 + row*(nw_die_height+nw_grid_spacing)), axis=-1)
+
+    # atan2 so that vertical wires, and wires picked right to left, point the right way
+    direction = wires[:, 1] - wires[:, 0]
+    rotations = numpy.degrees(numpy.arctan2(direction[:, 1], direction[:, 0]))
+    anchors = offsets + wires[:, 0]
+    return anchors, rotations, offsets
+
+def place_wire(nw_corner_x, nw_corner_y, field, **grid):
+    """
+    Place a single nanowire, given as the (x1, x2) and (y1, y2) coordinates used in the
+    nanowire_align scripts. Returns (anchor, rotation) for the device block inserts.
+    """
+    wire = numpy.array((nw_corner_x, nw_corner_y), dtype=float).T[numpy.newaxis]
+    anchors, rotations, _ = place_devices(wire, [field], **grid)
+    return tuple(anchors[0]), rotations[0]
+
+def quantize_rotation(rotations, step):
+    """
+    Round rotations (degrees) to the nearest multiple of step, in the range [0, 360).
+    """
+    return numpy.mod(numpy.round(numpy.asarray(rotations, dtype=float)/step)*step, 360)
+
+def rotate_polygons(polygons, rotation, grid=0.001):
+    """
+    Rotate polygons about the origin by rotation degrees, and snap the vertices to grid.
+    """
+    theta = numpy.radians(rotation)
+    rot = numpy.array([[numpy.cos(theta), numpy.sin(theta)], [-numpy.sin(theta), numpy.cos(theta)]])
+    return [numpy.round(polygon@rot/grid)*grid for polygon in polygons]
+
+def rotated_block(drawing, polygons, rotation, step=1.0, grid=0.001, layer=None, name="device"):
+    """
+    Get a flattened block of the given polygons, pre-rotated by rotation rounded to the
+    nearest step degrees and snapped to grid.
+
+    Blocks are cached, so every wire with the same device geometry and angle bin
+    shares one block, and Beamer only has to fracture it once. Returns the block name.
+    """
+    angle = float(quantize_rotation(rotation, step))
+    geometry = hashlib.sha1(numpy.round(numpy.concatenate(polygons)/grid).astype(numpy.int64).tobytes())
+    geometry.update(str([len(polygon) for polygon in polygons]).encode())
+    key = (id(drawing), geometry.hexdigest(), angle, grid, layer)
+    if key not in _rotated_blocks:
+        blockname = "%s_%s_r%07.3f" % (name, geometry.hexdigest()[:8], angle)
+        block = dxf.block(blockname, layer=layer)
+        for polygon in rotate_polygons(polygons, angle, grid):
+            block.add(large_gates.polygon_entity(polygon, layer=layer))
+        drawing.blocks.add(block)
+        _rotated_blocks[key] = blockname
+    return _rotated_blocks[key]
+
+def add_device(drawing, blockname, polygons, anchor, rotation, rotation_step=None, device_layer=None, grid=0.001, **kwargs):
+    """
+    Insert a device at anchor, rotated by rotation degrees.
+
+    If rotation_step is None, the existing block blockname is inserted with the exact
+    rotation. Otherwise, the rotation is quantized to rotation_step and a shared
+    pre-rotated copy of polygons (see rotated_block), drawn on device_layer, is inserted
+    without rotation. Returns the insert, after adding it to the drawing.
+    """
+    if rotation_step is None:
+        ref = dxf.insert(blockname=blockname, insert=anchor, rotation=rotation, **kwargs)
+    else:
+        name = rotated_block(drawing, polygons, rotation, rotation_step, grid, device_layer, blockname)
+        ref = dxf.insert(blockname=name, insert=anchor, **kwargs)
+    drawing.add(ref)
+    return ref
@@ -1,25 +1,82 @@
 import dxfwrite
+import gdspy
+import numpy
 from dxfwrite import DXFEngine as dxf
+from large_gates import rectangle_polygon, polygon_entity, polygon_cell, family_polygons, cell_name
+
+def double_dot_etch_polygons(starting_gap, window_length, etch_window_1, island_1, etch_window_2, island_2, etch_window_3):
+    # the corners of the three etch windows, with the nanowire along the x axis starting at the origin
+    polygons = []
+    x_etch_position = starting_gap
+    for etch_window, island in ((etch_window_1, island_1), (etch_window_2, island_2), (etch_window_3, 0)):
+        polygons.append(rectangle_polygon((x_etch_position,-window_length/2), etch_window, window_length))
+        x_etch_position += etch_window + island
+    return polygons
 
 def double_dot_etch_block(layer, starting_gap, window_length, etch_window_1, island_1, etch_window_2, island_2, etch_window_3, blockname):
     block  = dxf.block(blockname, layer=layer)                                                                # creating the block
-    x_etch_position = starting_gap
-    block.add(dxf.rectangle((x_etch_position,-window_length/2), etch_window_1, window_length, rotation = 0, layer = layer))
-    x_etch_position = starting_gap+etch_window_1+island_1
-    block.add(dxf.rectangle((x_etch_position,-window_length/2), etch_window_2, window_length, rotation = 0, layer = layer))
-    x_etch_position = starting_gap+etch_window_1+island_1+etch_window_2+island_2
-    block.add(dxf.rectangle((x_etch_position,-window_length/2), etch_window_3, window_length, rotation = 0, layer = layer))                        # short horiztonal right
+    for polygon in double_dot_etch_polygons(starting_gap, window_length, etch_window_1, island_1, etch_window_2, island_2, etch_window_3):
+        block.add(polygon_entity(polygon, layer = layer))
     # add block-definition to drawing
     #drawing.blocks.add(block_name)
     print("I DID IT ETCH BLOCK")
     return block
 
-def initial_test_etch_block(layer, window_spacing, start_window_width, no_windows, window_length, window_size):
-    block  = dxf.block("test_etch_block", layer=layer) 
-    current_coordinate = window_spacing
-    window_size = start_window_width
-    for i in range(no_windows):
-        block.add(dxf.rectangle((current_coordinate,-window_length/2), window_size, window_length, rotation = 0))
-        current_coordinate += window_size + window_spacing
-        window_size += window_increment
+def double_dot_etch_cell(lib, layer, starting_gap, window_length, etch_window_1, island_1, etch_window_2, island_2, etch_window_3):
+    # gdspy version of double_dot_etch_block, shared between every wire with the same etch windows
+    params = (starting_gap, window_length, etch_window_1, island_1, etch_window_2, island_2, etch_window_3)
+    return polygon_cell(lib, "dd_etch", double_dot_etch_polygons(*params), layer, params)
+
+def initial_test_etch_block(layer, window_spacing, start_window_width, no_windows, window_length, window_increment=0, blockname="test_etch_block"):
+    # a row of no_windows etch windows, starting at start_window_width and growing by window_increment each time
+    block  = dxf.block(blockname, layer=layer)
+    widths = start_window_width + window_increment*numpy.arange(no_windows)
+    starts = window_spacing*numpy.arange(1, no_windows+1) + numpy.concatenate(([0], numpy.cumsum(widths)[:-1]))
+    for polygon in rectangle_polygon((starts, -window_length/2), widths, window_length):
+        block.add(polygon_entity(polygon, layer = layer))
     return block
+
+def test_window_polygons(window_width, island_length, window_length):
+    # a single test structure: two etch windows either side of an island, with the first window starting at the origin
+    return [rectangle_polygon((0,-window_length/2), window_width, window_length),
+        rectangle_polygon((window_width+island_length,-window_length/2), window_width, window_length)]
+
+def etch_test_matrix_cell(lib, layer, window_widths, island_lengths, datatypes=(0,), window_length=1, spacing=2,
+        repeats=3, label_height=1, name=None):
+    # a calibration matrix of etch window width (columns) x island length (rows), with one copy of the matrix per
+    # dose datatype placed side by side. Each structure is repeated repeats times in y as a cell array, and
+    # the rows, columns and dose blocks are labelled (dimensions in nm)
+    window_widths = numpy.asarray(window_widths, dtype=float)
+    island_lengths = numpy.asarray(island_lengths, dtype=float)
+    if name is None:
+        name = cell_name("etch_matrix", layer, window_length, spacing, repeats, *window_widths, *island_lengths, *datatypes)
+    if name in lib.cells:
+        return lib.cells[name]
+    matrix = lib.new_cell(name)
+
+    # all of the test structures in one go, as a (rows, columns, 2, 4, 2) array
+    widths, islands = numpy.meshgrid(window_widths, island_lengths)
+    structures = family_polygons(test_window_polygons, widths.ravel(), islands.ravel(), window_length)
+    structures = structures.reshape(widths.shape + structures.shape[1:])
+
+    # a regular grid, so the pitch is set by the largest structure
+    pitch_x = (2*window_widths.max() + island_lengths.max()) + spacing
+    pitch_y = repeats*(window_length + spacing) + label_height + spacing
+    block_width = len(window_widths)*pitch_x + spacing + 4*label_height
+
+    for k, datatype in enumerate(datatypes):
+        block_x = k*block_width
+        matrix.add(gdspy.Text("DT%d" % datatype, 2*label_height,
+            (block_x, len(island_lengths)*pitch_y + label_height), layer=layer, datatype=datatype))
+        for row, island in enumerate(island_lengths):
+            y = row*pitch_y
+            matrix.add(gdspy.Text("L%d" % round(island*1000), label_height,
+                (block_x, y + window_length/2), layer=layer, datatype=datatype))
+            for col, width in enumerate(window_widths):
+                x = block_x + 4*label_height + col*pitch_x
+                cell = polygon_cell(lib, "etch_test", structures[row, col], layer, (width, island, window_length), datatype)
+                matrix.add(gdspy.CellArray(cell, 1, repeats, (pitch_x, window_length + spacing),
+                    (x, y + window_length/2 + label_height + spacing)))
+                if row == 0:
+                    matrix.add(gdspy.Text("W%d" % round(width*1000), label_height, (x, y), layer=layer, datatype=datatype))
+    return matrix
@@ -0,0 +1,284 @@
+import heapq
+import math
+
+import numpy
+from scipy import ndimage
+
+import large_gates
+
+# 8-connected moves on the routing grid, and the length of each
+_STEPS = ((1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1))
+_STEP_COSTS = tuple(math.hypot(dx, dy) for dx, dy in _STEPS)
+
+def _rotate(points, rotations):
+    # rotate (..., 2) points anticlockwise about the origin by rotations (degrees), broadcasting over the leading axes
+    theta = numpy.radians(rotations)
+    c, s = numpy.cos(theta), numpy.sin(theta)
+    x, y = points[..., 0], points[..., 1]
+    return numpy.stack((c*x - s*y, s*x + c*y), axis=-1)
+
+def pad_ring(chip_size, pad_size, pad_pitch, n_pads=None, teardrop_length=50, margin=None):
+    """
+    Place bondpads evenly along each edge of a square chip centered on the origin, with their
+    teardrops (see large_gates.bondpad) pointing into the chip. Pads sit margin (default
+    pad_size) in from the chip edge, and corners are left clear.
+
+    Returns (inserts, rotations, tips): the insert point and rotation (degrees) of each pad
+    block, and the end of its teardrop where a trace connects. Pads are ordered anticlockwise
+    starting at the bottom left.
+    """
+    if margin is None:
+        margin = pad_size
+    inner = chip_size/2 - margin - pad_size
+    usable = chip_size - 2*(margin + pad_size)
+    n_side = int(usable//pad_pitch) + 1
+    if n_pads is not None:
+        if -(-n_pads//4) > n_side:
+            raise ValueError("%d pads at a pitch of %g don't fit on a %g chip" % (n_pads, pad_pitch, chip_size))
+        n_side = -(-n_pads//4)
+    along = (numpy.arange(n_side) - (n_side - 1)/2)*pad_pitch
+
+    # lay out the bottom edge, and rotate it onto the other three
+    sides = numpy.repeat(numpy.arange(4)*90, n_side)
+    bottom = numpy.stack((along, numpy.full(n_side, -inner)), axis=-1)
+    inserts = _rotate(numpy.tile(bottom, (4, 1)), sides)
+    rotations = numpy.mod(sides + 180, 360)
+    tips = inserts + _rotate(numpy.array((0, -teardrop_length)), rotations)
+    if n_pads is not None:
+        keep = numpy.round(numpy.linspace(0, len(inserts), n_pads, endpoint=False)).astype(int)
+        inserts, rotations, tips = inserts[keep], rotations[keep], tips[keep]
+    return inserts, rotations, tips
+
+def pad_polygons(inserts, rotations, size, trace_width=10, teardrop_length=50):
+    # the polygons of every pad in a ring, placed and rotated
+    pad = large_gates.bondpad_polygons(size, True, trace_width, teardrop_length)
+    return [_rotate(polygon, rotation) + insert for insert, rotation in zip(inserts, rotations) for polygon in pad]
+
+def obstacle_grid(polygons, bounds, pitch, clearance=0):
+    """
+    Build the obstacle index for routing: a boolean grid over bounds ((xmin, ymin), (xmax, ymax))
+    with cells of size pitch, indexed [ix, iy] and True where blocked.
+
+    Each polygon blocks the cells under its bounding box grown by clearance. This is
+    conservative, but lets every obstacle be added at once with a summed difference array
+    instead of rasterizing them one by one.
+    """
+    (xmin, ymin), (xmax, ymax) = bounds
+    shape = (int(math.ceil((xmax - xmin)/pitch)), int(math.ceil((ymax - ymin)/pitch)))
+    counts = numpy.zeros((shape[0] + 1, shape[1] + 1), dtype=numpy.int32)
+    if len(polygons):
+        boxes = numpy.array([(numpy.min(p, axis=0), numpy.max(p, axis=0)) for p in polygons])
+        lo = numpy.floor((boxes[:, 0] - clearance - (xmin, ymin))/pitch).astype(int)
+        hi = numpy.floor((boxes[:, 1] + clearance - (xmin, ymin))/pitch).astype(int) + 1
+        lo = numpy.clip(lo, 0, shape)
+        hi = numpy.clip(hi, 0, shape)
+        inside = numpy.all(hi > lo, axis=1)
+        lo, hi = lo[inside], hi[inside]
+        numpy.add.at(counts, (lo[:, 0], lo[:, 1]), 1)
+        numpy.add.at(counts, (hi[:, 0], lo[:, 1]), -1)
+        numpy.add.at(counts, (lo[:, 0], hi[:, 1]), -1)
+        numpy.add.at(counts, (hi[:, 0], hi[:, 1]), 1)
+    return numpy.cumsum(numpy.cumsum(counts, axis=0), axis=1)[:-1, :-1] > 0
+
+def astar(blocked, start, goal, turn_penalty=0.5):
+    """
+    Find the shortest 8-connected path between two cells of a routing grid, avoiding blocked
+    cells and without cutting the corners of blocked cells. Each change of direction costs
+    turn_penalty extra, so that traces stay straight where they can.
+
+    Returns the path as a list of (ix, iy) cells from start to goal, or None if there isn't one.
+    """
+    nx, ny = blocked.shape
+    free = (~blocked).ravel().tolist()
+    start_index, goal_index = start[0]*ny + start[1], goal[0]*ny + goal[1]
+    gx, gy = goal
+
+    def heuristic(x, y):
+        # octile distance to the goal
+        dx, dy = abs(x - gx), abs(y - gy)
+        return max(dx, dy) + (math.sqrt(2) - 1)*min(dx, dy)
+
+    cost = {start_index: 0.0}
+    parent = {start_index: None}
+    direction = {start_index: None}
+    closed = set()
+    heap = [(heuristic(*start), 0.0, start_index)]
+    while heap:
+        _, current_cost, index = heapq.heappop(heap)
+        if index == goal_index:
+            break
+        if index in closed:
+            continue
+        closed.add(index)
+        x, y = divmod(index, ny)
+        for step, (dx, dy) in enumerate(_STEPS):
+            next_x, next_y = x + dx, y + dy
+            if not (0 <= next_x < nx and 0 <= next_y < ny):
+                continue
+            next_index = next_x*ny + next_y
+            if not free[next_index] or next_index in closed:
+                continue
+            if dx and dy and not (free[x*ny + next_y] and free[next_x*ny + y]):
+                continue
+            next_cost = current_cost + _STEP_COSTS[step]
+            if direction[index] is not None and direction[index] != step:
+                next_cost += turn_penalty
+            if next_cost < cost.get(next_index, math.inf):
+                cost[next_index] = next_cost
+                parent[next_index] = index
+                direction[next_index] = step
+                heapq.heappush(heap, (next_cost + heuristic(next_x, next_y), next_cost, next_index))
+    else:
+        return None
+
+    path = []
+    index = goal_index
+    while index is not None:
+        path.append(divmod(index, ny))
+        index = parent[index]
+    return path[::-1]
+
+def simplify_path(points):
+    # drop the points in the middle of straight runs, keeping the ends and every corner
+    points = numpy.asarray(points, dtype=float)
+    if len(points) < 3:
+        return points
+    steps = numpy.diff(points, axis=0)
+    steps /= numpy.linalg.norm(steps, axis=1, keepdims=True)
+    corner = numpy.abs(steps[:-1, 0]*steps[1:, 1] - steps[:-1, 1]*steps[1:, 0]) > 1e-9
+    return numpy.concatenate((points[:1], points[1:-1][corner], points[-1:]))
+
+def trace_polygons(points, start_width, width, taper_length):
+    """
+    Draw a trace along a polyline, tapering linearly from start_width at the first point to
+    width over taper_length (measured along the trace). Each segment is a quadrilateral, and
+    every corner is filled with a square the width of the trace.
+    """
+    points = numpy.asarray(points, dtype=float)
+    points = points[numpy.concatenate(([True], numpy.any(numpy.diff(points, axis=0) != 0, axis=1)))]
+    distance = numpy.concatenate(([0], numpy.cumsum(numpy.linalg.norm(numpy.diff(points, axis=0), axis=1))))
+
+    # insert a point where the taper ends, so that the trace is straight sided after it
+    if 0 < taper_length < distance[-1] and not numpy.any(numpy.isclose(distance, taper_length)):
+        segment = numpy.searchsorted(distance, taper_length) - 1
+        fraction = (taper_length - distance[segment])/(distance[segment + 1] - distance[segment])
+        points = numpy.insert(points, segment + 1, points[segment] + fraction*(points[segment + 1] - points[segment]), axis=0)
+        distance = numpy.insert(distance, segment + 1, taper_length)
+    widths = start_width + (width - start_width)*numpy.clip(distance/taper_length if taper_length else 1, 0, 1)
+
+    steps = numpy.diff(points, axis=0)
+    lengths = numpy.diff(distance)
+    unit = steps/lengths[:, numpy.newaxis]
+    normal = numpy.stack((-unit[:, 1], unit[:, 0]), axis=-1)
+    a, b = points[:-1], points[1:]
+    wa, wb = widths[:-1, numpy.newaxis]/2, widths[1:, numpy.newaxis]/2
+    quads = numpy.stack((a - normal*wa, b - normal*wb, b + normal*wb, a + normal*wa), axis=1)
+
+    # squares at each corner, aligned with the incoming segment
+    u, n, w = unit[:-1], normal[:-1], widths[1:-1, numpy.newaxis]/2
+    c = points[1:-1]
+    joins = numpy.stack((c - u*w - n*w, c + u*w - n*w, c + u*w + n*w, c - u*w + n*w), axis=1)
+    return list(quads) + list(joins)
+
+def assign_pads(terminals, tips):
+    """
+    Assign each terminal a pad, preserving the order of both around the center of the pad
+    ring so that the fan-out doesn't cross itself. Returns the index of the pad for each terminal.
+    """
+    terminals, tips = numpy.asarray(terminals, dtype=float), numpy.asarray(tips, dtype=float)
+    if len(terminals) > len(tips):
+        raise ValueError("%d terminals but only %d pads" % (len(terminals), len(tips)))
+    center = tips.mean(axis=0)
+    terminal_angle = numpy.arctan2(*(terminals - center).T[::-1])
+    pad_angle = numpy.arctan2(*(tips - center).T[::-1])
+    terminal_order, pad_order = numpy.argsort(terminal_angle), numpy.argsort(pad_angle)
+
+    # spread the terminals evenly over the pads, and try every rotation of the ring to find the best fit
+    spread = numpy.round(numpy.linspace(0, len(tips), len(terminals), endpoint=False)).astype(int)
+    candidates = pad_order[(spread[numpy.newaxis] + numpy.arange(len(tips))[:, numpy.newaxis]) % len(tips)]
+    mismatch = numpy.angle(numpy.exp(1j*(pad_angle[candidates] - terminal_angle[terminal_order])))
+    best = numpy.argmin(numpy.sum(mismatch**2, axis=1))
+    pads = numpy.empty(len(terminals), dtype=int)
+    pads[terminal_order] = candidates[best]
+    return pads
+
+def route(terminals, terminal_widths, tips, obstacles, bounds, pitch=10, clearance=10, trace_width=10,
+        taper_length=50, passes=2):
+    """
+    Route each terminal (for example the end of a contact track) out to a pad in a ring.
+
+    terminals is an (N, 2) array of start points, and terminal_widths the width of the
+    track at each. tips are the trace ends of the pads (see pad_ring), and obstacles the
+    polygons to route around (alignment marks, other devices and the pads themselves).
+    Routing is done on a grid of pitch (um) over bounds, so terminals should be at least
+    one grid cell apart. Nets are routed shortest first, and each finished trace becomes an
+    obstacle for the rest. If some nets fail, everything is ripped up and rerouted with the
+    failed nets first, up to passes times, keeping the attempt that routed the most nets.
+
+    Returns (pads, traces): the pad assigned to each terminal, and for each terminal the list
+    of polygons of its tapered trace (None if it couldn't be routed).
+    """
+    terminals, tips = numpy.asarray(terminals, dtype=float), numpy.asarray(tips, dtype=float)
+    terminal_widths = numpy.broadcast_to(numpy.asarray(terminal_widths, dtype=float), len(terminals))
+    origin = numpy.asarray(bounds[0], dtype=float)
+    blocked = obstacle_grid(obstacles, bounds, pitch, clearance)
+    pads = assign_pads(terminals, tips)
+
+    def to_cell(point):
+        cell = numpy.floor((point - origin)/pitch).astype(int)
+        return tuple(numpy.clip(cell, 0, numpy.array(blocked.shape) - 1))
+
+    starts = [to_cell(point) for point in terminals]
+    goals = [to_cell(tips[pad]) for pad in pads]
+    if len(set(starts)) < len(starts):
+        raise ValueError("terminals must be at least one grid cell (%g um) apart" % pitch)
+
+    # keep every net's end cells free, and reserve them from the other nets
+    ends = numpy.zeros_like(blocked)
+    for cell in starts + goals:
+        ends[cell] = True
+    blocked &= ~ends
+    # cells within keep_out of a trace are blocked, so the next centerline is at least trace_width + clearance away
+    keep_out = int(math.ceil((trace_width + clearance)/pitch)) - 1
+
+    # the clearance around the end of each net's own terminal and pad is released when it is routed, so that the
+    # trace can get out from between them
+    escape = int(math.ceil(clearance/pitch)) + 1
+
+    order = list(numpy.argsort(numpy.linalg.norm(terminals - tips[pads], axis=1)))
+    best = None
+    for _ in range(passes):
+        traces = _route_nets(order, blocked.copy(), ends, starts, goals, terminals, terminal_widths, tips[pads],
+            origin, pitch, escape, keep_out, trace_width, taper_length)
+        failed = [net for net in order if traces[net] is None]
+        if best is None or sum(trace is None for trace in best) > len(failed):
+            best = traces
+        if not failed:
+            break
+        order = failed + [net for net in order if traces[net] is not None]
+    return pads, best
+
+def _route_nets(order, blocked, ends, starts, goals, terminals, terminal_widths, tips, origin, pitch, escape,
+        keep_out, trace_width, taper_length):
+    # route each net in order on the grid, blocking each trace once it is placed
+    traces = [None]*len(terminals)
+    for net in order:
+        net_blocked = blocked | ends
+        for x, y in (starts[net], goals[net]):
+            net_blocked[max(x - escape, 0):x + escape + 1, max(y - escape, 0):y + escape + 1] = False
+        # a failed search floods the whole grid, so check the ends are connected first
+        regions, _ = ndimage.label(~net_blocked, structure=numpy.ones((3, 3)))
+        if regions[starts[net]] != regions[goals[net]]:
+            continue
+        path = astar(net_blocked, starts[net], goals[net])
+        if path is None:
+            continue
+        cells = numpy.array(path)
+        centers = origin + (cells + 0.5)*pitch
+        points = simplify_path(numpy.concatenate((terminals[net:net+1], centers[1:-1], tips[net:net+1])))
+        traces[net] = trace_polygons(points, terminal_widths[net], trace_width, taper_length)
+
+        # the trace becomes an obstacle for the remaining nets
+        for x, y in cells:
+            blocked[max(x - keep_out, 0):x + keep_out + 1, max(y - keep_out, 0):y + keep_out + 1] = True
+    return traces
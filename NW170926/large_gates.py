@@ -1,6 +1,136 @@
+import hashlib
+
 import dxfwrite
+import gdspy
+import numpy
 from dxfwrite import DXFEngine as dxf
 
+def polygon(*points):
+    # the corners of a polygon as a (..., N, 2) array. Coordinates may be arrays (one entry per device in a family),
+    # in which case they are broadcast together
+    coords = numpy.broadcast_arrays(*[numpy.asarray(c, dtype=float) for point in points for c in point])
+    return numpy.stack(coords, axis=-1).reshape(coords[0].shape + (len(points), 2))
+
+def offset(x, y=0):
+    # an x/y shift that broadcasts against (..., N, 2) polygons
+    return polygon((x, y))
+
+def rectangle_polygon(insert, width, height):
+    # the corners of a rectangle, in the same order as dxf.rectangle
+    x, y = insert
+    return polygon((x, y), (x+width, y), (x+width, y+height), (x, y+height))
+
+def polygon_entity(polygon, **kwargs):
+    # a closed polyline through the corners of a polygon
+    polyline = dxf.polyline(**kwargs)
+    polyline.add_vertices([tuple(point) for point in polygon])
+    polyline.close(True)
+    return polyline
+
+def position_polygons(polygons, *coords):
+    # repeat a set of polygons at each x coordinate along the nanowire, as the position_* blocks do
+    return [polygon + offset(coord) for coord in coords for polygon in polygons]
+
+def plungers_side_mirror_polygons(plunger_to_nw, plunger_tip_width, plunger_tip_height, plunger_taper_width):
+    taper = polygon((-plunger_tip_width/2,-plunger_to_nw), (plunger_tip_width/2,-plunger_to_nw),
+        (plunger_taper_width/2,-plunger_tip_height-plunger_to_nw), (-plunger_taper_width/2,-plunger_tip_height-plunger_to_nw))
+    return [taper, taper*(1, -1)]
+
+def tgates_side_mirror_polygons(tgate_to_nw, tgate_tip_width, tgate_tip_height, tgate_taper_width):
+    return [rectangle_polygon((-tgate_tip_width/2,-tgate_to_nw-tgate_taper_width), tgate_tip_width, tgate_taper_width),
+        rectangle_polygon((-tgate_taper_width/2, -tgate_to_nw-tgate_taper_width-tgate_tip_height), tgate_taper_width, tgate_tip_height)]
+
+def contacts_parallel_polygons(taper_point, taper_length, taper_width, taper_before_track, *contact_coords):
+    # the first contact points along +x and the second is rotated by 180 degrees, as in contacts_parallel
+    taper = polygon((0,-taper_point/2), (0,taper_point/2), (-taper_length,taper_width/2), (-taper_length,-taper_width/2))
+    track = rectangle_polygon((-taper_length-taper_before_track,-taper_width/2), taper_before_track, taper_width)
+    return [taper + offset(contact_coords[0]), track + offset(contact_coords[0]),
+        -taper + offset(contact_coords[1]), -track + offset(contact_coords[1])]
+
+def family_polygons(polygons, *params):
+    # build the polygons of a whole family of devices at once. Each parameter is a scalar or an (F,) array, and
+    # the result is an (F, P, N, 2) array of the P polygons of each of the F devices
+    params = numpy.broadcast_arrays(*[numpy.atleast_1d(numpy.asarray(p, dtype=float)) for p in params])
+    return numpy.stack(numpy.broadcast_arrays(*polygons(*params)), axis=1)
+
+def comb_polygons(polygons, coords):
+    # repeat the (F, P, N, 2) polygons of each device at each of its (F, n) x coordinates, giving (F, n*P, N, 2)
+    polygons = numpy.asarray(polygons, dtype=float)
+    coords = numpy.atleast_2d(numpy.asarray(coords, dtype=float))
+    combs = polygons[:, numpy.newaxis] + offset(coords)[..., numpy.newaxis, :, :]
+    return combs.reshape(len(combs), -1, *polygons.shape[-2:])
+
+def regular_spacing(coords, tolerance=0.0005):
+    # if the coordinates are evenly spaced (to within the database grid), return (start, pitch, count), else None
+    coords = numpy.sort(numpy.asarray(coords, dtype=float))
+    if len(coords) < 2:
+        return None
+    steps = numpy.diff(coords)
+    if steps[0] <= tolerance or numpy.any(numpy.abs(steps - steps[0]) > tolerance):
+        return None
+    return float(coords[0]), float(coords[-1] - coords[0])/(len(coords) - 1), len(coords)
+
+def comb_inserts(blockname, color, *coords, **kwargs):
+    # insert a block at each x coordinate, as a single arrayed insert if the coordinates are evenly spaced. Arrays
+    # are rotated with the insert, so rotated blocks are always inserted one by one
+    spacing = regular_spacing(coords)
+    if spacing is not None and not kwargs.get("rotation", 0):
+        start, pitch, count = spacing
+        return [dxf.insert(blockname = blockname, insert = (start,0), columns = count, rows = 1,
+            colspacing = pitch, rowspacing = 0, color = color, **kwargs)]
+    return [dxf.insert(blockname = blockname, insert = (coord,0), columns = 1, rows = 1,
+        colspacing = 0, rowspacing = 0, color = color, **kwargs) for coord in coords]
+
+def cell_name(prefix, *params):
+    # a cell name made from a hash of the parameters (to the database grid), so the same geometry always gets the
+    # same name and is only defined once per library
+    digest = hashlib.sha1(repr([round(float(p), 3) if isinstance(p, (int, float)) else p for p in params]).encode())
+    return "%s_%s" % (prefix, digest.hexdigest()[:10])
+
+def polygon_cell(lib, prefix, polygons, layer, params, datatype=0):
+    # get the cell for a set of polygons, creating it only if this set of parameters hasn't been seen before
+    name = cell_name(prefix, layer, datatype, *params)
+    if name in lib.cells:
+        return lib.cells[name]
+    cell = lib.new_cell(name)
+    cell.add(gdspy.PolygonSet([numpy.asarray(polygon) for polygon in polygons], layer=layer, datatype=datatype))
+    return cell
+
+def position_cell(lib, cell, *coords, rotation=0):
+    # reference a cell at each x coordinate along the nanowire (the gdspy equivalent of the position_* blocks)
+    name = cell_name(cell.name, rotation, *coords)
+    if name in lib.cells:
+        return lib.cells[name]
+    positioned = lib.new_cell(name)
+    spacing = regular_spacing(coords)
+    if spacing is not None and not rotation:
+        start, pitch, count = spacing
+        positioned.add(gdspy.CellArray(cell, count, 1, (pitch, 0), (start, 0), rotation=rotation))
+    else:
+        for coord in coords:
+            positioned.add(gdspy.CellReference(cell, (coord, 0), rotation=rotation))
+    return positioned
+
+def plungers_side_mirror_cell(lib, layer, plunger_to_nw, plunger_tip_width, plunger_tip_height, plunger_taper_width):
+    params = (plunger_to_nw, plunger_tip_width, plunger_tip_height, plunger_taper_width)
+    return polygon_cell(lib, "plunger", plungers_side_mirror_polygons(*params), layer, params)
+
+def tgates_side_mirror_cell(lib, layer, tgate_to_nw, tgate_tip_width, tgate_tip_height, tgate_taper_width):
+    params = (tgate_to_nw, tgate_tip_width, tgate_tip_height, tgate_taper_width)
+    return polygon_cell(lib, "tgate", tgates_side_mirror_polygons(*params), layer, params)
+
+def contacts_parallel_cell(lib, layer, taper_point, taper_length, taper_width, taper_before_track, *contact_coords):
+    # one contact cell, referenced pointing along +x at the first coordinate and rotated by 180 degrees at the second
+    params = (taper_point, taper_length, taper_width, taper_before_track)
+    contact = polygon_cell(lib, "contact", contacts_parallel_polygons(*params, 0, 0)[:2], layer, params)
+    name = cell_name("contacts", contact.name, *contact_coords[:2])
+    if name in lib.cells:
+        return lib.cells[name]
+    cell = lib.new_cell(name)
+    cell.add(gdspy.CellReference(contact, (contact_coords[0], 0)))
+    cell.add(gdspy.CellReference(contact, (contact_coords[1], 0), rotation=180))
+    return cell
+
 def plungers_side(layer, plunger_to_nw, plunger_tip_width, plunger_tip_height, plunger_taper_width,blockname): #plungers on just one side of the nanowire
 
     block  = dxf.block(blockname, layer=layer)
@@ -48,9 +178,7 @@ def plungers_side_mirror(layer, plunger_to_nw, plunger_tip_width, plunger_tip_he
 
 def position_plunger(new_blockname, blockname,layer,color, *plunger_coords):
     block = dxf.block(new_blockname, layer = layer)
-    for plunger in plunger_coords:
-        plunger_ref_temp = dxf.insert(blockname = blockname, insert = (plunger,0), columns = 1, rows = 1, 
-            colspacing = 0,rowspacing =0, color = color)
+    for plunger_ref_temp in comb_inserts(blockname, color, *plunger_coords):
         block.add(plunger_ref_temp)
 
     return block    
@@ -58,7 +186,9 @@ def position_plunger(new_blockname, blockname,layer,color, *plunger_coords):
 
 def contacts_parallel(drawing, blockname, layer, color, taper_point, taper_length, taper_width, taper_before_track, *contact_coords): # contacts the nanowire in parallel
 
-    block_temp = dxf.block("block_temp", layer = layer)
+    # the single contact gets its own name, so that several contact blocks can be added to the same drawing
+    contact_blockname = blockname + "_contact"
+    block_temp = dxf.block(contact_blockname, layer = layer)
     drawing.blocks.add(block_temp)
     taper= dxf.polyline(layer = layer)
     taper.add_vertices([(0,-taper_point/2), (0,taper_point/2), (-taper_length,taper_width/2), (-taper_length,-taper_width/2)])
@@ -71,9 +201,9 @@ def contacts_parallel(drawing, blockname, layer, color, taper_point, taper_lengt
       #  color = color, rotation = 0, layer = layer)) #contact 2
 
     block = dxf.block(blockname, layer = layer)
-    block_ref = dxf.insert(blockname='block_temp', insert=(contact_coords[0],0), columns = 1 , rows = 1, 
+    block_ref = dxf.insert(blockname=contact_blockname, insert=(contact_coords[0],0), columns = 1 , rows = 1, 
         colspacing = 0, rowspacing = 0, color =color, rotation = 0) 
-    block_ref1= dxf.insert(blockname='block_temp', insert=(contact_coords[1],0), columns = 1 , rows = 1, 
+    block_ref1= dxf.insert(blockname=contact_blockname, insert=(contact_coords[1],0), columns = 1 , rows = 1, 
         colspacing = 0, rowspacing = 0, color =color, rotation = 180) 
     block.add(block_ref)
     block.add(block_ref1)
@@ -82,23 +212,29 @@ def contacts_parallel(drawing, blockname, layer, color, taper_point, taper_lengt
 
 def position_parallel_contacts(new_blockname, blockname,layer,color, rotation, *contact_coords):
     block = dxf.block(new_blockname, layer = layer)
-    for contact in contact_coords:
-        contact_ref_temp = dxf.insert(blockname = blockname, insert = (contact,0), columns = 1, rows = 1, 
-            colspacing = 0,rowspacing =0, color = color, rotation = rotation)
+    for contact_ref_temp in comb_inserts(blockname, color, *contact_coords, rotation = rotation):
         block.add(contact_ref_temp)
 
     return block
 
 def position_tgates(new_blockname, blockname, layer, color, *tgate_coords):
     block = dxf.block(new_blockname, layer = layer)
-    for tgate in tgate_coords:
-        tgate_ref_temp = dxf.insert(blockname = blockname, insert = (tgate,0), columns = 1, rows = 1, 
-            colspacing = 0,rowspacing =0, color = color)
+    for tgate_ref_temp in comb_inserts(blockname, color, *tgate_coords):
         block.add(tgate_ref_temp)
 
     return block
 
+def bondpad_polygons(size, teardrop=True, trace_width=10, teardrop_length=50):
+    # a square pad sitting on the x axis, with a teardrop narrowing to the trace at (0, -teardrop_length)
+    polygons = [rectangle_polygon((-size/2, 0), size, size)]
+    if teardrop:
+        polygons.append(polygon((-trace_width/2, -teardrop_length), (trace_width/2, -teardrop_length), (size/2, 0), (-size/2, 0)))
+    return polygons
+
 # Create a new bondpad block
 # Bondpad will be square with a given side width, with a teardrop of length width (if enabled).
-def bondpad(blockname, size, teardrop=True, trace_width=10, teardrop_length=50):
-    pass
+def bondpad(blockname, size, teardrop=True, trace_width=10, teardrop_length=50, layer=0):
+    block = dxf.block(blockname, layer=layer)
+    for pad_polygon in bondpad_polygons(size, teardrop, trace_width, teardrop_length):
+        block.add(polygon_entity(pad_polygon, layer = layer))
+    return block
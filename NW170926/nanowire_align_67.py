@@ -1,9 +1,9 @@
 import os
 import sys
-import math
 import alignment_marker
 import etch_windows
 import large_gates
+import device_placement
 from dxfwrite import DXFEngine as dxf
 
 name="rectangle.dxf"
@@ -396,6 +396,7 @@ contact_x_disp = 0.150 # contact x displacement from island
 #makes the unit plunger block
 plunger_block = large_gates.plungers_side_mirror(layer2, plunger_to_nw,plunger_tip_width,plunger_tip_height,plunger_taper_width,"plunger_block")
 drawing.blocks.add(plunger_block)
+plunger_polygons = large_gates.plungers_side_mirror_polygons(plunger_to_nw,plunger_tip_width,plunger_tip_height,plunger_taper_width)
 
 tgate_to_nw = 0.150
 tgate_tip_height = 7
@@ -406,19 +407,25 @@ tgate_block_A = large_gates.tgates_side_mirror(layer2, tgate_to_nw, tgate_tip_wi
 drawing.blocks.add(tgate_block_A)
 
 
+#quantize the device rotations to this step (in degrees), so that wires with similar angles share
+#one pre-rotated, flattened block. Set to None to insert each device at the exact wire angle.
+rotation_step = None
+
+#the nanowire grid, used to find where each device block is inserted
+nw_grid = dict(nw_x=nw_x, nw_y=nw_y, nw_die_width=nw_die_width, nw_die_height=nw_die_height, nw_grid_spacing=nw_grid_spacing)
+
 #A NANOWIRE CODE
 nw_corner_x = (92.56287677,93.45052837)
 nw_corner_y = (193.52483374,202.86573261)
-nw_rotation = math.atan((nw_corner_y[1]-nw_corner_y[0])/(nw_corner_x[1]-nw_corner_x[0]))*180/math.pi #needs to be in degrees for dxfengine
+nw_anchor, nw_rotation = device_placement.place_wire(nw_corner_x, nw_corner_y, "a", **nw_grid) #needs to be in degrees for dxfengine
 
 #ETCH BLOCK
 dd_etch_block_A = etch_windows.double_dot_etch_block(layer1, starting_gap, window_length, 
     etch_window_1, island_1, etch_window_2, island_2, etch_window_3, "dd_etch_block_A")
 drawing.blocks.add(dd_etch_block_A) #adds the double dot etch blocks
 
-etch_block_ref_A = dxf.insert(blockname='dd_etch_block_A', insert=(-nw_grid_width/2+nw_corner_x[0],-nw_grid_height/2+nw_die_height+nw_grid_spacing+nw_corner_y[0]), 
-    columns = 1 , rows = 1, colspacing = 0, rowspacing = 0, color =am_colour, rotation = nw_rotation) 
-drawing.add(etch_block_ref_A)
+etch_block_ref_A = device_placement.add_device(drawing, 'dd_etch_block_A', etch_windows.double_dot_etch_polygons(starting_gap, window_length, etch_window_1, island_1, etch_window_2, island_2, etch_window_3),
+    nw_anchor, nw_rotation, rotation_step, device_layer=layer1, color=am_colour)
 
 #PLUNGERS
 #these are where you want to position plungers relative to the first coordinate of the nanowire
@@ -436,24 +443,21 @@ tgate_coords_A = [starting_gap+etch_window_1+0.5*island_1,
 #positions the unit plunger block
 plunger_block_A = large_gates.position_plunger("plunger_block_A", "plunger_block", layer2, contact_colour, *plunger_coords_A)
 drawing.blocks.add(plunger_block_A)
-plunger_block_A_ref = dxf.insert(blockname='plunger_block_A', insert=(-nw_grid_width/2+nw_corner_x[0],-nw_grid_height/2+nw_die_height+nw_grid_spacing+nw_corner_y[0]), 
-    columns = 1 , rows = 1, colspacing = 0, rowspacing = 0, color =am_colour, rotation = nw_rotation) 
-drawing.add(plunger_block_A_ref)
+plunger_block_A_ref = device_placement.add_device(drawing, 'plunger_block_A', large_gates.position_polygons(plunger_polygons, *plunger_coords_A),
+    nw_anchor, nw_rotation, rotation_step, device_layer=layer2, color=am_colour)
 
 tgate_block_A1 = large_gates.position_tgates("tgate_block_A1", "tgate_block_A", layer2, contact_colour, *tgate_coords_A)
 drawing.blocks.add(tgate_block_A1)
-tgate_block_A_ref = dxf.insert(blockname='tgate_block_A1', insert=(-nw_grid_width/2+nw_corner_x[0],-nw_grid_height/2+nw_die_height+nw_grid_spacing+nw_corner_y[0]), 
-    columns = 1 , rows = 1, colspacing = 0, rowspacing = 0, color =am_colour, rotation = nw_rotation) 
-drawing.add(tgate_block_A_ref)
+tgate_block_A_ref = device_placement.add_device(drawing, 'tgate_block_A1', large_gates.position_polygons(large_gates.tgates_side_mirror_polygons(tgate_to_nw, tgate_tip_width, tgate_tip_height, tgate_taper_width), *tgate_coords_A),
+    nw_anchor, nw_rotation, rotation_step, device_layer=layer2, color=am_colour)
 
 #CONTACTS
 #makes the unit and then repeats the contact
 contact_block_A = large_gates.contacts_parallel(drawing, "contact_block_A", layer2, contact_colour, taper_point, taper_length, taper_width, taper_before_track,*contact_coords_A)
 drawing.blocks.add(contact_block_A)
 
-contact_block_ref_A = dxf.insert(blockname='contact_block_A', insert=(-nw_grid_width/2+nw_corner_x[0],-nw_grid_height/2+nw_die_height+nw_grid_spacing+nw_corner_y[0]), 
-    columns = 1 , rows = 1, colspacing = 0, rowspacing = 0, color =am_colour, rotation = nw_rotation) 
-drawing.add(contact_block_ref_A)
+contact_block_ref_A = device_placement.add_device(drawing, 'contact_block_A', large_gates.contacts_parallel_polygons(taper_point, taper_length, taper_width, taper_before_track, *contact_coords_A),
+    nw_anchor, nw_rotation, rotation_step, device_layer=layer2, color=am_colour)
 
 
 
@@ -465,16 +469,15 @@ island_2 = 1
 nw_corner_x = (112.64274388,121.4685056)
 nw_corner_y = (117.80158788,121.76950615)
 
-nw_rotation = math.atan((nw_corner_y[1]-nw_corner_y[0])/(nw_corner_x[1]-nw_corner_x[0]))*180/math.pi #needs to be in degrees for dxfengine
+nw_anchor, nw_rotation = device_placement.place_wire(nw_corner_x, nw_corner_y, "b", **nw_grid) #needs to be in degrees for dxfengine
 
 #ETCH BLOCK
 dd_etch_block_B = etch_windows.double_dot_etch_block(layer1, starting_gap, window_length, 
     etch_window_1, island_1, etch_window_2, island_2, etch_window_3, "dd_etch_block_B")
 drawing.blocks.add(dd_etch_block_B) #adds the double dot etch blocks
 
-etch_block_ref_B = dxf.insert(blockname='dd_etch_block_B', insert=(-nw_grid_width/2+nw_corner_x[0],-nw_grid_height/2+nw_corner_y[0]), columns = 1 , rows = 1, 
-    colspacing = 0, rowspacing = 0, layer = layer1, color =am_colour, rotation = nw_rotation) 
-drawing.add(etch_block_ref_B)
+etch_block_ref_B = device_placement.add_device(drawing, 'dd_etch_block_B', etch_windows.double_dot_etch_polygons(starting_gap, window_length, etch_window_1, island_1, etch_window_2, island_2, etch_window_3),
+    nw_anchor, nw_rotation, rotation_step, device_layer=layer1, layer=layer1, color=am_colour)
 
 #PLUNGERS
 #these are where you want to position plungers relative to the first coordinate of the nanowire
@@ -493,9 +496,8 @@ tgate_coords_B = [starting_gap+etch_window_1+0.5*island_1,
 #positions the unit plunger block
 plunger_block_B = large_gates.position_plunger("plunger_block_B", "plunger_block", layer2, contact_colour, *plunger_coords_B)
 drawing.blocks.add(plunger_block_B)
-plunger_block_B_ref= dxf.insert(blockname='plunger_block_B', insert=(-nw_grid_width/2+nw_corner_x[0],-nw_grid_height/2+nw_corner_y[0]), columns = 1 , rows = 1, 
-    colspacing = 0, rowspacing = 0, layer = layer1, color =am_colour, rotation = nw_rotation) 
-drawing.add(plunger_block_B_ref)
+plunger_block_B_ref= device_placement.add_device(drawing, 'plunger_block_B', large_gates.position_polygons(plunger_polygons, *plunger_coords_B),
+    nw_anchor, nw_rotation, rotation_step, device_layer=layer2, layer=layer1, color=am_colour)
 
 #positions the tgates
 tgate_tip_width = island_1 - 0.175
@@ -504,18 +506,16 @@ drawing.blocks.add(tgate_block_B)
 
 tgate_block_B1 = large_gates.position_tgates("tgate_block_B1", "tgate_block_B", layer2, contact_colour, *tgate_coords_B)
 drawing.blocks.add(tgate_block_B1)
-tgate_block_B_ref = dxf.insert(blockname='tgate_block_B1', insert=(-nw_grid_width/2+nw_corner_x[0],-nw_grid_height/2+nw_corner_y[0]), 
-    columns = 1 , rows = 1, colspacing = 0, rowspacing = 0, color =am_colour, rotation = nw_rotation) 
-drawing.add(tgate_block_B_ref)
+tgate_block_B_ref = device_placement.add_device(drawing, 'tgate_block_B1', large_gates.position_polygons(large_gates.tgates_side_mirror_polygons(tgate_to_nw, tgate_tip_width, tgate_tip_height, tgate_taper_width), *tgate_coords_B),
+    nw_anchor, nw_rotation, rotation_step, device_layer=layer2, color=am_colour)
 
 #CONTACTS
 #makes the unit and then repeats the contact
 contact_block_B = large_gates.contacts_parallel(drawing, "contact_block_B", layer2, contact_colour, taper_point, taper_length, taper_width, taper_before_track,*contact_coords_B)
 drawing.blocks.add(contact_block_B)
 
-contact_block_ref_B = dxf.insert(blockname='contact_block_B', insert=(-nw_grid_width/2+nw_corner_x[0],-nw_grid_height/2+nw_corner_y[0]), 
-    columns = 1 , rows = 1, colspacing = 0, rowspacing = 0, color =am_colour, rotation = nw_rotation) 
-drawing.add(contact_block_ref_B)
+contact_block_ref_B = device_placement.add_device(drawing, 'contact_block_B', large_gates.contacts_parallel_polygons(taper_point, taper_length, taper_width, taper_before_track, *contact_coords_B),
+    nw_anchor, nw_rotation, rotation_step, device_layer=layer2, color=am_colour)
 
 
 
@@ -527,16 +527,15 @@ island_2 = 2 #adds the double dot etch blocks
 
 nw_corner_x = (210.39227794 ,218.62187771)
 nw_corner_y = (205.97164159,199.62701832)
-nw_rotation = math.atan((nw_corner_y[1]-nw_corner_y[0])/(nw_corner_x[1]-nw_corner_x[0]))*180/math.pi #needs to be in degrees for dxfengine
+nw_anchor, nw_rotation = device_placement.place_wire(nw_corner_x, nw_corner_y, "c", **nw_grid) #needs to be in degrees for dxfengine
 
 #ETCH BLOCK
 dd_etch_block_C = etch_windows.double_dot_etch_block(layer1, starting_gap, window_length, 
     etch_window_1, island_1, etch_window_2, island_2, etch_window_3, "dd_etch_block_C")
 drawing.blocks.add(dd_etch_block_C) #adds the double dot etch blocks
 
-etch_block_ref_C = dxf.insert(blockname='dd_etch_block_C', insert=(-nw_grid_width/2+nw_die_width+nw_grid_spacing+ nw_corner_x[0],-nw_grid_height/2+nw_die_height+nw_grid_spacing+nw_corner_y[0]), 
-    columns = 1 , rows = 1, colspacing = 0, rowspacing = 0, color =am_colour, rotation = nw_rotation) 
-drawing.add(etch_block_ref_C)
+etch_block_ref_C = device_placement.add_device(drawing, 'dd_etch_block_C', etch_windows.double_dot_etch_polygons(starting_gap, window_length, etch_window_1, island_1, etch_window_2, island_2, etch_window_3),
+    nw_anchor, nw_rotation, rotation_step, device_layer=layer1, color=am_colour)
 
 #PLUNGERS
 #these are where you want to position plungers relative to the first coordinate of the nanowire
@@ -556,9 +555,8 @@ tgate_coords_C = [starting_gap+etch_window_1+0.5*island_1,
 #positions the unit plunger block
 plunger_block_C = large_gates.position_plunger("plunger_block_C", "plunger_block", layer2, contact_colour, *plunger_coords_C)
 drawing.blocks.add(plunger_block_C)
-plunger_block_C_ref = dxf.insert(blockname='plunger_block_C', insert=(-nw_grid_width/2+nw_die_width+nw_grid_spacing+ nw_corner_x[0],-nw_grid_height/2+nw_die_height+nw_grid_spacing+nw_corner_y[0]), 
-    columns = 1 , rows = 1, colspacing = 0, rowspacing = 0, color =am_colour, rotation = nw_rotation) 
-drawing.add(plunger_block_C_ref)
+plunger_block_C_ref = device_placement.add_device(drawing, 'plunger_block_C', large_gates.position_polygons(plunger_polygons, *plunger_coords_C),
+    nw_anchor, nw_rotation, rotation_step, device_layer=layer2, color=am_colour)
 
 #positions the tgates
 tgate_tip_width = island_1 - 0.175
@@ -567,9 +565,8 @@ drawing.blocks.add(tgate_block_C)
 
 tgate_block_C1 = large_gates.position_tgates("tgate_block_C1", "tgate_block_C", layer2, contact_colour, *tgate_coords_C)
 drawing.blocks.add(tgate_block_C1)
-tgate_block_C_ref = dxf.insert(blockname='tgate_block_C1', insert=(-nw_grid_width/2+nw_die_width+nw_grid_spacing+ nw_corner_x[0],-nw_grid_height/2+nw_die_height+nw_grid_spacing+nw_corner_y[0]), 
-    columns = 1 , rows = 1, colspacing = 0, rowspacing = 0, color =am_colour, rotation = nw_rotation) 
-drawing.add(tgate_block_C_ref)
+tgate_block_C_ref = device_placement.add_device(drawing, 'tgate_block_C1', large_gates.position_polygons(large_gates.tgates_side_mirror_polygons(tgate_to_nw, tgate_tip_width, tgate_tip_height, tgate_taper_width), *tgate_coords_C),
+    nw_anchor, nw_rotation, rotation_step, device_layer=layer2, color=am_colour)
 
 
 #CONTACTS
@@ -577,9 +574,8 @@ drawing.add(tgate_block_C_ref)
 contact_block_C = large_gates.contacts_parallel(drawing, "contact_block_C", layer2, contact_colour, taper_point, taper_length, taper_width, taper_before_track,*contact_coords_C)
 drawing.blocks.add(contact_block_C)
 
-contact_block_ref_C = dxf.insert(blockname='contact_block_C', insert=(-nw_grid_width/2+nw_die_width+nw_grid_spacing+ nw_corner_x[0],-nw_grid_height/2+nw_die_height+nw_grid_spacing+nw_corner_y[0]), 
-    columns = 1 , rows = 1, colspacing = 0, rowspacing = 0, color =am_colour, rotation = nw_rotation) 
-drawing.add(contact_block_ref_C)
+contact_block_ref_C = device_placement.add_device(drawing, 'contact_block_C', large_gates.contacts_parallel_polygons(taper_point, taper_length, taper_width, taper_before_track, *contact_coords_C),
+    nw_anchor, nw_rotation, rotation_step, device_layer=layer2, color=am_colour)
 
 
 
@@ -593,16 +589,15 @@ island_2 = 3 #adds the double dot etch blocks
 
 nw_corner_x = ( 193.6382245 ,203.3215282)
 nw_corner_y = (87.40188165,86.82848077)
-nw_rotation = math.atan((nw_corner_y[1]-nw_corner_y[0])/(nw_corner_x[1]-nw_corner_x[0]))*180/math.pi #needs to be in degrees for dxfengine
+nw_anchor, nw_rotation = device_placement.place_wire(nw_corner_x, nw_corner_y, "d", **nw_grid) #needs to be in degrees for dxfengine
 
 #ETCH BLOCK
 dd_etch_block_D = etch_windows.double_dot_etch_block(layer1, starting_gap, window_length, 
     etch_window_1, island_1, etch_window_2, island_2, etch_window_3, "dd_etch_block_D")
 drawing.blocks.add(dd_etch_block_D) #adds the double dot etch blocks
 
-etch_block_ref_D = dxf.insert(blockname='dd_etch_block_D', insert=(-nw_grid_width/2+nw_die_width+nw_grid_spacing+nw_corner_x[0],-nw_grid_height/2+nw_corner_y[0]),
-    columns = 1 , rows = 1, colspacing = 0, rowspacing = 0, color =am_colour, rotation = nw_rotation) 
-drawing.add(etch_block_ref_D)
+etch_block_ref_D = device_placement.add_device(drawing, 'dd_etch_block_D', etch_windows.double_dot_etch_polygons(starting_gap, window_length, etch_window_1, island_1, etch_window_2, island_2, etch_window_3),
+    nw_anchor, nw_rotation, rotation_step, device_layer=layer1, color=am_colour)
 
 #PLUNGERS
 #these are where you want to position plungers relative to the first coordinate of the nanowire
@@ -621,9 +616,8 @@ tgate_coords_D = [starting_gap+etch_window_1+0.5*island_1,
 #positions the unit plunger block
 plunger_block_D = large_gates.position_plunger("plunger_block_D", "plunger_block", layer2, contact_colour, *plunger_coords_D)
 drawing.blocks.add(plunger_block_D)
-plunger_block_D_ref = dxf.insert(blockname='plunger_block_D', insert=(-nw_grid_width/2+nw_die_width+nw_grid_spacing+nw_corner_x[0],-nw_grid_height/2+nw_corner_y[0]),
-    columns = 1 , rows = 1, colspacing = 0, rowspacing = 0, color =am_colour, rotation = nw_rotation) 
-drawing.add(plunger_block_D_ref)
+plunger_block_D_ref = device_placement.add_device(drawing, 'plunger_block_D', large_gates.position_polygons(plunger_polygons, *plunger_coords_D),
+    nw_anchor, nw_rotation, rotation_step, device_layer=layer2, color=am_colour)
 
 #positions the tgates
 tgate_tip_width = island_1 - 0.175
@@ -632,18 +626,16 @@ drawing.blocks.add(tgate_block_D)
 
 tgate_block_D1 = large_gates.position_tgates("tgate_block_D1", "tgate_block_D", layer2, contact_colour, *tgate_coords_D)
 drawing.blocks.add(tgate_block_D1)
-tgate_block_D_ref = dxf.insert(blockname='tgate_block_D1', insert=(-nw_grid_width/2+nw_die_width+nw_grid_spacing+nw_corner_x[0],-nw_grid_height/2+nw_corner_y[0]),
-    columns = 1 , rows = 1, colspacing = 0, rowspacing = 0, color =am_colour, rotation = nw_rotation) 
-drawing.add(tgate_block_D_ref)
+tgate_block_D_ref = device_placement.add_device(drawing, 'tgate_block_D1', large_gates.position_polygons(large_gates.tgates_side_mirror_polygons(tgate_to_nw, tgate_tip_width, tgate_tip_height, tgate_taper_width), *tgate_coords_D),
+    nw_anchor, nw_rotation, rotation_step, device_layer=layer2, color=am_colour)
 
 #CONTACTS
 #makes the unit and then repeats the contact
 contact_block_D = large_gates.contacts_parallel(drawing, "contact_block_D", layer2, contact_colour, taper_point, taper_length, taper_width, taper_before_track,*contact_coords_D)
 drawing.blocks.add(contact_block_D)
 
-contact_block_ref_D = dxf.insert(blockname='contact_block_D', insert=(-nw_grid_width/2+nw_die_width+nw_grid_spacing+nw_corner_x[0],-nw_grid_height/2+nw_corner_y[0]),
-    columns = 1 , rows = 1, colspacing = 0, rowspacing = 0, color =am_colour, rotation = nw_rotation) 
-drawing.add(contact_block_ref_D)
+contact_block_ref_D = device_placement.add_device(drawing, 'contact_block_D', large_gates.contacts_parallel_polygons(taper_point, taper_length, taper_width, taper_before_track, *contact_coords_D),
+    nw_anchor, nw_rotation, rotation_step, device_layer=layer2, color=am_colour)
 
 
 #ASSEMBLE THE DRAWING
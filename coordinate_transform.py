@@ -3,6 +3,29 @@ import cv2
 import numpy
 import math
 import os.path
+import argparse
+import csv
+import functools
+import glob
+import hashlib
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import gdspy
+
+import elements
+import raster
+import transforms
+
+# Bump this whenever detect_markers/detect_wires or the misfit change, so that cached
+# results are recomputed rather than reused.
+DETECTOR_VERSION = 3
+CACHE_FIELDS = ("markers", "transform", "residuals", "wires", "misfit")
+# Pixels per um of the rectified image used to measure the layout misfit in batch runs
+MISFIT_SCALE = 2
+# Wire sections, as named in the layout
+SECTIONS = ("a", "b", "c", "d")
 
 # Create a rotation array to rotate by the angle theta
 def rot_mat(theta):
@@ -16,11 +39,98 @@ def showimage(img, name, points=None):
     plt.title(name)
     plt.show()
 
+@functools.lru_cache(maxsize=4)
+def field_polygons(fid="a", sec_size=300):
+    """
+    Get the flattened polygons of a wire section, packed into a (V, 2) vertex array and
+    (P+1,) offsets into it, in um with the origin at the bottom left of the field.
+    Cached, as gdspy only allows each field to be made once per process.
+    """
+    lib = gdspy.GdsLibrary()
+    field = elements.wire_section(lib, fid, sec_size=sec_size, sn_size=20)
+    return raster.pack(field.get_polygons())
+
+def layout_raster(vertices, offsets, die_dims=(300, 300), transform_scale=1, transform_offset=0, supersample=4):
+    """
+    Rasterize packed polygons given in die coordinates (um, origin at the !!bottom
+    left!!, as used by the layout scripts) into the rectified image made by find_nw,
+    where the origin is at the top left and coordinates are scaled by transform_scale
+    and offset by transform_offset. Returns a float image of the covered fraction of
+    each pixel.
+    """
+    pixels = numpy.stack((vertices[:, 0], die_dims[1] - vertices[:, 1]), axis=-1)*transform_scale
+    pixels += transform_offset
+    w, h = (numpy.array(die_dims)*transform_scale + transform_offset).astype(int)
+    # Pixel centres are at integer coordinates
+    return raster.rasterize(pixels, offsets, (-0.5, -0.5), (h, w), 1.0, supersample)
+
+@functools.lru_cache(maxsize=16)
+def field_raster(fid="a", die_dims=(300, 300), transform_scale=1, transform_offset=0):
+    """
+    Rasterize the layout of a wire section (alignment squares, supplementary crosses
+    and serial) as for layout_raster. The result is cached, so that batch runs only
+    render each field once per process.
+    """
+    design = layout_raster(*field_polygons(fid, die_dims[0]), die_dims, transform_scale, transform_offset)
+    design.flags.writeable = False
+    return design
+
+def layout_misfit(img, design):
+    """
+    Compare a rectified SEM image with the rasterized layout. The image is normalised
+    so that the background (below Otsu's threshold) is 0 and the metal is 1, and the
+    misfit of each pixel is its difference from the layout coverage.
+
+    Returns (misfit, score): the per pixel misfit and its mean. Wires are not in the
+    layout, but are thin enough to add little to the score. Raises ValueError if the
+    image has no contrast to separate metal from background.
+    """
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    threshold, _ = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    below, above = img <= threshold, img > threshold
+    if not below.any() or not above.any():
+        raise ValueError("Unable to separate metal from background to compare with the layout.")
+    background, metal = img[below].mean(), img[above].mean()
+    normalised = numpy.clip((img.astype(numpy.float32) - background)/max(metal - background, 1), 0, 1)
+    misfit = numpy.abs(normalised - design)
+    return misfit, float(misfit.mean())
+
+def field_misfit(img, field=None, die_dims=(300, 300), transform_scale=1):
+    """
+    Layout misfit score (see layout_misfit) of a rectified SEM image against the wire
+    section it shows: the section named by field if it is one of SECTIONS, otherwise
+    whichever section it fits best. The misfit is only a diagnostic, so an image
+    without the contrast to compare gives nan rather than an error.
+    """
+    fid = str(field).lower()
+    sections = (fid,) if fid in SECTIONS else SECTIONS
+    try:
+        return min(layout_misfit(img, field_raster(s, tuple(die_dims), transform_scale))[1] for s in sections)
+    except ValueError:
+        return float("nan")
+
+def overlay_layout(img, design, color=(0, 0, 255), alpha=0.3):
+    """
+    Draw the rasterized layout over a rectified SEM image: tinted inside, and outlined.
+    Returns a BGR image.
+    """
+    if img.ndim == 2:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    covered = (design > 0.5).astype(numpy.uint8)
+    edges = covered - cv2.erode(covered, numpy.ones((3, 3), numpy.uint8))
+    tint = alpha*design[..., numpy.newaxis]
+    out = img*(1 - tint) + numpy.array(color)*tint
+    out[edges > 0] = color
+    return out.astype(numpy.uint8)
+
 # The following code assumes that the origin is in the !!top left!!.
 # The first argument is the alignment marker coords (tl, tr, bl, br)
 # Following this, pass in the two coordinates of the nanowire.
+# If overlay is set, the layout of the field (and any planned device polygons, in die
+# coordinates with the origin at the bottom left) is drawn over the rectified image.
 def find_nw(marker_coords, nw_coords, die_dims=(300, 300), img=None, 
-            transform_offset=0, transform_scale=1):
+            transform_offset=0, transform_scale=1, overlay=False, fid="a", devices=()):
     # Check that our arrays are numpy arrays
     if not isinstance(marker_coords, numpy.ndarray):
         marker_coords = numpy.array(marker_coords, dtype=numpy.float32)
@@ -40,22 +150,29 @@ def find_nw(marker_coords, nw_coords, die_dims=(300, 300), img=None,
     elif img is not None:
         raise ValueError("img must be an image read in by cv2.imread")
 
-    # Do an openCV Perspective Transform
+    # Fit a perspective transform to the markers
     # Note, desired coordinates are offset in order to show a border
     desired_coords = numpy.array(((0, 0), (die_dims[0], 0), (0, die_dims[1]), die_dims)) * transform_scale
     desired_coords += transform_offset
-    desired_coords = numpy.float32(desired_coords)
-    M = cv2.getPerspectiveTransform(marker_coords, desired_coords)
+    M, _ = transforms.fit_projective(marker_coords, desired_coords)
 
     # And transform the raw coordinates
-    marker_coords = cv2.perspectiveTransform(numpy.array([marker_coords]), M)[0]
-    nw_coords = cv2.perspectiveTransform(numpy.array([nw_coords]), M)[0]
+    marker_coords = transforms.apply_transform(M, marker_coords)
+    nw_coords = transforms.apply_transform(M, nw_coords)
 
     # If we have the image, show it
     if have_image:
         size = (numpy.array(die_dims) * transform_scale) + transform_offset
         size = tuple(size)
         dst = cv2.warpPerspective(img, M, size)
+        if overlay:
+            design = field_raster(fid, tuple(die_dims), transform_scale, transform_offset)
+            if len(devices):
+                planned = layout_raster(*raster.pack(list(devices)), die_dims, transform_scale, transform_offset)
+                design = numpy.maximum(design, planned)
+            _, score = layout_misfit(dst, design)
+            print(f"Layout misfit: {score:.4f}")
+            dst = overlay_layout(dst, design)
         showimage(dst, "result", numpy.concatenate((marker_coords, nw_coords)))
         cv2.imwrite("res.tif", dst)
 
@@ -68,7 +185,270 @@ def find_nw(marker_coords, nw_coords, die_dims=(300, 300), img=None,
 
     return (marker_coords, nw_coords)
 
-if __name__ == "__main__":
+def _corner_extreme(mask, quadrant):
+    """
+    Find the pixel of mask that lies furthest towards the image corner given by
+    quadrant (tl, tr, bl, br). The alignment squares run diagonally in from each
+    corner, so the extreme point along the diagonal is the outer marker corner.
+    """
+    ys, xs = numpy.nonzero(mask)
+    if xs.size == 0:
+        return None
+    sx = -1 if quadrant in ("tl", "bl") else 1
+    sy = -1 if quadrant in ("tl", "tr") else 1
+    i = numpy.argmax(sx*xs + sy*ys)
+    return (xs[i], ys[i])
+
+def _background_stats(img):
+    """
+    Robust estimate of the background level (median) and noise (scaled median absolute
+    deviation) of an 8 bit image, computed from its histogram.
+    """
+    cdf = numpy.cumsum(numpy.bincount(img.ravel(), minlength=256))
+    background = numpy.searchsorted(cdf, cdf[-1]/2)
+    deviation = numpy.abs(numpy.arange(256) - background)
+    dev_cdf = numpy.cumsum(numpy.bincount(deviation, weights=numpy.diff(cdf, prepend=0)))
+    return background, 1.4826*numpy.searchsorted(dev_cdf, dev_cdf[-1]/2)
+
+def detect_markers(img, min_area=100, refine_window=5, close_size=7):
+    """
+    Detect the four field alignment markers in an SEM image of a wire section.
+
+    The image is thresholded and closed, so that the squares in each diagonal chain
+    of alignment squares (which only touch at their corners) form a single blob.
+    In each quadrant, the sparsest of the large blobs (lowest fill of its bounding
+    box) is taken to be the chain, which rejects the solid serial number glyph.
+    The outermost corner of that chain is returned, refined to subpixel accuracy.
+
+    Returns the marker coordinates in the (tl, tr, bl, br) order expected by
+    find_nw, or raises ValueError if a marker can't be found.
+    """
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    blur = cv2.GaussianBlur(img, (5, 5), 0)
+    _, binary = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    closed = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, numpy.ones((close_size, close_size), numpy.uint8))
+
+    h, w = binary.shape
+    n_labels, labels, stats, _ = cv2.connectedComponentsWithStats(closed, connectivity=8)
+    fill = stats[:, cv2.CC_STAT_AREA]/(stats[:, cv2.CC_STAT_WIDTH]*stats[:, cv2.CC_STAT_HEIGHT])
+    quadrants = (("tl", (0, 0)), ("tr", (w//2, 0)), ("bl", (0, h//2)), ("br", (w//2, h//2)))
+    markers = []
+    for quadrant, (qx, qy) in quadrants:
+        sub_labels = labels[qy:qy+h//2, qx:qx+w//2]
+        found, counts = numpy.unique(sub_labels[sub_labels > 0], return_counts=True)
+        if found.size == 0 or counts.max() < min_area:
+            raise ValueError(f"Unable to find the {quadrant} alignment marker.")
+        candidates = found[counts >= counts.max()/4]
+        label = candidates[numpy.argmin(fill[candidates])]
+        corner = _corner_extreme(sub_labels == label, quadrant)
+        markers.append((corner[0] + qx, corner[1] + qy))
+
+    markers = numpy.array(markers, dtype=numpy.float32).reshape(-1, 1, 2)
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+    cv2.cornerSubPix(blur, markers, (refine_window, refine_window), (-1, -1), criteria)
+    return markers.reshape(4, 2)
+
+def detect_wires(img, markers, min_length=20, min_aspect=4, exclude=0.05, threshold=5):
+    """
+    Detect nanowires in an SEM image as long, thin bright blobs.
+
+    Wires are much fainter than the alignment marks, so rather than using Otsu's
+    method the threshold is set threshold standard deviations above the background,
+    estimated robustly from the median and median absolute deviation. Blobs that lie
+    within exclude (as a fraction of the marker spacing) of the alignment markers are
+    ignored. Returns an (N, 2, 2) array giving the two endpoints of each wire in image
+    coordinates.
+    """
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    blur = cv2.GaussianBlur(img, (3, 3), 0)
+    background, noise = _background_stats(blur)
+    binary = (blur > background + threshold*max(noise, 1)).astype(numpy.uint8)
+
+    spacing = numpy.linalg.norm(markers[1] - markers[0])
+    contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    wires = []
+    for contour in contours:
+        (cx, cy), (rw, rh), angle = cv2.minAreaRect(contour)
+        length, width = max(rw, rh), max(min(rw, rh), 1)
+        if length < min_length or length/width < min_aspect:
+            continue
+        # Ignore anything touching the alignment squares
+        if any(cv2.pointPolygonTest(contour, (float(x), float(y)), True) > -exclude*spacing
+               for x, y in markers):
+            continue
+        theta = math.radians(angle if rw >= rh else angle + 90)
+        half = numpy.array((math.cos(theta), math.sin(theta)))*length/2
+        wires.append(((cx, cy) - half, (cx, cy) + half))
+    return numpy.array(wires, dtype=numpy.float32).reshape(-1, 2, 2)
+
+def process_image(key, img, die_dims=(300, 300), field=None):
+    """
+    Run detection, homography and wire extraction on a single SEM frame.
+
+    Returns a dictionary with the key that was passed in, the detected markers (image
+    coordinates), the perspective transform and the wire endpoints in die coordinates
+    with the origin at the !!bottom left!! of the die, as used by the layout scripts,
+    and the layout misfit against the field the image shows (see field_misfit).
+    """
+    markers = detect_markers(img)
+    wires = detect_wires(img, markers)
+
+    desired_coords = numpy.array(((0, 0), (die_dims[0], 0), (0, die_dims[1]), die_dims))
+    M, _ = transforms.fit_projective(markers, desired_coords)
+    wires = transforms.apply_transform(M, wires)
+    wires[..., 1] = die_dims[1] - wires[..., 1]
+
+    # The perspective transform always fits four markers exactly, so the residuals
+    # of an affine fit are kept instead, as a sanity check on the detection.
+    _, residuals = transforms.fit_affine(markers, desired_coords)
+
+    # Compare the rectified image with the layout, to catch misdetected markers
+    size = tuple((numpy.array(die_dims)*MISFIT_SCALE).astype(int))
+    rectified = cv2.warpPerspective(img, numpy.diag((MISFIT_SCALE, MISFIT_SCALE, 1))@M, size)
+    misfit = field_misfit(rectified, field, die_dims, MISFIT_SCALE)
+
+    return {"key": key, "markers": markers, "transform": M,
+            "residuals": residuals, "wires": wires, "misfit": misfit}
+
+def cache_key(data, die_dims=(300, 300)):
+    """
+    Key used to cache results for an image, from the hash of the raw image file,
+    the detector version and the die dimensions.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    return f"{digest}_v{DETECTOR_VERSION}_{die_dims[0]:g}x{die_dims[1]:g}"
+
+def load_cached(cache_dir, ckey):
+    """
+    Load a cached result, returning None if it hasn't been computed yet.
+    """
+    try:
+        with numpy.load(os.path.join(cache_dir, f"{ckey}.npz")) as cached:
+            return {field: cached[field] for field in CACHE_FIELDS}
+    except (OSError, KeyError, ValueError):
+        return None
+
+def save_cached(cache_dir, ckey, result):
+    """
+    Save the computed transform, markers, residuals, wires and layout misfit for an image.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary file first so an interrupted run can't leave a corrupt entry
+    tmp_path = os.path.join(cache_dir, f"{ckey}.tmp.npz")
+    numpy.savez(tmp_path, **{field: result[field] for field in CACHE_FIELDS})
+    os.replace(tmp_path, os.path.join(cache_dir, f"{ckey}.npz"))
+
+def find_images(root, pattern="*/SEM_Alignment/*.tif"):
+    """
+    Find all SEM images below root, laid out as <root>/<die>/SEM_Alignment/<image>.tif.
+
+    Returns a list of ((die, field), path) pairs, where the field is the last
+    underscore separated part of the image name (i.e. NW170926_56_03.tif is field 03).
+    """
+    images = []
+    for path in sorted(glob.glob(os.path.join(root, pattern))):
+        die = os.path.basename(os.path.dirname(os.path.dirname(path)))
+        field = os.path.splitext(os.path.basename(path))[0].rsplit("_", 1)[-1]
+        images.append(((die, field), path))
+    return images
+
+def _prefetch(images, out_queue, die_dims, cache_dir):
+    """
+    Decode images in the background, handing them over through a bounded queue.
+
+    If a cache_dir is given, images with a cached result are passed through
+    without being decoded. Images that can't be read are passed on with the
+    exception in place of the image, and the end of the images is always marked
+    with None, so the consumer never waits forever.
+    """
+    try:
+        for key, path in images:
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+            except OSError as e:
+                out_queue.put((key, path, None, e))
+                continue
+            ckey = cache_key(data, die_dims)
+            if cache_dir is not None:
+                cached = load_cached(cache_dir, ckey)
+                if cached is not None:
+                    out_queue.put((key, path, ckey, cached))
+                    continue
+            img = cv2.imdecode(numpy.frombuffer(data, numpy.uint8), cv2.IMREAD_GRAYSCALE)
+            out_queue.put((key, path, ckey, img))
+    finally:
+        out_queue.put(None)
+
+def process_batch(images, die_dims=(300, 300), workers=None, prefetch=8, cache_dir=None):
+    """
+    Process a list of ((die, field), path) images in a process pool.
+
+    Image decoding runs in a separate thread, at most prefetch images ahead of
+    the workers, so that reading from disk overlaps with compute. Yields
+    (path, result) pairs as they complete, where result is either the dictionary
+    returned by process_image, or the exception raised while processing.
+
+    If cache_dir is given, results are cached there, keyed by the hash of the image
+    file and DETECTOR_VERSION, so only new or changed images are processed on reruns.
+    """
+    decoded = queue.Queue(maxsize=prefetch)
+    reader = threading.Thread(target=_prefetch, args=(images, decoded, die_dims, cache_dir),
+                              daemon=True)
+    reader.start()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        done = False
+        while not done or pending:
+            # Keep the pool fed without letting decoded images pile up in memory
+            while not done and len(pending) < prefetch:
+                item = decoded.get()
+                if item is None:
+                    done = True
+                    break
+                key, path, ckey, img = item
+                if isinstance(img, dict):
+                    yield path, dict(img, key=key)
+                    continue
+                if isinstance(img, Exception):
+                    yield path, img
+                    continue
+                if img is None:
+                    yield path, ValueError(f"Unable to read image {path}")
+                    continue
+                pending[pool.submit(process_image, key, img, die_dims, key[1])] = (path, ckey)
+            if not pending:
+                continue
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                path, ckey = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # One bad frame shouldn't stop the rest of the batch
+                    yield path, e
+                    continue
+                if cache_dir is not None:
+                    save_cached(cache_dir, ckey, result)
+                yield path, result
+
+def write_positions(results, filename):
+    """
+    Write a positions table (CSV) keyed by die and field, one row per wire.
+    """
+    with open(filename, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(("die", "field", "wire", "x1", "y1", "x2", "y2", "misfit", "image"))
+        for path, result in sorted(results, key=lambda r: r[1]["key"]):
+            die, field = result["key"]
+            for i, wire in enumerate(result["wires"]):
+                writer.writerow((die, field, i, *(f"{x:.4f}" for x in wire.flatten()),
+                                 f"{float(result['misfit']):.4f}", path))
+
+def _example():
     impath = "/Users/spauka/Dropbox/DotPics/Nanowire_Fab/NW170926/NW_Alignment/56/SEM_Alignment"
 
     # Open the raw image (if available)
@@ -98,3 +478,35 @@ if __name__ == "__main__":
     print("NW Coordinates, shifted origin")
     print(numpy.abs(nw - (0, 300)))
 
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Translate nanowire coordinates from SEM images to die coordinates.")
+    subparsers = parser.add_subparsers(dest="command")
+    batch = subparsers.add_parser("batch", help="Process every SEM image in a lot.")
+    batch.add_argument("ROOT", type=str, help="Alignment directory, laid out as <die>/SEM_Alignment/*.tif")
+    batch.add_argument("OUTPUT", type=str, help="Output positions table (csv)")
+    batch.add_argument("-j", "--jobs", type=int, default=None, help="Number of worker processes")
+    batch.add_argument("--prefetch", type=int, default=8, help="Number of images to decode ahead")
+    batch.add_argument("--die-size", type=float, nargs=2, default=(300, 300), help="Die dimensions in um")
+    batch.add_argument("--cache", type=str, default=None,
+                       help="Result cache directory (default: <ROOT>/.transform_cache)")
+    batch.add_argument("--no-cache", action="store_true", help="Recompute every image")
+    args = parser.parse_args()
+
+    if args.command == "batch":
+        images = find_images(args.ROOT)
+        cache_dir = None
+        if not args.no_cache:
+            cache_dir = args.cache or os.path.join(args.ROOT, ".transform_cache")
+        results = []
+        for path, result in process_batch(images, tuple(args.die_size), args.jobs,
+                                          args.prefetch, cache_dir):
+            if isinstance(result, Exception):
+                print(f"Failed {path}: {result}")
+                continue
+            print(f"Processed {path}: {len(result['wires'])} wires, misfit {float(result['misfit']):.3f}")
+            results.append((path, result))
+        write_positions(results, args.OUTPUT)
+        print(f"Written {len(results)}/{len(images)} images to {args.OUTPUT}.")
+    else:
+        _example()
@@ -0,0 +1,412 @@
+"""
+Design rule checks (minimum width, minimum spacing, enclosure and acute angles) for
+hierarchical layouts, so that device layers pushing the resolution limit (60 nm
+plunger tips, 20 nm etch windows) are caught before they are written.
+
+Each unique cell's own polygons are checked once, in the coordinates of the cell,
+however many times it is instanced. Interactions between instances (polygons in
+different instances that come within the spacing of each other, and enclosures) are
+found with a packed R-tree over the bounding box of every polygon instance (see
+spatial_index), so only pairs that are close are checked. A pair is identified by
+its two polygons and their relative transform, so a pair that repeats in every die
+is only checked once.
+
+Checks are done on edges, for every pair of edges at once: the width of a polygon is
+the distance between two of its edges that face each other across its inside, a
+notch is the same across its outside, and the spacing between two polygons is the
+distance between their boundaries. Polygons that touch or overlap are merged when
+they are written, so they are not a spacing violation (but the notches of the merged
+shape are not checked either). The polygons of magnified references are checked at
+the scale of the referenced cell.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import gdspy
+
+import layout_stats
+import raster
+import spatial_index
+
+# Defaults, from the smallest NW170926 features (etch windows)
+MIN_WIDTH = 0.02 # um
+MIN_SPACING = 0.02 # um
+MIN_ANGLE = 45.0 # degrees
+# Distances within this of a rule pass, so features drawn exactly at the limit are allowed
+TOLERANCE = 1e-6 # um
+
+def _rule(rule, layer):
+    """
+    The value of a rule for a layer, where a rule is a single value for every layer or a
+    dictionary of layer to value (missing layers are not checked).
+    """
+    return rule.get(layer) if isinstance(rule, dict) else rule
+
+def _gather(vertices, offsets, index):
+    """
+    The packed polygons with the given indices, as a new (vertices, offsets).
+    """
+    lengths = np.diff(offsets)[index]
+    starts = np.concatenate(([0], np.cumsum(lengths)))
+    rows = np.repeat(offsets[index] - starts[:-1], lengths) + np.arange(starts[-1])
+    return vertices[rows], starts
+
+def _cross(u, v):
+    return u[..., 0]*v[..., 1] - u[..., 1]*v[..., 0]
+
+def _closest(p, s0, s1):
+    """
+    The closest point to each p on the segment s0-s1.
+    """
+    d = s1 - s0
+    t = np.clip(np.sum((p - s0)*d, axis=-1)/np.maximum(np.sum(d*d, axis=-1), 1e-30), 0, 1)
+    return s0 + t[..., np.newaxis]*d
+
+def segment_distance(a0, a1, b0, b1):
+    """
+    Distance between each pair of segments a0-a1 and b0-b1 ((N, 2) arrays of ends), and
+    the closest points on each. Segments that cross are at distance 0.
+    """
+    pa = np.stack((a0, a1, _closest(b0, a0, a1), _closest(b1, a0, a1)))
+    pb = np.stack((_closest(a0, b0, b1), _closest(a1, b0, b1), b0, b1))
+    k = np.argmin(np.linalg.norm(pa - pb, axis=-1), axis=0)
+    rows = np.arange(len(a0))
+    pa, pb = pa[k, rows], pb[k, rows]
+    da, db = a1 - a0, b1 - b0
+    crosses = ((_cross(da, b0 - a0)*_cross(da, b1 - a0) < 0) & (_cross(db, a0 - b0)*_cross(db, a1 - b0) < 0))
+    distance = np.where(crosses, 0.0, np.linalg.norm(pa - pb, axis=-1))
+    return distance, pa, pb
+
+def _group_min(values, group, n):
+    """
+    The minimum of values in each of n groups (inf for empty groups), and the index of
+    the minimum (-1 for empty groups).
+    """
+    best = np.full(n, np.inf)
+    where = np.full(n, -1, dtype=np.int64)
+    if len(values):
+        order = np.lexsort((values, group))
+        first = order[np.concatenate(([True], group[order][1:] != group[order][:-1]))]
+        best[group[first]] = values[first]
+        where[group[first]] = first
+    return best, where
+
+def polygon_pairs(va, oa, vb, ob, ia, ib):
+    """
+    Compare pairs of packed polygons: polygon ia[k] of (va, oa) with polygon ib[k] of
+    (vb, ob), checking every edge of one against every edge of the other.
+
+    Returns (distance, points, inside, overlap): the distance between the boundaries of
+    each pair, the (K, 2, 2) closest points on each, whether every vertex of the first
+    polygon is inside the second, and whether the polygons touch or overlap.
+    """
+    la, lb = np.diff(oa)[ia], np.diff(ob)[ib]
+    n = la*lb
+    pair = np.repeat(np.arange(len(ia)), n)
+    local = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+    i, j = local//lb[pair], local % lb[pair]
+    ea, eb = oa[ia][pair] + i, ob[ib][pair] + j
+    a0, a1 = va[ea], va[raster.next_vertex(oa)[ea]]
+    b0, b1 = vb[eb], vb[raster.next_vertex(ob)[eb]]
+    distance, pa, pb = segment_distance(a0, a1, b0, b1)
+    distance, closest = _group_min(distance, pair, len(ia))
+
+    def crossings(p, s0, s1):
+        # Whether a ray from p along +x crosses the segment s0-s1
+        straddle = (s0[:, 1] > p[:, 1]) != (s1[:, 1] > p[:, 1])
+        x = s0[:, 0] + (p[:, 1] - s0[:, 1])*(s1[:, 0] - s0[:, 0])/np.where(straddle, s1[:, 1] - s0[:, 1], 1)
+        return straddle & (p[:, 0] < x)
+
+    # Point in polygon for every vertex of each polygon, by counting crossings
+    start_a, start_b = np.cumsum(la) - la, np.cumsum(lb) - lb
+    a_in = np.bincount(start_a[pair] + i, crossings(a0, b0, b1), minlength=la.sum()) % 2 == 1
+    b_in = np.bincount(start_b[pair] + j, crossings(b0, a0, a1), minlength=lb.sum()) % 2 == 1
+    inside = np.logical_and.reduceat(a_in, start_a) if len(ia) else np.zeros(0, dtype=bool)
+    overlap = ((distance <= TOLERANCE) | np.logical_or.reduceat(a_in, start_a) | np.logical_or.reduceat(b_in, start_b)
+               if len(ia) else np.zeros(0, dtype=bool))
+    points = np.stack((pa[closest], pb[closest]), axis=1) if len(ia) else np.zeros((0, 2, 2))
+    return distance, points, inside, overlap
+
+def facing_edges(vertices, offsets, distance, inside=True):
+    """
+    Find pairs of edges of the same polygon that face each other across the inside of
+    the polygon (for width) or the outside (for notches) and are less than distance
+    apart. Edges face each other if they point in opposite directions and each is on
+    the given side of the other. Edges that only touch along a keyhole cut are left out.
+
+    Returns (polygons, distances, points): the polygon and distance of each pair, and
+    the (N, 2, 2) closest points on its edges.
+    """
+    lengths = np.diff(offsets)
+    n = lengths*lengths
+    polygon = np.repeat(np.arange(len(lengths)), n)
+    local = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+    size = lengths[polygon]
+    i, j = local//size, local % size
+    # Each pair once, leaving out neighbouring edges (which meet at a vertex)
+    keep = (j > i + 1) & ~((i == 0) & (j == size - 1))
+    polygon, i, j = polygon[keep], i[keep], j[keep]
+    ea, eb = offsets[:-1][polygon] + i, offsets[:-1][polygon] + j
+    nxt = raster.next_vertex(offsets)
+    a0, a1, b0, b1 = vertices[ea], vertices[nxt[ea]], vertices[eb], vertices[nxt[eb]]
+    da, db = a1 - a0, b1 - b0
+    # Reorient clockwise polygons, so the inside is always on the left
+    side = np.sign(raster.signed_areas(vertices, offsets))[polygon]*(1 if inside else -1)
+    facing = ((np.sum(da*db, axis=1) < 0) & (side*_cross(da, (b0 + b1)/2 - a0) > 0)
+              & (side*_cross(db, (a0 + a1)/2 - b0) > 0))
+    a0, a1, b0, b1, polygon = a0[facing], a1[facing], b0[facing], b1[facing], polygon[facing]
+    d, pa, pb = segment_distance(a0, a1, b0, b1)
+    close = d < distance - TOLERANCE
+    # Keyhole cuts (which join a hole to the outside, as in text and boolean results)
+    # make edges that are not neighbours meet: the two sides of the cut lie on top of
+    # each other, and the edges either side of each end of the cut share a vertex.
+    # Neither is a notch or a narrow place.
+    length = np.maximum(np.linalg.norm(a1 - a0, axis=1), 1e-30)
+    collinear = ((np.abs(_cross(a1 - a0, b0 - a0)) <= TOLERANCE*length)
+                 & (np.abs(_cross(a1 - a0, b1 - a0)) <= TOLERANCE*length))
+    ends = np.stack([np.linalg.norm(p - q, axis=1) for p in (a0, a1) for q in (b0, b1)])
+    close &= ~((collinear | (ends.min(axis=0) <= TOLERANCE)) & (d <= TOLERANCE))
+    return polygon[close], d[close], np.stack((pa[close], pb[close]), axis=1)
+
+def _narrowest(vertices, offsets, distance, inside):
+    """
+    The narrowest place in each polygon that fails a width (or notch) check, as a list
+    of (value, position), so that a narrow curve is reported once rather than for every
+    pair of its edges.
+    """
+    polygon, d, points = facing_edges(vertices, offsets, distance, inside)
+    found, where = _group_min(d, polygon, len(offsets) - 1)
+    return [(float(found[p]), points[where[p]].mean(axis=0)) for p in np.nonzero(where >= 0)[0]]
+
+def acute_angles(vertices, offsets, min_angle=MIN_ANGLE):
+    """
+    Find vertices where the inside angle of a polygon is less than min_angle (degrees).
+    Returns (polygons, vertex indices, angles in degrees).
+    """
+    nxt = raster.next_vertex(offsets)
+    prev = np.empty_like(nxt)
+    prev[nxt] = np.arange(len(nxt))
+    e1, e2 = vertices - vertices[prev], vertices[nxt] - vertices
+    polygon = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    orientation = np.sign(raster.signed_areas(vertices, offsets))[polygon]
+    turn = np.arctan2(_cross(e1, e2), np.sum(e1*e2, axis=1))*orientation
+    angle = np.degrees(np.pi - turn)
+    valid = (np.linalg.norm(e1, axis=1) > 0) & (np.linalg.norm(e2, axis=1) > 0)
+    acute = np.nonzero(valid & (angle < min_angle - TOLERANCE))[0]
+    return polygon[acute], acute, angle[acute]
+
+def check_cell(node, width=MIN_WIDTH, spacing=MIN_SPACING, min_angle=MIN_ANGLE, layers=None):
+    """
+    Check the polygons directly in a cell (ignoring references) for width, notches,
+    spacing between its polygons and acute angles, in the coordinates of the cell.
+    Width and notches are reported at the narrowest place in each polygon.
+
+    Returns a list of (rule, layer, value, (x, y)) violations, where value is the
+    measured width, spacing or angle.
+    """
+    violations = []
+    for layer, (vertices, offsets) in raster.cell_layers(node, layers).items():
+        w, s = _rule(width, layer), _rule(spacing, layer)
+        if w is not None:
+            violations.extend(("width", layer, *found) for found in _narrowest(vertices, offsets, w, True))
+        if s is not None:
+            violations.extend(("notch", layer, *found) for found in _narrowest(vertices, offsets, s, False))
+            tree = spatial_index.RTree(raster.polygon_bounds(vertices, offsets))
+            ia, ib = tree.join(tree, s)
+            ia, ib = ia[ia < ib], ib[ia < ib]
+            d, points, _, overlap = polygon_pairs(vertices, offsets, vertices, offsets, ia, ib)
+            close = np.nonzero(~overlap & (d < s - TOLERANCE))[0]
+            violations.extend(("spacing", layer, float(d[k]), points[k].mean(axis=0)) for k in close)
+        if min_angle is not None:
+            _, vertex, angle = acute_angles(vertices, offsets, min_angle)
+            violations.extend(("angle", layer, float(a), vertices[v]) for v, a in zip(vertex, angle))
+    return violations
+
+def _transform(points, T):
+    return points@T[..., :2, :2].swapaxes(-1, -2) + T[..., np.newaxis, :2, 2]
+
+def _instances(cells, layer):
+    """
+    Every instance of every polygon on a layer, as (cell, polygon, transform, boxes):
+    the index of its cell in cells (a list of (cell, transforms, polygons by layer)),
+    its index in the packed polygons of the cell, the index of its instance in the
+    concatenated transforms of every cell, and its bounding box in top cell coordinates.
+    """
+    cell, polygon, transform, boxes = [], [], [], []
+    first = 0
+    for c, (_, T, own) in enumerate(cells):
+        if layer in own:
+            bounds = raster.polygon_bounds(*own[layer])
+            corners = np.stack((bounds[:, (0, 1, 0, 1), 0], bounds[:, (0, 0, 1, 1), 1]), axis=-1)
+            placed = _transform(corners[np.newaxis], T[:, np.newaxis]) # (K, P, 4, 2)
+            boxes.append(np.stack((placed.min(axis=2), placed.max(axis=2)), axis=2).reshape(-1, 2, 2))
+            cell.append(np.full(placed.shape[0]*placed.shape[1], c))
+            polygon.append(np.tile(np.arange(len(bounds)), len(T)))
+            transform.append(np.repeat(np.arange(first, first + len(T)), len(bounds)))
+        first += len(T)
+    if not boxes:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, np.zeros((0, 2, 2))
+    return np.concatenate(cell), np.concatenate(polygon), np.concatenate(transform), np.concatenate(boxes)
+
+def _relative_pairs(cells, transforms, a, b, ia, ib, layer_a, layer_b):
+    """
+    Reduce pairs of polygon instances (ia[k] of the instances a with ib[k] of b, see
+    _instances) to unique pairs of polygons and relative transforms, and compare each
+    unique pair once (see polygon_pairs) in the coordinates of the first polygon's cell.
+
+    Returns (inverse, first, distance, points, inside, overlap): the unique pair of each
+    instance pair, the first instance pair of each unique pair, and the comparison of
+    each unique pair.
+    """
+    cell_a, poly_a, t_a = a[0][ia], a[1][ia], a[2][ia]
+    cell_b, poly_b, t_b = b[0][ib], b[1][ib], b[2][ib]
+    relative = np.linalg.inv(transforms[t_a])@transforms[t_b]
+    # Round to well below the database grid, so repeated instances give identical keys
+    keys = np.concatenate((np.stack((cell_a, poly_a, cell_b, poly_b), axis=1),
+                           np.round(relative[:, :2].reshape(-1, 6)*1e6).astype(np.int64)), axis=1)
+    _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+
+    def packed(cell, poly, layer):
+        # Every polygon on the layer, numbered cell by cell
+        parts = [own[layer] if layer in own else (np.zeros((0, 2)), np.zeros(1, dtype=np.int64))
+                 for _, _, own in cells]
+        base = np.concatenate(([0], np.cumsum([len(o) - 1 for _, o in parts])))
+        lengths = np.concatenate([np.diff(o) for _, o in parts])
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        return _gather(np.concatenate([v for v, _ in parts]), offsets, base[cell] + poly)
+
+    va, oa = packed(cell_a[first], poly_a[first], layer_a)
+    vb, ob = packed(cell_b[first], poly_b[first], layer_b)
+    # Move the second polygon of each pair into the coordinates of the first
+    R = np.repeat(relative[first], np.diff(ob), axis=0)
+    vb = np.einsum("nij,nj->ni", R[:, :2, :2], vb) + R[:, :2, 2]
+    distance, points, inside, overlap = polygon_pairs(va, oa, vb, ob, np.arange(len(first)), np.arange(len(first)))
+    return inverse, first, distance, points, inside, overlap
+
+def check_interactions(cells, layer, spacing):
+    """
+    Check the spacing between polygons on a layer in different instances (or in a
+    parent and one of its children), for cells as from layout_stats.instance_transforms
+    with their polygons (a list of (cell, transforms, polygons by layer)).
+
+    Returns a list of (rule, layer, value, (x, y), cell names, count) violations, one
+    for each unique pair of polygons and relative transform, with the position of its
+    first instance in top cell coordinates and the number of times it occurs.
+    """
+    transforms = np.concatenate([T for _, T, _ in cells])
+    instances = _instances(cells, layer)
+    tree = spatial_index.RTree(instances[3])
+    ia, ib = tree.join(tree, spacing)
+    different = (ia < ib) & (instances[2][ia] != instances[2][ib])
+    ia, ib = ia[different], ib[different]
+    if not len(ia):
+        return []
+    inverse, first, distance, points, _, overlap = _relative_pairs(cells, transforms, instances, instances, ia, ib,
+                                                                   layer, layer)
+    counts = np.bincount(inverse, minlength=len(first))
+    violations = []
+    for k in np.nonzero(~overlap & (distance < spacing - TOLERANCE))[0]:
+        position = _transform(points[k].mean(axis=0)[np.newaxis], transforms[instances[2][ia[first[k]]]])[0]
+        names = (cells[instances[0][ia[first[k]]]][0].name, cells[instances[0][ib[first[k]]]][0].name)
+        violations.append(("spacing", layer, float(distance[k]), position, names, int(counts[k])))
+    return violations
+
+def check_enclosure(cells, inner, outer, margin):
+    """
+    Check that every polygon on layer inner is inside a polygon on layer outer, at
+    least margin from its edges. Polygons are compared across the hierarchy, as in
+    check_interactions, and each unique pair is only compared once.
+
+    Returns a list of (rule, (inner, outer), value, (x, y), cell name, count)
+    violations, one for each polygon of a cell that fails in any instance, where value
+    is the largest enclosure found (0 if it is not inside any polygon).
+    """
+    transforms = np.concatenate([T for _, T, _ in cells])
+    a, b = _instances(cells, inner), _instances(cells, outer)
+    if not len(a[0]):
+        return []
+    ia, ib = spatial_index.RTree(b[3]).query_boxes(a[3])
+    # Only pairs where the outer box contains the inner box can enclose it. The margin
+    # is left out, so that best holds the real enclosure of polygons that are too close
+    contains = np.all((b[3][ib, 0] <= a[3][ia, 0] + TOLERANCE) & (b[3][ib, 1] >= a[3][ia, 1] - TOLERANCE), axis=1)
+    ia, ib = ia[contains], ib[contains]
+    best = np.zeros(len(a[0]))
+    if len(ia):
+        inverse, _, distance, _, inside, _ = _relative_pairs(cells, transforms, a, b, ia, ib, inner, outer)
+        np.maximum.at(best, ia, np.where(inside, distance, 0)[inverse])
+    failed = np.nonzero(best < margin - TOLERANCE)[0]
+    violations = []
+    keys, first, counts = np.unique(np.stack((a[0][failed], a[1][failed]), axis=1), axis=0, return_index=True,
+                                    return_counts=True)
+    for (c, _), k, count in zip(keys, failed[first], counts):
+        violations.append(("enclosure", (inner, outer), float(best[k]), a[3][k].mean(axis=0), cells[c][0].name,
+                           int(count)))
+    return violations
+
+def check(cell, lib=None, width=MIN_WIDTH, spacing=MIN_SPACING, min_angle=MIN_ANGLE, enclosures=(), layers=None):
+    """
+    Check a cell and everything it references. width and spacing are a value for every
+    layer, or a dictionary of layer to value; enclosures is a list of (inner layer,
+    outer layer, margin) rules. Set a rule to None to skip it.
+
+    Returns a list of (rule, layer, value, (x, y), cell name, count) violations. Checks
+    within a cell are reported once for the cell, with the position of its first
+    instance in the coordinates of cell and the number of instances.
+    """
+    if layers is None:
+        layers = {int(layer) for node, _ in layout_stats.instance_transforms(cell, lib)
+                  for polyset in node.polygons for layer in polyset.layers}
+        if enclosures:
+            layers |= {layer for inner, outer, _ in enclosures for layer in (inner, outer)}
+    cells = [(node, T, raster.cell_layers(node, layers)) for node, T in layout_stats.instance_transforms(cell, lib)]
+
+    violations = []
+    for node, T, own in cells:
+        if own:
+            for rule, layer, value, position in check_cell(node, width, spacing, min_angle, layers):
+                violations.append((rule, layer, value, _transform(position[np.newaxis], T[0])[0], node.name, len(T)))
+    for layer in sorted(layers):
+        s = _rule(spacing, layer)
+        if s is not None:
+            violations.extend((rule, layer, value, position, " / ".join(names), count)
+                              for rule, layer, value, position, names, count in check_interactions(cells, layer, s))
+    for inner, outer, margin in enclosures:
+        violations.extend(check_enclosure(cells, inner, outer, margin))
+    return violations
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check a GDS file against design rules.")
+    parser.add_argument("INPUT", type=str, help="GDS file")
+    parser.add_argument("-c", "--cell", type=str, default=None, help="Cell to check (default: the top cell)")
+    parser.add_argument("-l", "--layers", type=int, nargs="+", default=None, help="Layers to check (default: all)")
+    parser.add_argument("-w", "--width", type=float, default=MIN_WIDTH, help="Minimum width (um)")
+    parser.add_argument("-s", "--spacing", type=float, default=MIN_SPACING, help="Minimum spacing (um)")
+    parser.add_argument("-a", "--angle", type=float, default=MIN_ANGLE, help="Minimum inside angle (degrees)")
+    parser.add_argument("--rule", type=float, nargs=3, action="append", default=[],
+                        metavar=("LAYER", "WIDTH", "SPACING"), help="Width and spacing for one layer")
+    parser.add_argument("--enclosure", type=float, nargs=3, action="append", default=[],
+                        metavar=("INNER", "OUTER", "MARGIN"), help="Layer INNER must be inside OUTER by MARGIN (um)")
+    args = parser.parse_args()
+
+    lib = gdspy.GdsLibrary(infile=args.INPUT)
+    top = lib.cells[args.cell] if args.cell else lib.top_level()[0]
+    width, spacing = args.width, args.spacing
+    if args.rule:
+        layers = {int(layer) for node, _ in layout_stats.instance_transforms(top, lib)
+                  for polyset in node.polygons for layer in polyset.layers}
+        width, spacing = {layer: args.width for layer in layers}, {layer: args.spacing for layer in layers}
+        for layer, w, s in args.rule:
+            width[int(layer)], spacing[int(layer)] = w, s
+    enclosures = [(int(inner), int(outer), margin) for inner, outer, margin in args.enclosure]
+    start = time.perf_counter()
+    violations = check(top, lib, width, spacing, args.angle, enclosures, args.layers)
+    print(f"{len(violations)} violations in {time.perf_counter() - start:.2f} s.")
+    units = {"angle": " deg"}
+    for rule, layer, value, (x, y), name, count in sorted(violations, key=lambda v: (v[0], str(v[1]), v[4])):
+        layer = "/".join(str(l) for l in layer) if isinstance(layer, tuple) else layer
+        print(f"  {rule} on {layer}: {value:.4f}{units.get(rule, ' um')} in {name} at ({x:.3f}, {y:.3f})"
+              + (f" and {count - 1} more" if count > 1 else ""))
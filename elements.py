@@ -8,6 +8,7 @@ import gdspy
 from mathutils import Vector, Matrix
 
 import render_text
+import snap
 
 def round_vect(vector, precision=3):
     """
@@ -34,6 +35,37 @@ def make_polyline(points, layer=0, datatype=0):
     points = [poly.xy for poly in points]
     return gdspy.Polygon(points, layer, datatype)
 
+def merge_cell(lib, cell, precision=0.001):
+    """
+    Union the polygons of a cell on each layer and datatype, so that overlapping and
+    touching shapes are exposed (and fractured) once. References are left as they are.
+    The names of merged cells are remembered, so each cell is only merged once per library.
+    """
+    if getattr(merge_cell, "merged", None) is None or merge_cell.lib is not lib:
+        merge_cell.merged = set()
+        merge_cell.lib = lib
+
+    if cell.name in merge_cell.merged:
+        return cell
+
+    # Group polygons by layer and datatype
+    by_spec = {}
+    for polyset in cell.polygons:
+        for points, layer, datatype in zip(polyset.polygons, polyset.layers, polyset.datatypes):
+            by_spec.setdefault((layer, datatype), []).append(points)
+
+    merged = []
+    for (layer, datatype), polygons in by_spec.items():
+        union = gdspy.boolean(polygons, None, "or", precision=precision,
+                              layer=layer, datatype=datatype)
+        if union is not None:
+            merged.append(union)
+    cell.remove_polygons(lambda *_: True)
+    cell.add(merged)
+
+    merge_cell.merged.add(cell.name)
+    return cell
+
 def arrow(pos, height=150, arm_width=30, head_width=100, head_height=60, layer=0):
     """
     Create an arrow with the name given. The total height of the arrow is
@@ -107,7 +139,7 @@ def elionix_mark(lib, name="AM_elionix",
                  cross_dim=150, center_dim=15,
                  arm_width=10, center_arm_width=1,
                  orientation_square_dim=1.5,
-                 layer=1):
+                 layer=1, merge=False):
     """
     Create an elionix alignment marker (cross) block. Default dimensions are as given.
     The block is oriented such that the origin is at the bottom left of the cross.
@@ -120,6 +152,7 @@ def elionix_mark(lib, name="AM_elionix",
         arm_width: The width of the wide arms.
         center_arm_width: The width of the center arm segments.
         orientation_square_dim: The dimensions (square) of the little alignment squares.
+        merge: Union the overlapping arms, cross and orientation squares (see merge_cell).
     """
     elionix_block = lib.new_cell(name)
 
@@ -145,6 +178,8 @@ def elionix_mark(lib, name="AM_elionix",
     elionix_block.add(gdspy.Rectangle(bl_center.xy, tl.xy, layer=layer))
     elionix_block.add(gdspy.Rectangle(bl_center.xy, br.xy, layer=layer))
 
+    if merge:
+        merge_cell(lib, elionix_block)
     return elionix_block
 
 def elionix_4block(lib, em_mark, name="AM_elionix_4", block_size=400):
@@ -219,10 +254,12 @@ def die_marker(lib, name="die_marker", arm_thickness=100, arm_length=500, layer=
 
 def wire_section(lib, fid=None, sec_size=200, square_dim=5,
                  supp_dist=100, supp_width=1, supp_size=3, sn_size=10,
-                 layer=1):
+                 layer=1, merge=False):
     """
     Generate a block where nanowires can be placed.
     ID should be a single letter identifier for the block.
+    If merge is set, overlapping shapes in the block are unioned (see merge_cell).
+    The corner squares only touch at their corners, so they stay separate polygons.
     """
     N_RECT = 5
     if fid is None:
@@ -273,6 +310,9 @@ def wire_section(lib, fid=None, sec_size=200, square_dim=5,
     sn_pos = Vector((sec_size+5, 0, 0))
     wire_block.add(gdspy.CellReference(sn_block, sn_pos.xy, magnification=sn_size))
 
+    if merge:
+        merge_cell(lib, rects)
+        merge_cell(lib, wire_block)
     return wire_block
 
 def draw_wafer(lib, diameter=150_000, flat_size=57_500, layer=0):
@@ -304,5 +344,8 @@ if __name__ == "__main__":
     die_marker(doc, name="die_marker")
     wire_section(doc, "a")
     draw_wafer(doc)
+    # Snap to the beamer database grid before export
+    for name, layer, datatype, area in snap.snap_library(doc):
+        print(f"Warning: sliver in {name} on layer {layer}/{datatype} (area {area:.3g} um^2)")
     with open("test.gds", "wb") as f:
         doc.write_gds(f)
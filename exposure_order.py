@@ -0,0 +1,202 @@
+"""
+Choose the order in which shots are exposed, to shorten the beam's path between them.
+
+Shots are grouped by write field (see write_fields), and fields are visited in a
+serpentine so the stage only ever steps to a neighbour. Within a field, a nearest
+neighbour tour is built with a KD-tree, then improved with 2-opt moves between each
+shot and its nearest neighbours. The ordered shots are written out flat, in exposure
+order, to be imported with KEEPELEMENTORDER (see gen_layout.py --keep-order). The
+Beamer template imports DXF, so write the output as a .dxf file for that flow.
+"""
+
+import argparse
+
+import numpy as np
+import gdspy
+from dxfwrite import DXFEngine as dxf
+from scipy.spatial import cKDTree
+
+import fracture
+import write_fields
+
+def path_length(points, order=None):
+    """
+    Length of the path visiting points in the given order (default: as given).
+    """
+    p = points if order is None else points[order]
+    return np.linalg.norm(np.diff(p, axis=0), axis=1).sum()
+
+def nearest_neighbour(points, start=0, k=8):
+    """
+    Greedy tour of points, always moving to the closest shot not yet visited. Each step
+    asks the KD-tree for the k nearest points; once most of those have been visited,
+    the tree is rebuilt from the remaining points.
+    """
+    n = len(points)
+    visited = np.zeros(n, dtype=bool)
+    remaining = np.arange(n)
+    tree = cKDTree(points)
+    order = [start]
+    visited[start] = True
+    current = start
+    for _ in range(n - 1):
+        m = k
+        while True:
+            _, near = tree.query(points[current], k=min(m, len(remaining)))
+            near = remaining[np.atleast_1d(near)]
+            free = near[~visited[near]]
+            if len(free):
+                break
+            if m < 4*k and m < len(remaining):
+                m *= 2
+            else:
+                remaining = np.nonzero(~visited)[0]
+                tree = cKDTree(points[remaining])
+                m = k
+        current = free[0]
+        visited[current] = True
+        order.append(current)
+    return np.array(order)
+
+def two_opt(points, order, k=8, max_rounds=1000):
+    """
+    Improve an open path with 2-opt moves. A move joins shot i to shot j and shot i+1
+    to shot j+1, reversing the path between them. Only the k nearest neighbours of
+    each shot are tried as j, and each round applies every improving move that does
+    not overlap a better one. Returns the new order.
+    """
+    n = len(points)
+    order = np.array(order)
+    if n < 4:
+        return order
+    k = min(k, n - 1)
+    _, neighbours = cKDTree(points).query(points, k=k + 1)
+    neighbours = neighbours[:, 1:]
+    for _ in range(max_rounds):
+        position = np.empty(n, dtype=np.int64)
+        position[order] = np.arange(n)
+        p = points[order]
+        edge = np.append(np.linalg.norm(np.diff(p, axis=0), axis=1), 0)
+
+        i = np.repeat(np.arange(n - 1), k)
+        j = position[neighbours[order[:-1]]].ravel()
+        valid = j > i + 1
+        i, j = i[valid], j[valid]
+        after = np.minimum(j + 1, n - 1)
+        # Joining the end of the path on to i+1 adds no edge
+        added = (np.linalg.norm(p[i] - p[j], axis=1)
+                 + np.where(j < n - 1, np.linalg.norm(p[i + 1] - p[after], axis=1), 0))
+        gain = edge[i] + edge[j] - added
+        improving = np.nonzero(gain > 1e-9)[0]
+        if not len(improving):
+            break
+
+        taken = np.zeros(n + 1, dtype=bool)
+        for move in improving[np.argsort(-gain[improving], kind="stable")]:
+            a, b = i[move], j[move] + 1
+            if taken[a:b + 1].any():
+                continue
+            taken[a:b + 1] = True
+            order[a + 1:b] = order[a + 1:b][::-1]
+    return order
+
+def order_points(points, start=None, k=8):
+    """
+    Short path through points, starting from the point closest to start (default: the
+    first point). Returns the visiting order.
+    """
+    if not len(points):
+        return np.zeros(0, dtype=np.int64)
+    first = 0 if start is None else int(np.argmin(np.linalg.norm(points - start, axis=1)))
+    return two_opt(points, nearest_neighbour(points, first, k), k)
+
+def field_order(fields):
+    """
+    Serpentine order of (F, 2) field indices: along x, alternating direction on each row.
+    """
+    direction = np.where(fields[:, 1] % 2, -1, 1)
+    return np.lexsort((direction*fields[:, 0], fields[:, 1]))
+
+def order_shots(shots, field_size=write_fields.FIELD_SIZE, origin=(0, 0), k=8):
+    """
+    Exposure order for an (N, 4, 2) array of shots (e.g. from fracture.instance_shots).
+    Each shot belongs to the field containing its centre. Returns (order, fields): the
+    order of the shots, and the (N, 2) field index of each shot.
+    """
+    centres = shots.mean(axis=1)
+    field, _ = write_fields.field_index(np.stack((centres, centres), axis=1), field_size, origin)
+    ids, inverse = np.unique(field, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    order = []
+    position = None
+    for f in field_order(ids):
+        members = np.nonzero(inverse == f)[0]
+        members = members[order_points(centres[members], position, k)]
+        order.append(members)
+        position = centres[members[-1]]
+    order = np.concatenate(order) if order else np.zeros(0, dtype=np.int64)
+    return order, field
+
+def ordered_cell(name, shots, specs):
+    """
+    Make a flat gdspy cell with shots added in the given order, so they are written to
+    the file (and, with KEEPELEMENTORDER, exposed) in that order.
+    """
+    cell = gdspy.Cell(name, exclude_from_current=True)
+    # Consecutive shots on the same layer share a PolygonSet, which keeps their order
+    breaks = np.nonzero(np.any(np.diff(specs, axis=0) != 0, axis=1))[0] + 1
+    for run, spec in zip(np.split(np.arange(len(shots)), breaks), specs[np.concatenate(([0], breaks))]):
+        if len(run):
+            cell.add(gdspy.PolygonSet(fracture.shot_polygons(shots[run]), int(spec[0]), int(spec[1])))
+    return cell
+
+def write_dxf(filename, shots, specs):
+    """
+    Write shots to a DXF file in the given order, as closed polylines on layers named
+    after their GDS layer number (DXF has no datatypes, so those are dropped).
+    """
+    drawing = dxf.drawing(filename)
+    for layer in np.unique(specs[:, 0]):
+        if layer != 0:
+            drawing.layers.add(dxf.layer(name=str(layer)))
+    for polygon, spec in zip(fracture.shot_polygons(shots), specs):
+        polyline = dxf.polyline(polygon.tolist(), layer=str(spec[0]))
+        polyline.close()
+        drawing.add(polyline)
+    drawing.save()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Order the shots of a GDS file for exposure.")
+    parser.add_argument("INPUT", type=str, help="GDS file")
+    parser.add_argument("OUTPUT", type=str, help="GDS or DXF file (by extension) to write the ordered, flattened shots to")
+    parser.add_argument("-c", "--cell", type=str, default=None, help="Cell to order (default: the top cell)")
+    parser.add_argument("-l", "--layers", type=int, nargs="+", default=None, help="Layers to write (default: all)")
+    parser.add_argument("-f", "--field-size", type=float, default=write_fields.FIELD_SIZE, help="Write field size (um)")
+    parser.add_argument("--origin", type=float, nargs=2, default=(0, 0), help="Field grid origin (um)")
+    args = parser.parse_args()
+
+    lib = gdspy.GdsLibrary(infile=args.INPUT)
+    top = lib.cells[args.cell] if args.cell else lib.top_level()[0]
+    shots, specs = fracture.instance_shots(top, lib, args.layers)
+    # Beamer exposes one layer at a time, so order each layer separately
+    layer_order = np.lexsort((specs[:, 1], specs[:, 0]))
+    shots, specs = shots[layer_order], specs[layer_order]
+    order = []
+    for spec in np.unique(specs, axis=0):
+        members = np.nonzero(np.all(specs == spec, axis=1))[0]
+        ordered, fields = order_shots(shots[members], args.field_size, args.origin)
+        # Compare with the file order, field by field
+        ids, inverse = np.unique(fields, axis=0, return_inverse=True)
+        rank = np.argsort(field_order(ids))
+        unordered = members[np.argsort(rank[inverse.ravel()], kind="stable")]
+        members = members[ordered]
+        before, after = path_length(shots[unordered].mean(axis=1)), path_length(shots[members].mean(axis=1))
+        print(f"Layer {spec[0]}/{spec[1]}: {len(members)} shots, path {before/1000:.1f} mm -> {after/1000:.1f} mm")
+        order.append(members)
+    order = np.concatenate(order) if order else np.zeros(0, dtype=np.int64)
+    if args.OUTPUT.lower().endswith(".dxf"):
+        write_dxf(args.OUTPUT, shots[order], specs[order])
+    else:
+        out = gdspy.GdsLibrary(unit=lib.unit, precision=lib.precision)
+        out.add(ordered_cell(top.name, shots[order], specs[order]))
+        out.write_gds(args.OUTPUT)
@@ -0,0 +1,219 @@
+"""
+Fracture layouts into the rectangles and trapezoids that the e-beam writer exposes.
+
+Each polygon is cut into horizontal slabs at its vertices. Within a slab, the edges
+that cross it are paired up left to right (even-odd), and each pair bounds a
+trapezoid. Trapezoids in neighbouring slabs that lie between the same two edges are
+joined back together, so a rectangle stays a single shot and a rotated rectangle
+becomes three.
+
+Fracturing is done once for the polygons of each unique cell, and the shot counts
+are multiplied up through the hierarchy (see layout_stats), so the wafer costs the
+same as a single die. Nothing is kept between calls, so cells changed in place (see
+snap and elements.merge_cell) are fractured again.
+"""
+
+import argparse
+import copy
+
+import cv2
+import numpy as np
+import gdspy
+
+import layout_stats
+
+TOLERANCE = 1e-9 # um
+
+def fracture_polygon(points, tolerance=TOLERANCE):
+    """
+    Fracture a polygon into trapezoids with horizontal top and bottom edges (triangles
+    are trapezoids with a zero length top or bottom).
+
+    Returns a (T, 4, 2) array of the corners of each trapezoid, in the order bottom left,
+    bottom right, top right, top left.
+    """
+    points = np.asarray(points, dtype=float)
+    start, end = points, np.roll(points, -1, axis=0)
+    sloped = np.abs(end[:, 1] - start[:, 1]) > tolerance
+    upward = (start[:, 1] < end[:, 1])[:, np.newaxis]
+    lo = np.where(upward, start, end)[sloped]
+    hi = np.where(upward, end, start)[sloped]
+    if not len(lo):
+        return np.zeros((0, 4, 2))
+
+    ys = np.unique(np.round(points[:, 1]/tolerance)*tolerance)
+    y0, y1 = ys[:-1, np.newaxis], ys[1:, np.newaxis]
+    spans = (lo[:, 1] <= y0 + tolerance) & (hi[:, 1] >= y1 - tolerance) # (slabs, edges)
+    slope = (hi[:, 0] - lo[:, 0])/(hi[:, 1] - lo[:, 1])
+    x0 = lo[:, 0] + (y0 - lo[:, 1])*slope
+    x1 = lo[:, 0] + (y1 - lo[:, 1])*slope
+
+    # Walk up the slabs, extending the trapezoids whose edges carry on into the next one
+    trapezoids = [] # [y bottom, y top, x bottom left, x bottom right, x top left, x top right]
+    open_edges = {}
+    for s in range(len(ys) - 1):
+        edges = np.nonzero(spans[s])[0]
+        edges = edges[np.argsort(x0[s, edges] + x1[s, edges], kind="stable")]
+        continuing = {}
+        for left, right in edges[:len(edges)//2*2].reshape(-1, 2):
+            if (left, right) in open_edges:
+                trapezoid = open_edges[left, right]
+                trapezoid[1], trapezoid[4], trapezoid[5] = ys[s + 1], x1[s, left], x1[s, right]
+            else:
+                trapezoid = [ys[s], ys[s + 1], x0[s, left], x0[s, right], x1[s, left], x1[s, right]]
+                trapezoids.append(trapezoid)
+            continuing[left, right] = trapezoid
+        open_edges = continuing
+
+    t = np.array(trapezoids)
+    # Keyhole cuts (holes joined to the outline) leave zero width trapezoids behind
+    t = t[(t[:, 3] - t[:, 2] > tolerance) | (t[:, 5] - t[:, 4] > tolerance)]
+    return np.stack((np.stack((t[:, 2], t[:, 0]), axis=-1), np.stack((t[:, 3], t[:, 0]), axis=-1),
+                     np.stack((t[:, 5], t[:, 1]), axis=-1), np.stack((t[:, 4], t[:, 1]), axis=-1)), axis=1)
+
+def is_rectangle(trapezoids, tolerance=TOLERANCE):
+    """
+    Boolean mask of the trapezoids (as returned by fracture_polygon) with vertical sides.
+    """
+    return ((np.abs(trapezoids[:, 0, 0] - trapezoids[:, 3, 0]) <= tolerance)
+            & (np.abs(trapezoids[:, 1, 0] - trapezoids[:, 2, 0]) <= tolerance))
+
+def trapezoid_area(trapezoids):
+    """
+    Area of each trapezoid (also after it has been placed by a rotated or reflected
+    reference).
+    """
+    x, y = trapezoids[..., 0], trapezoids[..., 1]
+    return np.abs(np.sum(x*np.roll(y, -1, axis=-1) - np.roll(x, -1, axis=-1)*y, axis=-1))/2
+
+def fracture_cell(cell, tolerance=TOLERANCE, polygons=False):
+    """
+    Fracture the polygons directly in a cell (ignoring references).
+
+    Returns a dictionary of (layer, datatype) to a (T, 4, 2) array of trapezoids. If
+    polygons is set, each value is (trapezoids, index) instead, where index is the
+    polygon (counting the cell's polygons on that layer and datatype) that each
+    trapezoid came from.
+    """
+    by_spec = {}
+    for polyset in cell.polygons:
+        for points, layer, datatype in zip(polyset.polygons, polyset.layers, polyset.datatypes):
+            by_spec.setdefault((int(layer), int(datatype)), []).append(fracture_polygon(points, tolerance))
+    if not polygons:
+        return {spec: np.concatenate(parts) for spec, parts in by_spec.items()}
+    return {spec: (np.concatenate(parts), np.repeat(np.arange(len(parts)), [len(part) for part in parts]))
+            for spec, parts in by_spec.items()}
+
+def shot_counts(cell, lib=None):
+    """
+    Count the figures the writer will expose for a cell and everything it references.
+
+    Returns a dictionary of (layer, datatype) to a dictionary of rectangles, trapezoids
+    (including triangles), figures (their sum) and area (um^2).
+    """
+    totals = {}
+    for node, T in layout_stats.instance_transforms(cell, lib):
+        scale = np.abs(np.linalg.det(T[:, :2, :2])).sum()
+        for spec, trapezoids in fracture_cell(node).items():
+            rectangles = is_rectangle(trapezoids).sum()
+            totals[spec] = totals.get(spec, 0) + np.array((len(T)*rectangles, len(T)*(len(trapezoids) - rectangles),
+                                                           scale*trapezoid_area(trapezoids).sum()))
+    return {spec: {"rectangles": int(round(r)), "trapezoids": int(round(t)), "figures": int(round(r + t)), "area": float(a)}
+            for spec, (r, t, a) in sorted(totals.items())}
+
+def shot_polygons(trapezoids, tolerance=TOLERANCE):
+    """
+    Convert trapezoids to a list of polygons, dropping the repeated corner of triangles.
+    """
+    polygons = []
+    for trapezoid in trapezoids:
+        repeated = np.all(np.abs(trapezoid - np.roll(trapezoid, -1, axis=0)) <= tolerance, axis=1)
+        polygons.append(trapezoid[~repeated])
+    return polygons
+
+def fracture_library(lib, tolerance=TOLERANCE):
+    """
+    Make a copy of a library with every polygon replaced by its trapezoids, to hand
+    pre-fractured data to the writer. The hierarchy is kept, so each cell is only
+    fractured once. References rotated by other than a multiple of 90 degrees will
+    not give trapezoids with horizontal edges, and will be fractured again by the writer.
+    """
+    fractured = gdspy.GdsLibrary(name=lib.name, unit=lib.unit, precision=lib.precision)
+    copies = {}
+    for name, cell in lib.cells.items():
+        new = gdspy.Cell(name, exclude_from_current=True)
+        for (layer, datatype), trapezoids in fracture_cell(cell, tolerance).items():
+            if len(trapezoids):
+                new.add(gdspy.PolygonSet(shot_polygons(trapezoids, tolerance), layer, datatype))
+        new.add([copy.copy(label) for label in cell.labels])
+        copies[name] = new
+    for name, cell in lib.cells.items():
+        for ref in cell.references:
+            new_ref = copy.copy(ref)
+            new_ref.ref_cell = copies[ref.ref_cell if isinstance(ref.ref_cell, str) else ref.ref_cell.name]
+            copies[name].add(new_ref)
+    fractured.add(list(copies.values()))
+    return fractured
+
+def instance_shots(cell, lib=None, layers=None, polygons=False):
+    """
+    Place the fractured shots of every cell instance under cell, on the given layers
+    (default: all). Returns (shots, specs): an (N, 4, 2) array of trapezoid corners in
+    the coordinates of cell, and an (N, 2) array of their (layer, datatype). If
+    polygons is set, also returns the polygon instance each shot came from, numbered
+    from 0 across the whole layout.
+    """
+    shots, specs, index = [], [], []
+    n_polygons = 0
+    for node, T in layout_stats.instance_transforms(cell, lib):
+        for spec, (trapezoids, polygon) in fracture_cell(node, polygons=True).items():
+            if layers is None or spec[0] in layers:
+                shots.append((trapezoids[np.newaxis]@T[:, np.newaxis, :2, :2].swapaxes(-1, -2)
+                              + T[:, np.newaxis, np.newaxis, :2, 2]).reshape(-1, 4, 2))
+                specs.append(np.tile(spec, (len(T)*len(trapezoids), 1)))
+                count = polygon.max() + 1 if len(polygon) else 0
+                index.append((n_polygons + np.arange(len(T))[:, np.newaxis]*count + polygon).ravel())
+                n_polygons += len(T)*count
+    if not shots:
+        shots, specs, index = np.zeros((0, 4, 2)), np.zeros((0, 2), dtype=int), np.zeros(0, dtype=np.int64)
+    else:
+        shots, specs, index = np.concatenate(shots), np.concatenate(specs), np.concatenate(index)
+    return (shots, specs, index) if polygons else (shots, specs)
+
+def preview(cell, lib=None, layers=None, pixel_size=1.0):
+    """
+    Draw the shots of a cell as an image, each trapezoid filled and outlined, to see
+    how a layout will be exposed. Returns (image, origin), where origin is the layout
+    coordinate of the bottom left corner of the image.
+    """
+    shots, _ = instance_shots(cell, lib, layers)
+    if not len(shots):
+        return np.zeros((1, 1), dtype=np.uint8), np.zeros(2)
+    origin = shots.reshape(-1, 2).min(axis=0)
+    size = np.ceil((shots.reshape(-1, 2).max(axis=0) - origin)/pixel_size).astype(int) + 1
+    # Flip y, so the image is the right way up
+    pixels = np.round((shots - origin)/pixel_size*np.array((1, -1)) + np.array((0, size[1] - 1))).astype(np.int32)
+    image = np.zeros((size[1], size[0]), dtype=np.uint8)
+    cv2.fillPoly(image, list(pixels), 128)
+    cv2.polylines(image, list(pixels), True, 255)
+    return image, origin
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fracture a GDS file into rectangles and trapezoids.")
+    parser.add_argument("INPUT", type=str, help="GDS file")
+    parser.add_argument("-c", "--cell", type=str, default=None, help="Cell to fracture (default: the top cell)")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Write the fractured library to this GDS file")
+    parser.add_argument("--preview", type=str, default=None, help="Save an image of the shots to this file")
+    parser.add_argument("--pixel-size", type=float, default=1.0, help="Preview pixel size (um)")
+    parser.add_argument("-l", "--layers", type=int, nargs="+", default=None, help="Layers to preview (default: all)")
+    args = parser.parse_args()
+
+    lib = gdspy.GdsLibrary(infile=args.INPUT)
+    top = lib.cells[args.cell] if args.cell else lib.top_level()[0]
+    print(f"{'layer':>5} {'datatype':>8} {'rectangles':>12} {'trapezoids':>12} {'area (um^2)':>16}")
+    for (layer, datatype), counts in shot_counts(top, lib).items():
+        print(f"{layer:>5} {datatype:>8} {counts['rectangles']:>12} {counts['trapezoids']:>12} {counts['area']:>16.6g}")
+    if args.output:
+        fracture_library(lib).write_gds(args.output)
+    if args.preview:
+        cv2.imwrite(args.preview, preview(top, lib, args.layers, args.pixel_size)[0])
@@ -21,10 +21,16 @@ if __name__ == "__main__":
     parser.add_argument("-s", "--size", type=float, default=3.9, help="Size of the wafer in inches")
     parser.add_argument("-t", "--template", type=str, default="Layout_Template.ftxt.templ", 
                         help="Template to use to generate beamer output")
+    parser.add_argument("--keep-order", action="store_true",
+                        help="Import elements in file order (e.g. a .dxf written by exposure_order.py). "
+                             "The template's Heal node can still reorder figures, see the README")
     parser.add_argument("ID", type=str, help="ID string for the wafer")
     parser.add_argument("INPUT", type=str, help="Name of the input dxf file")
     parser.add_argument("OUTPUT", type=str, help="Output beamer file name")
     args = parser.parse_args()
+    if args.keep_order and not args.INPUT.lower().endswith(".dxf"):
+        parser.error("--keep-order needs a .dxf input, as the template imports DXF "
+                     "(write one with exposure_order.py INPUT OUTPUT.dxf)")
 
     # Read in the template beamer file
     with open(args.template, "r") as f:
@@ -40,6 +46,7 @@ if __name__ == "__main__":
     with open(args.OUTPUT, "w") as f:
         ids = "\n".join(output)
         f.write(templ.format(X=args.x, Y=args.y, dxf=args.INPUT,
-                             substr_size=args.size, ids=ids))
+                             substr_size=args.size, ids=ids,
+                             keep_order="true" if args.keep_order else "false"))
 
     print("Written output beamer file to {}.".format(args.OUTPUT))
@@ -0,0 +1,214 @@
+"""
+Count polygons, vertices and exposed area in a layout, per (layer, datatype), without
+flattening it.
+
+Statistics are calculated once for the polygons of each cell, and then multiplied up
+through the reference hierarchy by the number of times each cell is instanced.
+Area is the sum of polygon areas, so overlapping polygons are counted as many times
+as they would be exposed.
+"""
+
+import argparse
+
+import numpy as np
+import gdspy
+
+def _packed_stats(by_spec):
+    """
+    Statistics for a dictionary of (layer, datatype) to a list of (N, 2) vertex arrays,
+    as a dictionary of (layer, datatype) to an array of (polygons, vertices, area).
+    """
+    stats = {}
+    for spec, polygons in by_spec.items():
+        if not len(polygons):
+            continue
+        lengths = np.array([len(p) for p in polygons])
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        vertices = np.concatenate(polygons)
+        nxt = np.roll(vertices, -1, axis=0)
+        nxt[starts + lengths - 1] = vertices[starts]
+        cross = vertices[:, 0]*nxt[:, 1] - nxt[:, 0]*vertices[:, 1]
+        area = np.abs(np.add.reduceat(cross, starts)).sum()/2
+        stats[spec] = np.array((len(polygons), len(vertices), area))
+    return stats
+
+def cell_stats(cell):
+    """
+    Statistics for the polygons directly in a cell (ignoring references), as a dictionary
+    of (layer, datatype) to an array of (polygons, vertices, area).
+    """
+    by_spec = {}
+    for polyset in cell.polygons:
+        for points, layer, datatype in zip(polyset.polygons, polyset.layers, polyset.datatypes):
+            by_spec.setdefault((int(layer), int(datatype)), []).append(points)
+    return _packed_stats(by_spec)
+
+def _as_dict(totals):
+    return {spec: {"polygons": int(round(values[0])), "vertices": int(round(values[1])), "area": float(values[2])}
+            for spec, values in sorted(totals.items())}
+
+def polygon_stats(by_spec):
+    """
+    Statistics for plain polygons (e.g. from the NW170926 device helpers), given as a
+    dictionary of (layer, datatype) to a list of (N, 2) vertex arrays. Returns the same
+    format as layout_stats.
+    """
+    return _as_dict(_packed_stats(by_spec))
+
+def _children(cell, lib=None):
+    """
+    Yield (child cell, number of instances, area scale) for each reference in a cell.
+    """
+    for ref in cell.references:
+        child = ref.ref_cell
+        if isinstance(child, str):
+            if lib is None:
+                raise ValueError(f"Reference to {child} by name needs a library to look it up in.")
+            child = lib.cells[child]
+        count = ref.columns*ref.rows if isinstance(ref, gdspy.CellArray) else 1
+        magnification = 1 if ref.magnification is None else ref.magnification
+        yield child, count, magnification**2
+
+def layout_stats(cell, lib=None):
+    """
+    Calculate the statistics for a cell and everything it references.
+
+    Each unique cell is visited once. The number of times each cell appears in the
+    layout (its multiplicity) is propagated down the hierarchy in topological order,
+    so a wafer of identical dies costs the same as a single die.
+
+    Returns a dictionary of (layer, datatype) to a dictionary of polygons, vertices and area (um^2).
+    """
+    # Find every cell, and sort them so that parents come before their children
+    order = []
+    visited = set()
+    def visit(node):
+        visited.add(id(node))
+        for child, _, _ in _children(node, lib):
+            if id(child) not in visited:
+                visit(child)
+        order.append(node)
+    visit(cell)
+    order.reverse()
+
+    # Propagate instance counts down the hierarchy, along with the sum of the area scale
+    # of each instance (from magnified references)
+    instances = {id(cell): np.array((1.0, 1.0))}
+    for node in order:
+        count, area_weight = instances[id(node)]
+        for child, n, scale in _children(node, lib):
+            instances.setdefault(id(child), np.zeros(2))
+            instances[id(child)] += (count*n, area_weight*n*scale)
+
+    totals = {}
+    for node in order:
+        count, area_weight = instances[id(node)]
+        for spec, (polygons, vertices, area) in cell_stats(node).items():
+            totals[spec] = totals.get(spec, 0) + np.array((count*polygons, count*vertices, area_weight*area))
+    return _as_dict(totals)
+
+def reference_transforms(ref):
+    """
+    The (n, 3, 3) homogeneous transforms from the coordinates of a referenced cell into
+    the coordinates of the parent, one for each instance (n > 1 for a CellArray).
+    Follows gdspy: magnify, offset by the array spacing, reflect, rotate, then translate.
+    """
+    mag = 1 if ref.magnification is None else ref.magnification
+    if isinstance(ref, gdspy.CellArray):
+        i, j = np.meshgrid(np.arange(ref.columns), np.arange(ref.rows), indexing="ij")
+        spacing = np.stack((i.ravel()*ref.spacing[0], j.ravel()*ref.spacing[1]), axis=-1)
+    else:
+        spacing = np.zeros((1, 2))
+    theta = np.radians(ref.rotation or 0)
+    c, s = np.cos(theta), np.sin(theta)
+    linear = np.array(((c, -s), (s, c)))
+    if ref.x_reflection:
+        linear = linear@np.diag((1, -1))
+    T = np.tile(np.eye(3), (len(spacing), 1, 1))
+    T[:, :2, :2] = linear*mag
+    T[:, :2, 2] = spacing@linear.T + (0 if ref.origin is None else ref.origin)
+    return T
+
+def instance_transforms(cell, lib=None):
+    """
+    Find the transform of every instance of every cell under cell, without flattening
+    any polygons. Returns a list of (cell, (K, 3, 3) transforms into the coordinates of
+    the top cell), with parents before their children.
+    """
+    order = []
+    visited = set()
+    def visit(node):
+        visited.add(id(node))
+        for child, _, _ in _children(node, lib):
+            if id(child) not in visited:
+                visit(child)
+        order.append(node)
+    visit(cell)
+    order.reverse()
+
+    transforms = {id(cell): [np.eye(3)[np.newaxis]]}
+    result = []
+    for node in order:
+        T = np.concatenate(transforms.pop(id(node)))
+        result.append((node, T))
+        for ref in node.references:
+            child = ref.ref_cell if not isinstance(ref.ref_cell, str) else lib.cells[ref.ref_cell]
+            transforms.setdefault(id(child), []).append((T[:, np.newaxis]@reference_transforms(ref)).reshape(-1, 3, 3))
+    return result
+
+def instance_boxes(cell, layers=None, lib=None):
+    """
+    Find the bounding box of every polygon instance under cell on the given layers
+    (default: all), in the coordinates of cell. Only the bounding box corners are
+    transformed, so no polygons are flattened.
+
+    Returns (boxes, names, specs): an (N, 2, 2) array of ((xmin, ymin), (xmax, ymax)),
+    the name of the cell each polygon is defined in, and an (N, 2) array of its
+    (layer, datatype).
+    """
+    boxes, names, specs = [], [], []
+    for node, T in instance_transforms(cell, lib):
+        own, own_specs = [], []
+        for polyset in node.polygons:
+            for points, layer, datatype in zip(polyset.polygons, polyset.layers, polyset.datatypes):
+                if layers is None or layer in layers:
+                    own.append((points.min(axis=0), points.max(axis=0)))
+                    own_specs.append((layer, datatype))
+        if not own:
+            continue
+        own = np.array(own)
+        corners = np.stack((own[:, (0, 1, 0, 1), 0], own[:, (0, 0, 1, 1), 1]), axis=-1) # (P, 4, 2)
+        placed = corners@T[:, np.newaxis, :2, :2].swapaxes(-1, -2) + T[:, np.newaxis, np.newaxis, :2, 2]
+        boxes.append(np.stack((placed.min(axis=2), placed.max(axis=2)), axis=2).reshape(-1, 2, 2))
+        names.extend([node.name]*(len(T)*len(own)))
+        specs.append(np.tile(np.array(own_specs), (len(T), 1)))
+    if not boxes:
+        return np.zeros((0, 2, 2)), [], np.zeros((0, 2), dtype=int)
+    return np.concatenate(boxes), names, np.concatenate(specs)
+
+def cell_breakdown(cell, lib=None):
+    """
+    Statistics for each unique cell under cell (own polygons only), to find where
+    vertices come from. Returns a dictionary of cell name to cell_stats.
+    """
+    breakdown = {}
+    stack = [cell]
+    while stack:
+        node = stack.pop()
+        if node.name in breakdown:
+            continue
+        breakdown[node.name] = cell_stats(node)
+        stack.extend(child for child, _, _ in _children(node, lib))
+    return breakdown
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print polygon, vertex and area counts for a GDS file.")
+    parser.add_argument("INPUT", type=str, help="GDS file")
+    parser.add_argument("-c", "--cell", type=str, default=None, help="Cell to analyse (default: the top cell)")
+    args = parser.parse_args()
+
+    lib = gdspy.GdsLibrary(infile=args.INPUT)
+    top = lib.cells[args.cell] if args.cell else lib.top_level()[0]
+    print(f"{'layer':>5} {'datatype':>8} {'polygons':>12} {'vertices':>12} {'area (um^2)':>16}")
+    for (layer, datatype), stats in layout_stats(top, lib).items():
+        print(f"{layer:>5} {datatype:>8} {stats['polygons']:>12} {stats['vertices']:>12} {stats['area']:>16.6g}")
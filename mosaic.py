@@ -0,0 +1,217 @@
+"""
+Stitch overlapping SEM frames of a die into a single mosaic in die coordinates,
+using the supplementary crosses in each wire section as registration points.
+
+Each frame needs an approximate initial transform from image pixels to die
+coordinates (for example from the stage position). Crosses detected in each frame
+are matched to the nominal cross positions from the layout, and a single global
+least squares problem is solved for an affine transform per frame, which ties
+frames together wherever they share a cross.
+"""
+
+import itertools
+
+import cv2
+import numpy as np
+
+import nanowire_chip
+import transforms
+
+def field_cross_positions(sec_size=300, supp_dist=100):
+    """
+    Nominal positions of the supplementary crosses in a wire section, relative to
+    its bottom left corner. Matches the layout in elements.wire_section.
+    """
+    n_supp = sec_size//supp_dist
+    skip = ((0, 0), (n_supp, 0), (0, n_supp), (n_supp, n_supp))
+    return np.array([(supp_dist*i, supp_dist*j) for i, j in itertools.product(range(n_supp+1), repeat=2)
+                     if (i, j) not in skip], dtype=np.float64)
+
+def die_cross_positions(die_size=7_500, sec_size=300, supp_dist=100):
+    """
+    Nominal positions of every supplementary cross in the die (all four fields a/b/c/d).
+    """
+    crosses = field_cross_positions(sec_size, supp_dist)
+    positions = nanowire_chip.wire_section_positions(die_size, sec_size)
+    return np.concatenate([crosses + pos for pos in positions.values()])
+
+def stage_transform(center, um_per_px, img_shape, rotation=0):
+    """
+    Initial transform from image pixels (y down) to die coordinates (y up) for a frame
+    centered at center (um), with the given pixel size and rotation (degrees).
+    """
+    h, w = img_shape[:2]
+    c, s = np.cos(np.radians(rotation)), np.sin(np.radians(rotation))
+    T = np.array(((c*um_per_px, s*um_per_px, 0), (s*um_per_px, -c*um_per_px, 0), (0, 0, 1)))
+    T[:2, 2] = center - transforms.apply_transform(T, ((w/2, h/2),))[0]
+    return T
+
+def detect_crosses(img, size_px, min_fill=0.3, max_fill=0.75):
+    """
+    Detect supplementary crosses in an image, given their approximate size in pixels.
+
+    Crosses are bright blobs whose bounding box is roughly square and of the given
+    size, and which only partially fill their bounding box. Returns an (N, 2) array of
+    cross centroids in image pixels.
+    """
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    blur = cv2.GaussianBlur(img, (3, 3), 0)
+    _, binary = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    _, _, stats, centroids = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    w, h = stats[:, cv2.CC_STAT_WIDTH], stats[:, cv2.CC_STAT_HEIGHT]
+    fill = stats[:, cv2.CC_STAT_AREA]/(w*h)
+    keep = ((np.abs(w - size_px) < size_px/2) & (np.abs(h - size_px) < size_px/2) &
+            (fill > min_fill) & (fill < max_fill))
+    keep[0] = False # Background
+    return centroids[keep]
+
+def match_crosses(crosses, T, nominal, radius):
+    """
+    Match detected crosses (image pixels) to the nominal cross positions using the
+    transform T. Returns (pixel, index) pairs for each cross within radius um of a
+    nominal position.
+    """
+    if len(crosses) == 0:
+        return crosses, np.zeros(0, dtype=int)
+    die_pos = transforms.apply_transform(T, crosses)
+    dist = np.linalg.norm(die_pos[:, np.newaxis] - nominal[np.newaxis], axis=-1)
+    index = np.argmin(dist, axis=1)
+    ok = dist[np.arange(len(crosses)), index] < radius
+    return crosses[ok], index[ok]
+
+def register(frames, initial, nominal=None, supp_size=3, radius=30, shared_weight=1.0):
+    """
+    Register a set of overlapping frames of a die in a single least squares solve.
+
+    frames is a list of images, and initial a list of approximate (3, 3) transforms
+    from image pixels to die coordinates. nominal gives the expected cross positions
+    (default: die_cross_positions()).
+
+    Each frame gets an affine transform. Each matched cross contributes an equation
+    tying it to its nominal position, and each cross seen in two frames contributes an
+    equation (weighted by shared_weight) tying the two frames together.
+
+    Returns (transforms, residuals) where transforms is an (F, 3, 3) array and residuals
+    is a list of the per-cross distance from the nominal position in each frame (um).
+    """
+    if nominal is None:
+        nominal = die_cross_positions()
+    n_frames = len(frames)
+    matches = []
+    for img, T in zip(frames, initial):
+        um_per_px = np.sqrt(abs(np.linalg.det(T[:2, :2])))
+        crosses = detect_crosses(img, supp_size/um_per_px)
+        pixels, index = match_crosses(crosses, T, nominal, radius)
+        if len(pixels) < 3:
+            raise ValueError(f"Only found {len(pixels)} crosses in a frame, need at least 3.")
+        matches.append((pixels, index))
+
+    def rows(frame, pixels):
+        # Rows of the design matrix mapping the frame parameters to die x and y
+        A = np.zeros((len(pixels), 2, 6*n_frames))
+        A[:, 0, 6*frame:6*frame+2] = pixels
+        A[:, 0, 6*frame+2] = 1
+        A[:, 1, 6*frame+3:6*frame+5] = pixels
+        A[:, 1, 6*frame+5] = 1
+        return A.reshape(-1, 6*n_frames)
+
+    A, b = [], []
+    for frame, (pixels, index) in enumerate(matches):
+        A.append(rows(frame, pixels))
+        b.append(nominal[index].reshape(-1))
+    for (i, (pi, ii)), (j, (pj, ij)) in itertools.combinations(enumerate(matches), 2):
+        shared, si, sj = np.intersect1d(ii, ij, return_indices=True)
+        if len(shared):
+            A.append(shared_weight*(rows(i, pi[si]) - rows(j, pj[sj])))
+            b.append(np.zeros(2*len(shared)))
+    params = np.linalg.lstsq(np.concatenate(A), np.concatenate(b), rcond=None)[0]
+
+    result = np.tile(np.eye(3), (n_frames, 1, 1))
+    result[:, :2] = params.reshape(n_frames, 2, 3)
+    residuals = [transforms.residuals(T, pixels, nominal[index])
+                 for T, (pixels, index) in zip(result, matches)]
+    return result, residuals
+
+class Mosaic:
+    """
+    A lazily rendered mosaic of registered frames in die coordinates.
+
+    Tiles are only rendered (and then cached) when requested, from the frames that
+    overlap them. Where frames overlap, their intensities are averaged.
+    """
+    def __init__(self, frames, frame_transforms, um_per_px=None, tile_size=1024):
+        self.frames = frames
+        self.transforms = np.asarray(frame_transforms)
+        if um_per_px is None:
+            um_per_px = np.sqrt(np.abs(np.linalg.det(self.transforms[:, :2, :2]))).min()
+        self.um_per_px = um_per_px
+        self.tile_size = tile_size
+        self._tiles = {}
+
+        # Bounding box of each frame in die coordinates
+        bounds = []
+        for img, T in zip(frames, self.transforms):
+            h, w = img.shape[:2]
+            corners = transforms.apply_transform(T, ((0, 0), (w, 0), (0, h), (w, h)))
+            bounds.append((corners.min(axis=0), corners.max(axis=0)))
+        self.frame_bounds = np.array(bounds)
+        self.origin = np.array((self.frame_bounds[:, 0, 0].min(), self.frame_bounds[:, 1, 1].max()))
+        extent = self.frame_bounds[:, 1].max(axis=0) - self.frame_bounds[:, 0].min(axis=0)
+        self.shape = tuple(np.ceil(extent[::-1]/um_per_px).astype(int))
+        # (columns, rows) of tiles, to match tile (tx, ty)
+        self.n_tiles = tuple(-(-n//tile_size) for n in self.shape[::-1])
+
+    def tile_transform(self, tx, ty):
+        """
+        Transform from die coordinates to pixels in tile (tx, ty).
+        """
+        s = self.um_per_px
+        x0 = self.origin[0] + tx*self.tile_size*s
+        y1 = self.origin[1] - ty*self.tile_size*s
+        return np.array(((1/s, 0, -x0/s), (0, -1/s, y1/s), (0, 0, 1)))
+
+    def tile(self, tx, ty):
+        """
+        Render tile (tx, ty), where tile (0, 0) is at the top left of the mosaic.
+        """
+        if (tx, ty) in self._tiles:
+            return self._tiles[(tx, ty)]
+
+        size = self.tile_size*self.um_per_px
+        lo = np.array((self.origin[0] + tx*size, self.origin[1] - (ty+1)*size))
+        hi = lo + size
+        overlap = np.all((self.frame_bounds[:, 0] < hi) & (self.frame_bounds[:, 1] > lo), axis=1)
+
+        D = self.tile_transform(tx, ty)
+        total = np.zeros((self.tile_size, self.tile_size), dtype=np.float32)
+        weight = np.zeros_like(total)
+        for i in np.nonzero(overlap)[0]:
+            img = self.frames[i]
+            if img.ndim == 3:
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            M = (D@self.transforms[i])[:2]
+            dsize = (self.tile_size, self.tile_size)
+            total += cv2.warpAffine(img.astype(np.float32), M, dsize)
+            weight += cv2.warpAffine(np.ones(img.shape[:2], np.float32), M, dsize)
+        tile = np.where(weight > 0, total/np.maximum(weight, 1e-6), 0).astype(np.uint8)
+        self._tiles[(tx, ty)] = tile
+        return tile
+
+    def render(self):
+        """
+        Render the whole mosaic into a single image.
+        """
+        ts = self.tile_size
+        out = np.zeros((self.n_tiles[1]*ts, self.n_tiles[0]*ts), dtype=np.uint8)
+        for tx, ty in itertools.product(range(self.n_tiles[0]), range(self.n_tiles[1])):
+            out[ty*ts:(ty+1)*ts, tx*ts:(tx+1)*ts] = self.tile(tx, ty)
+        return out[:self.shape[0], :self.shape[1]]
+
+def stitch_die(frames, initial, um_per_px=None, tile_size=1024, **kwargs):
+    """
+    Register frames of a die (see register) and build a lazily tiled mosaic of them.
+    Returns (mosaic, residuals).
+    """
+    frame_transforms, residuals = register(frames, initial, **kwargs)
+    return Mosaic(frames, frame_transforms, um_per_px, tile_size), residuals
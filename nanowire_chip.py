@@ -9,10 +9,48 @@ from mathutils import Vector
 
 import elements
 import render_text
+import snap
 
-def die(lib, die_size, chip_size, die_mark_offset=100, alignment_layer=1):
+def wire_section_positions(die_size, sec_size=300, spacing=100):
     """
-    Draw a complete die
+    Calculate the position of the bottom left corner of each wire section (a, b, c, d)
+    in a die. The sections are arranged in a square around the center of the die,
+    separated by spacing.
+    """
+    center = Vector((die_size/2, die_size/2, 0))
+    sections = ("a", "c", "d", "b")
+    offs = Vector((sec_size, 0, 0)) - Vector((-spacing, spacing, 0))
+    offs_rot = elements.gen_rotate_matrix(origin=Vector((sec_size/2, sec_size/2, 0)))
+    positions = {}
+    for sec in sections:
+        positions[sec] = (center-offs).xy[:]
+        offs = offs_rot@offs
+    return positions
+
+def die_positions(wafer_size, die_size):
+    """
+    Find the bottom left corner of each die that fits entirely on a round wafer, on a
+    grid of die_size from the bottom left of the wafer. Dies are ordered row by row,
+    starting from the bottom.
+    """
+    wafer_center = Vector((wafer_size/2, wafer_size/2, 0))
+    positions = []
+    for y, x in itertools.product(range(0, wafer_size, die_size), repeat=2):
+        loc = Vector((x, y, 0))
+        # Check that the location is contained in the wafer
+        contained = True
+        for i, j in itertools.product(range(2), repeat=2):
+            vect = loc + Vector((i*die_size, j*die_size, 0)) - wafer_center
+            if vect.magnitude > wafer_size/2:
+                contained = False
+        if contained:
+            positions.append((x, y))
+    return positions
+
+def die(lib, die_size, chip_size, die_mark_offset=100, alignment_layer=1, merge=False):
+    """
+    Draw a complete die. If merge is set, overlapping shapes in the alignment marks
+    and wire sections are unioned (see elements.merge_cell).
     """
     die_block = lib.new_cell("die")
 
@@ -44,7 +82,7 @@ def die(lib, die_size, chip_size, die_mark_offset=100, alignment_layer=1):
         chip_insert_loc = center_rot@chip_insert_loc
 
     # Add the alignment marks
-    em_mark = elements.elionix_mark(lib, layer=alignment_layer)
+    em_mark = elements.elionix_mark(lib, layer=alignment_layer, merge=merge)
     em_4block = elements.elionix_4block(lib, em_mark)
     insert_loc = chip_corner + Vector((100, 100, 0))
     for i in range(4):
@@ -58,14 +96,9 @@ def die(lib, die_size, chip_size, die_mark_offset=100, alignment_layer=1):
     die_block.add(orient)
 
     # Generate wire locations
-    sections = ("a", "c", "d", "b")
-    offs = Vector((300, 0, 0)) - Vector((-100, 100, 0))
-    offs_rot = elements.gen_rotate_matrix(origin=Vector((300/2, 300/2, 0)))
-    for i, sec in enumerate(sections):
-        print(offs)
-        wire_sec = elements.wire_section(lib, sec, sec_size=300, sn_size=20)
-        die_block.add(gdspy.CellReference(wire_sec, (center-offs).xy))
-        offs = offs_rot@offs
+    for sec, pos in wire_section_positions(die_size).items():
+        wire_sec = elements.wire_section(lib, sec, sec_size=300, sn_size=20, merge=merge)
+        die_block.add(gdspy.CellReference(wire_sec, pos))
 
     # Calculate SN location
     sn_loc = chip_corner + Vector((chip_size/2, 100, 0))
@@ -89,35 +122,19 @@ if __name__ == "__main__":
 
     # Insert dies
     die_block, sn_loc = die(doc, DIE_SIZE, CHIP_SIZE)
-    die_vect = Vector((DIE_SIZE, DIE_SIZE, 0))
-    wafer_center = Vector((WAFER_SIZE/2, WAFER_SIZE/2, 0))
-    x, y = 0, 0
-    did = 1
-    while y < WAFER_SIZE:
-        x = 0
-        while x < WAFER_SIZE:
-            loc = Vector((x, y, 0))
-            # Check that the location is contained in the wafer
-            contained = True
-            for i, j in itertools.product(range(2), repeat=2):
-                vect = loc + Vector((i*DIE_SIZE, j*DIE_SIZE, 0)) - wafer_center
-                if vect.magnitude > WAFER_SIZE/2:
-                    contained = False
-            if not contained:
-                x += DIE_SIZE
-                continue
-            # Add the chip
-            top_level.add(gdspy.CellReference(die_block, loc.xy))
-
-            # Generate SN
-            sn = SN_FORMAT.format(did)
-            sn_block, text_size = render_text.render_to_block(doc, sn, f"sn_{sn}",
-                                                              height=150, layer=1)
-            top_level.add(gdspy.CellReference(sn_block, (loc + sn_loc - text_size/2).xy))
-            did += 1
-
-            x += DIE_SIZE
-        y += DIE_SIZE
-
+    for did, (x, y) in enumerate(die_positions(WAFER_SIZE, DIE_SIZE), start=1):
+        loc = Vector((x, y, 0))
+        # Add the chip
+        top_level.add(gdspy.CellReference(die_block, loc.xy))
+
+        # Generate SN
+        sn = SN_FORMAT.format(did)
+        sn_block, text_size = render_text.render_to_block(doc, sn, f"sn_{sn}",
+                                                          height=150, layer=1)
+        top_level.add(gdspy.CellReference(sn_block, (loc + sn_loc - text_size/2).xy))
+
+    # Snap to the beamer database grid before export
+    for name, layer, datatype, area in snap.snap_library(doc):
+        print(f"Warning: sliver in {name} on layer {layer}/{datatype} (area {area:.3g} um^2)")
     with open(FILENAME, "wb") as f:
         doc.write_gds(f)
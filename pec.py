@@ -0,0 +1,211 @@
+"""
+Proximity effect correction: assign a dose to every fractured shot so that dense
+areas (alignment mark arms, bondpads) and isolated features (plunger tips) receive
+the same absorbed energy.
+
+The point spread function is a double Gaussian,
+
+    f(r) = 1/(pi (1 + eta)) (exp(-r^2/alpha^2)/alpha^2 + eta exp(-r^2/beta^2)/beta^2),
+
+normalised so that a large uniformly exposed area absorbs the dose it was given.
+The backscattered part is wide, so it is found by rasterizing the dose of each write
+field (with a halo of 3 beta around it) on a coarse grid and convolving with an FFT.
+The forward scattered part is narrower than any pixel, so it is found analytically
+for the whole polygon each shot came from, as curved and tapered polygons are
+fractured into strips much thinner than alpha. The energy of each shot is taken at
+its centre. Doses are then updated per shot until the energy at every shot matches
+the target, and rounded into dose classes that are written out as GDS datatypes.
+"""
+
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+import gdspy
+from scipy import ndimage, signal, special
+
+import exposure_order
+import fracture
+import raster
+import spatial_index
+import write_fields
+
+# PSF defaults for 100 kV on Si. These should be replaced by a fit to test exposures.
+ALPHA = 0.05 # um
+BETA = 30.0 # um
+ETA = 0.7
+
+def backscatter_kernel(pixel_size, beta=BETA, eta=ETA):
+    """
+    The backscattered part of the PSF on a grid of the given pixel size, out to 3 beta,
+    with sum eta/(1 + eta).
+    """
+    radius = int(np.ceil(3*beta/pixel_size))
+    x = np.arange(-radius, radius + 1)*pixel_size
+    kernel = np.exp(-(x[:, np.newaxis]**2 + x[np.newaxis, :]**2)/beta**2)
+    return kernel*(eta/(1 + eta))/kernel.sum()
+
+def forward_fraction(shots, alpha=ALPHA, eta=ETA, polygons=None):
+    """
+    The forward scattered energy at the centre of each shot from its own exposure (at
+    unit dose), treating the polygon it came from (polygons, see
+    fracture.instance_shots; default: each shot on its own) as a rectangle of its mean
+    width and height. Polygons much larger than alpha get 1/(1 + eta).
+    """
+    if polygons is None:
+        polygons = np.arange(len(shots))
+    _, group = np.unique(polygons, return_inverse=True)
+    n = group.max() + 1 if len(group) else 0
+    lo, hi = np.full((n, 2), np.inf), np.full((n, 2), -np.inf)
+    np.minimum.at(lo, group, shots.min(axis=1))
+    np.maximum.at(hi, group, shots.max(axis=1))
+    area = np.bincount(group, fracture.trapezoid_area(shots), minlength=n)
+    span = hi - lo
+    # Scale the bounding box down to the area of the polygon (triangles, sloped sides)
+    span = span*np.sqrt(area/np.maximum(span.prod(axis=1), 1e-30))[:, np.newaxis]
+    return (np.prod(special.erf(span/(2*alpha)), axis=1)/(1 + eta))[group]
+
+def exposure(shots, doses, origin, shape, pixel_size, supersample=4):
+    """
+    Rasterize the dose density of shots onto a grid with its bottom left corner at
+    origin (see raster.rasterize). Shots smaller than a few supersamples would be missed
+    or badly sampled, so their whole dose is put in the pixel containing their centre.
+    """
+    areas = fracture.trapezoid_area(shots)
+    small = areas < 4*(pixel_size/supersample)**2
+    large = np.nonzero(~small)[0]
+    image = raster.rasterize(shots[large].reshape(-1, 2), 4*np.arange(len(large) + 1), origin, shape, pixel_size,
+                             supersample, doses[large])
+    pixel = np.floor((shots[small].mean(axis=1) - origin)/pixel_size).astype(int)
+    inside = np.all((pixel >= 0) & (pixel < (shape[1], shape[0])), axis=1)
+    np.add.at(image, (pixel[inside, 1], pixel[inside, 0]), (doses[small]*areas[small]/pixel_size**2)[inside])
+    return image
+
+def field_tiles(shots, fields, ids, field_size, origin, pixel_size, halo):
+    """
+    For each write field in ids, the shots that affect it (within the halo around it)
+    and the grid they are rasterized on, and the shots inside the field. Returns a
+    list of (near, lo, shape, inner, sample), where sample is where to read the energy
+    of each inner shot, in (row, column) pixel coordinates.
+    """
+    index = spatial_index.RTree(np.stack((shots.min(axis=1), shots.max(axis=1)), axis=1))
+    tiles = []
+    for field in ids:
+        lo = np.asarray(origin) + field*field_size - halo
+        hi = lo + field_size + 2*halo
+        near = index.query(lo, hi)
+        shape = tuple(np.ceil((hi - lo)/pixel_size).astype(int)[::-1])
+        inner = near[np.all(fields[near] == field, axis=1)]
+        sample = ((shots[inner].mean(axis=1) - lo)/pixel_size - 0.5)[:, ::-1].T
+        tiles.append((near, lo, shape, inner, sample))
+    return tiles
+
+# Worker state, set once per process by _init_worker
+_state = {}
+
+def _init_worker(shots, tiles, pixel_size, beta, eta, supersample):
+    _state.update(shots=shots, tiles=tiles, pixel_size=pixel_size, kernel=backscatter_kernel(pixel_size, beta, eta),
+                  supersample=supersample)
+
+def _field_backscatter(args):
+    """
+    Backscattered energy at the centre of each shot in a field, given the doses of the
+    shots near the field. Only those doses are sent, so each iteration passes about
+    one dose per shot to the workers, however many fields there are.
+    """
+    k, doses = args
+    near, lo, shape, _, sample = _state["tiles"][k]
+    dose = exposure(_state["shots"][near], doses, lo, shape, _state["pixel_size"], _state["supersample"])
+    energy = signal.fftconvolve(dose, _state["kernel"], mode="same")
+    return k, ndimage.map_coordinates(energy, sample, order=1, mode="nearest")
+
+def correct(shots, field_size=write_fields.FIELD_SIZE, origin=(0, 0), alpha=ALPHA, beta=BETA, eta=ETA,
+            target=None, iterations=8, pixel_size=None, supersample=4, dose_range=(0.2, 5.0), workers=None,
+            polygons=None):
+    """
+    Find the relative dose of each shot (N, 4, 2) so that the energy absorbed at every
+    shot is target (default 1/(1 + eta), the energy at an isolated feature much larger
+    than alpha at unit dose, so the base dose stays right for small isolated features).
+
+    polygons is the polygon each shot came from (see fracture.instance_shots), so that
+    the forward scattering is found for whole polygons (see forward_fraction).
+
+    The pixel size defaults to beta/10. Each iteration computes the backscatter for
+    every write field in parallel, then scales each dose by target/energy, clipped
+    to dose_range.
+
+    Returns (doses, energy), the dose of each shot and its energy at those doses.
+    """
+    if target is None:
+        target = 1/(1 + eta)
+    if pixel_size is None:
+        pixel_size = beta/10
+    centres = shots.mean(axis=1)
+    fields, _ = write_fields.field_index(np.stack((centres, centres), axis=1), field_size, origin)
+    ids = np.unique(fields, axis=0)
+    forward = forward_fraction(shots, alpha, eta, polygons)
+    doses = np.ones(len(shots))
+    tiles = field_tiles(shots, fields, ids, field_size, origin, pixel_size, 3*beta)
+    with Pool(workers, _init_worker, (shots, tiles, pixel_size, beta, eta, supersample)) as pool:
+        for i in range(iterations + 1):
+            back = np.zeros(len(shots))
+            jobs = [(k, doses[near]) for k, (near, *_) in enumerate(tiles)]
+            for k, values in pool.imap_unordered(_field_backscatter, jobs):
+                back[tiles[k][3]] = values
+            energy = doses*forward + back
+            if i == iterations:
+                break
+            doses = np.clip(doses*target/energy, *dose_range)
+    return doses, energy
+
+def dose_classes(doses, n_classes=16, dose_range=None):
+    """
+    Round doses into n_classes classes, evenly spaced in log(dose) over dose_range
+    (default: the range of doses). Returns (classes, class_doses): the class of each
+    shot, and the dose of each class.
+    """
+    lo, hi = dose_range if dose_range is not None else (doses.min(), doses.max())
+    class_doses = np.geomspace(lo, hi, n_classes) if hi > lo else np.full(1, lo)
+    if len(class_doses) == 1:
+        return np.zeros(len(doses), dtype=int), class_doses
+    step = np.log(class_doses[1]/class_doses[0])
+    classes = np.clip(np.round(np.log(doses/lo)/step), 0, len(class_doses) - 1).astype(int)
+    return classes, class_doses
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Proximity effect correct a GDS file, writing dose classes as datatypes.")
+    parser.add_argument("INPUT", type=str, help="GDS file")
+    parser.add_argument("OUTPUT", type=str, help="GDS file to write the corrected, flattened shots to")
+    parser.add_argument("-c", "--cell", type=str, default=None, help="Cell to correct (default: the top cell)")
+    parser.add_argument("-l", "--layers", type=int, nargs="+", default=None, help="Layers to correct (default: all)")
+    parser.add_argument("--alpha", type=float, default=ALPHA, help="Forward scattering range (um)")
+    parser.add_argument("--beta", type=float, default=BETA, help="Backscattering range (um)")
+    parser.add_argument("--eta", type=float, default=ETA, help="Ratio of backscattered to forward scattered energy")
+    parser.add_argument("--pixel-size", type=float, default=None, help="Backscatter grid pixel size (um, default beta/10)")
+    parser.add_argument("--iterations", type=int, default=8, help="Number of dose iterations")
+    parser.add_argument("--classes", type=int, default=16, help="Number of dose classes")
+    parser.add_argument("-f", "--field-size", type=float, default=write_fields.FIELD_SIZE, help="Write field size (um)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of worker processes")
+    args = parser.parse_args()
+
+    lib = gdspy.GdsLibrary(infile=args.INPUT)
+    top = lib.cells[args.cell] if args.cell else lib.top_level()[0]
+    shots, specs, polygons = fracture.instance_shots(top, lib, args.layers, polygons=True)
+    out_specs = specs.copy()
+    target = 1/(1 + args.eta)
+    # Every datatype of a layer is exposed together, so each layer is corrected as a
+    # whole and gets a single table of dose classes
+    for layer in np.unique(specs[:, 0]):
+        members = np.nonzero(specs[:, 0] == layer)[0]
+        doses, energy = correct(shots[members], args.field_size, alpha=args.alpha, beta=args.beta, eta=args.eta,
+                                iterations=args.iterations, pixel_size=args.pixel_size, workers=args.jobs,
+                                polygons=polygons[members])
+        classes, class_doses = dose_classes(doses, args.classes)
+        out_specs[members, 1] = classes
+        print(f"Layer {layer}: {len(members)} shots, dose {doses.min():.3f} - {doses.max():.3f}, "
+              f"energy error {np.abs(energy/target - 1).max()*100:.1f}% max")
+        for c, dose in enumerate(class_doses):
+            print(f"  datatype {c}: {dose:.4f} x base dose, {np.sum(classes == c)} shots")
+    out = gdspy.GdsLibrary(unit=lib.unit, precision=lib.precision)
+    out.add(exposure_order.ordered_cell(top.name, shots, out_specs))
+    out.write_gds(args.OUTPUT)
@@ -0,0 +1,111 @@
+"""
+Estimate how errors in picking the alignment markers out of an SEM image propagate
+to the positions of the nanowires on the die, by Monte Carlo over perturbed
+perspective transforms.
+"""
+
+import argparse
+
+import numpy as np
+
+import transforms
+
+# Clearance between the plunger tips and the nanowire in the NW170926 layouts (um)
+PLUNGER_TO_NW = 0.150
+
+def _noise_scale(sigma, n_markers=4):
+    """
+    Expand the pixel noise model into a per marker, per axis standard deviation.
+
+    sigma may be a scalar (isotropic, same for all markers), a (4,) array
+    (isotropic, per marker) or a (4, 2) array (per marker, per axis).
+    """
+    sigma = np.asarray(sigma, dtype=np.float64)
+    if sigma.ndim == 0:
+        return np.full((n_markers, 2), float(sigma))
+    if sigma.shape == (n_markers,):
+        return np.repeat(sigma[:, np.newaxis], 2, axis=1)
+    if sigma.shape == (n_markers, 2):
+        return sigma
+    raise ValueError(f"sigma should be a scalar, ({n_markers},) or ({n_markers}, 2). "
+                     f"Got: {sigma.shape}.")
+
+def estimate_nw_error(marker_coords, nw_coords, die_dims=(300, 300), sigma=1.0, nw_sigma=0.0,
+                      n_samples=100_000, batch_size=10_000, quantile=0.99,
+                      clearance=PLUNGER_TO_NW, seed=None):
+    """
+    Estimate the positional uncertainty of each nanowire on the die.
+
+    The marker coordinates (tl, tr, bl, br) and nanowire endpoints are given in
+    image pixels, as for coordinate_transform.find_nw. nw_coords may be a single
+    (2, 2) wire or an (M, 2, 2) array of wires. For each sample, the markers are
+    perturbed with Gaussian noise of standard deviation sigma pixels (see
+    _noise_scale), and the wire endpoints with nw_sigma pixels, and the
+    perspective transform is refit.
+
+    Returns a dictionary containing:
+        nominal: (M, 2, 2) unperturbed wire endpoints on the die (um).
+        std: (M, 2, 2) standard deviation of each endpoint coordinate (um).
+        error: (M, 2) radial error of each endpoint at the given quantile (um).
+        flagged: (M,) boolean array of wires where either endpoint error exceeds clearance.
+    """
+    marker_coords = np.asarray(marker_coords, dtype=np.float64)
+    nw_coords = np.asarray(nw_coords, dtype=np.float64)
+    if marker_coords.shape != (4, 2):
+        raise ValueError("marker_coords should be a set of four (x, y) coordinates")
+    if nw_coords.shape == (2, 2):
+        nw_coords = nw_coords[np.newaxis]
+    if nw_coords.ndim != 3 or nw_coords.shape[1:] != (2, 2):
+        raise ValueError("nw_coords should be an (M, 2, 2) array of wire endpoints")
+    n_wires = len(nw_coords)
+    points = nw_coords.reshape(-1, 2)
+
+    desired_coords = np.array(((0, 0), (die_dims[0], 0), (0, die_dims[1]), die_dims),
+                              dtype=np.float64)
+    M, _ = transforms.fit_projective(marker_coords, desired_coords)
+    nominal = transforms.apply_transform(M, points)
+
+    rng = np.random.default_rng(seed)
+    scale = _noise_scale(sigma)
+    deviations = []
+    for start in range(0, n_samples, batch_size):
+        n_batch = min(batch_size, n_samples - start)
+        markers = marker_coords + rng.standard_normal((n_batch, 4, 2))*scale
+        T, _ = transforms.fit_projective(markers, np.broadcast_to(desired_coords, markers.shape))
+        perturbed = points
+        if nw_sigma:
+            perturbed = points + rng.standard_normal((n_batch, *points.shape))*nw_sigma
+        deviations.append(transforms.apply_transform(T, perturbed) - nominal)
+    deviations = np.concatenate(deviations)
+
+    std = deviations.std(axis=0).reshape(n_wires, 2, 2)
+    error = np.quantile(np.linalg.norm(deviations, axis=-1), quantile, axis=0).reshape(n_wires, 2)
+
+    # Flip to the bottom left origin used by the layout scripts
+    nominal = nominal.reshape(n_wires, 2, 2)
+    nominal[..., 1] = die_dims[1] - nominal[..., 1]
+
+    return {"nominal": nominal, "std": std, "error": error,
+            "flagged": (error > clearance).any(axis=1)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Estimate nanowire placement error from marker picking error.")
+    parser.add_argument("MARKERS", type=float, nargs=8,
+                        help="Marker pixel coordinates: tl_x tl_y tr_x tr_y bl_x bl_y br_x br_y")
+    parser.add_argument("-w", "--wire", type=float, nargs=4, action="append", required=True,
+                        help="Wire endpoints in pixels: x1 y1 x2 y2 (may be repeated)")
+    parser.add_argument("-s", "--sigma", type=float, default=1.0, help="Marker picking error (pixels)")
+    parser.add_argument("--nw-sigma", type=float, default=0.0, help="Wire picking error (pixels)")
+    parser.add_argument("-n", "--samples", type=int, default=100_000, help="Number of Monte Carlo samples")
+    parser.add_argument("--die-size", type=float, nargs=2, default=(300, 300), help="Die dimensions in um")
+    parser.add_argument("--clearance", type=float, default=PLUNGER_TO_NW, help="Allowed error in um")
+    args = parser.parse_args()
+
+    markers = np.array(args.MARKERS).reshape(4, 2)
+    wires = np.array(args.wire).reshape(-1, 2, 2)
+    result = estimate_nw_error(markers, wires, tuple(args.die_size), args.sigma, args.nw_sigma,
+                               args.samples, clearance=args.clearance)
+    for i, wire in enumerate(result["nominal"]):
+        flag = "EXCEEDS CLEARANCE" if result["flagged"][i] else "ok"
+        print(f"Wire {i}: ({wire[0, 0]:.3f}, {wire[0, 1]:.3f}) -> ({wire[1, 0]:.3f}, {wire[1, 1]:.3f}), "
+              f"99% error {result['error'][i, 0]:.3f}/{result['error'][i, 1]:.3f} um - {flag}")
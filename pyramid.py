@@ -0,0 +1,260 @@
+"""
+Export a layout (e.g. a whole wafer) as a deep-zoom pyramid of PNG tiles, with a
+static HTML viewer, so it can be looked over in a browser without a layout viewer.
+
+Level 0 is the whole layout in a single tile, and each level after it doubles the
+resolution. Rendering follows the hierarchy: the polygons of each unique cell are
+rasterized once per level (and orientation) and stamped at every instance, to the
+nearest pixel. Cells too large to stamp (the wafer outline) are rasterized directly
+into each tile. Tiles are rendered across a process pool, and empty tiles are skipped.
+"""
+
+import argparse
+import json
+import os
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+import gdspy
+
+import layout_stats
+import raster
+
+TILE_SIZE = 256 # px
+MAX_STAMP = 2048 # px, larger cells are rasterized directly into each tile
+BACKGROUND = (255, 255, 255)
+# BGR, for cv2
+LAYER_COLORS = {0: (180, 180, 180), 1: (160, 80, 20), 2: (30, 110, 220), 3: (40, 160, 40), 4: (40, 40, 200)}
+
+VIEWER = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+  html, body {{ margin: 0; height: 100%; overflow: hidden; background: #fff; font-family: sans-serif; }}
+  #view {{ position: absolute; inset: 0; cursor: grab; }}
+  #view img {{ position: absolute; image-rendering: pixelated; user-select: none; }}
+  #info {{ position: absolute; left: 8px; bottom: 8px; background: #fffc; padding: 2px 6px; font-size: 13px; }}
+</style>
+</head>
+<body>
+<div id="view"></div>
+<div id="info"></div>
+<script>
+const meta = {meta};
+const view = document.getElementById("view"), info = document.getElementById("info");
+// View state: layout coordinates (um) of the centre, and um per screen pixel
+let cx = meta.origin[0] + meta.size/2, cy = meta.origin[1] + meta.size/2;
+let scale = meta.size/Math.min(view.clientWidth, view.clientHeight);
+const tiles = new Map(), have = new Set(meta.tiles);
+
+function draw() {{
+  const level = Math.max(0, Math.min(meta.levels - 1,
+    Math.ceil(Math.log2(meta.size/(meta.tile_size*scale)))));
+  const tile_um = meta.size/2**level, n = 2**level;
+  const w = view.clientWidth, h = view.clientHeight;
+  const x0 = cx - w/2*scale, y1 = cy + h/2*scale;
+  const wanted = new Set();
+  const tx0 = Math.max(0, Math.floor((x0 - meta.origin[0])/tile_um));
+  const tx1 = Math.min(n - 1, Math.floor((x0 + w*scale - meta.origin[0])/tile_um));
+  const ty0 = Math.max(0, Math.floor((meta.origin[1] + meta.size - y1)/tile_um));
+  const ty1 = Math.min(n - 1, Math.floor((meta.origin[1] + meta.size - y1 + h*scale)/tile_um));
+  for (let tx = tx0; tx <= tx1; tx++) {{
+    for (let ty = ty0; ty <= ty1; ty++) {{
+      const key = `${{level}}/${{tx}}/${{ty}}`;
+      if (!have.has(key)) continue;
+      wanted.add(key);
+      let img = tiles.get(key);
+      if (!img) {{
+        img = document.createElement("img");
+        img.src = key + ".png";
+        img.draggable = false;
+        view.appendChild(img);
+        tiles.set(key, img);
+      }}
+      img.style.left = ((meta.origin[0] + tx*tile_um - x0)/scale) + "px";
+      img.style.top = ((y1 - (meta.origin[1] + meta.size - ty*tile_um))/scale) + "px";
+      img.style.width = img.style.height = (tile_um/scale + 0.5) + "px";
+    }}
+  }}
+  for (const [key, img] of tiles) {{
+    if (!wanted.has(key)) {{ img.remove(); tiles.delete(key); }}
+  }}
+}}
+
+let drag = null;
+view.addEventListener("mousedown", e => {{ drag = [e.clientX, e.clientY]; view.style.cursor = "grabbing"; }});
+window.addEventListener("mouseup", () => {{ drag = null; view.style.cursor = "grab"; }});
+window.addEventListener("mousemove", e => {{
+  const x = cx + (e.clientX - view.clientWidth/2)*scale, y = cy - (e.clientY - view.clientHeight/2)*scale;
+  info.textContent = `x ${{x.toFixed(1)}} um, y ${{y.toFixed(1)}} um, ${{scale.toPrecision(3)}} um/px`;
+  if (!drag) return;
+  cx -= (e.clientX - drag[0])*scale;
+  cy += (e.clientY - drag[1])*scale;
+  drag = [e.clientX, e.clientY];
+  draw();
+}});
+view.addEventListener("wheel", e => {{
+  e.preventDefault();
+  const factor = Math.exp(e.deltaY*0.002);
+  const mx = (e.clientX - view.clientWidth/2), my = (e.clientY - view.clientHeight/2);
+  cx += mx*scale*(1 - factor);
+  cy -= my*scale*(1 - factor);
+  scale *= factor;
+  draw();
+}}, {{ passive: false }});
+window.addEventListener("resize", draw);
+draw();
+</script>
+</body>
+</html>
+"""
+
+def tile_instances(boxes, origin, size, level, tile_size=TILE_SIZE):
+    """
+    Find the tiles of a level overlapped by each of the (N, 2, 2) boxes. Tiles are
+    indexed (x, y) from the top left. Returns (tiles, instance), pairs of (K, 2) tile
+    indices and the index of the box in each.
+    """
+    tile_um = size/2**level
+    n = 2**level
+    lo = np.floor((boxes[:, 0] - origin)/tile_um).astype(np.int64)
+    hi = np.floor((boxes[:, 1] - origin)/tile_um).astype(np.int64)
+    # Tile rows count down from the top
+    lo[:, 1], hi[:, 1] = n - 1 - hi[:, 1], n - 1 - lo[:, 1]
+    lo, hi = np.clip(lo, 0, n - 1), np.clip(hi, 0, n - 1)
+    counts = hi - lo + 1
+    total = counts.prod(axis=1)
+    instance = np.repeat(np.arange(len(boxes)), total)
+    k = np.arange(total.sum()) - np.repeat(np.cumsum(total) - total, total)
+    tiles = lo[instance] + np.stack((k % counts[instance, 0], k//counts[instance, 0]), axis=-1)
+    return tiles, instance
+
+# Worker state, set once per process by _init_worker
+_state = {}
+
+def _init_worker(cells, origin, size, out_dir, tile_size, colors):
+    _state.update(cells=cells, origin=np.asarray(origin), size=size, out_dir=out_dir, tile_size=tile_size,
+                  colors=colors, level=None, stamps={})
+
+def _stamp(index, linear, layer, pixel_size):
+    """
+    Rasterize the own polygons of a cell on one layer, under a linear transform, at
+    the pixel size of the current level. Returns (image, offset of its bottom left
+    pixel from the cell origin in pixels), or None if it is too large to stamp.
+    """
+    key = (index, tuple(np.round(linear, 9).ravel()), layer)
+    if key not in _state["stamps"]:
+        vertices, offsets = _state["cells"][index][layer]
+        placed = vertices@linear.T
+        lo = np.floor(placed.min(axis=0)/pixel_size).astype(int)
+        shape = tuple((np.ceil(placed.max(axis=0)/pixel_size).astype(int) - lo + 1)[::-1])
+        if max(shape) > MAX_STAMP:
+            _state["stamps"][key] = None
+        else:
+            _state["stamps"][key] = (raster.rasterize(placed, offsets, lo*pixel_size, shape, pixel_size, 2), lo)
+    return _state["stamps"][key]
+
+def _render_tile(args):
+    """
+    Render one tile from the cell instances that overlap it, and write it out.
+    """
+    level, (tx, ty), instances = args
+    if _state["level"] != level:
+        _state["level"], _state["stamps"] = level, {}
+    ts = _state["tile_size"]
+    pixel_size = _state["size"]/2**level/ts
+    tile_origin = _state["origin"] + np.array((tx, 2**level - 1 - ty))*ts*pixel_size
+
+    canvases = {}
+    for index, T in instances:
+        for layer, (vertices, offsets) in _state["cells"][index].items():
+            canvas = canvases.setdefault(layer, np.zeros((ts, ts), dtype=np.float32))
+            stamp = _stamp(index, T[:2, :2], layer, pixel_size)
+            if stamp is None:
+                placed = vertices@T[:2, :2].T + T[:2, 2]
+                np.maximum(canvas, raster.rasterize(placed, offsets, tile_origin, (ts, ts), pixel_size, 2), out=canvas)
+                continue
+            image, lo = stamp
+            col, row = np.round((T[:2, 2] - tile_origin)/pixel_size).astype(int) + lo
+            r0, c0 = max(row, 0), max(col, 0)
+            r1, c1 = min(row + image.shape[0], ts), min(col + image.shape[1], ts)
+            if r1 > r0 and c1 > c0:
+                window = canvas[r0:r1, c0:c1]
+                np.maximum(window, image[r0 - row:r1 - row, c0 - col:c1 - col], out=window)
+
+    if not any(canvas.any() for canvas in canvases.values()):
+        return level, tx, ty, False
+    out = np.empty((ts, ts, 3), dtype=np.float32)
+    out[:] = BACKGROUND
+    for layer, canvas in sorted(canvases.items()):
+        color = _state["colors"].get(layer, (0, 0, 0))
+        out += canvas[..., np.newaxis]*(np.array(color, dtype=np.float32) - out)
+    path = os.path.join(_state["out_dir"], str(level), str(tx))
+    os.makedirs(path, exist_ok=True)
+    # Flip y, so the tile is the right way up
+    cv2.imwrite(os.path.join(path, f"{ty}.png"), np.round(out[::-1]).astype(np.uint8))
+    return level, tx, ty, True
+
+def export(cell, out_dir, levels=8, lib=None, layers=None, tile_size=TILE_SIZE, colors=None, workers=None):
+    """
+    Render a cell as a tile pyramid with the given number of levels into out_dir, as
+    out_dir/level/x/y.png, and write a viewer to out_dir/index.html. Returns the
+    number of tiles written.
+    """
+    colors = LAYER_COLORS if colors is None else colors
+    bounds = cell.get_bounding_box()
+    size = float(np.max(bounds[1] - bounds[0]))
+    origin = bounds[0]
+
+    # Pack each cell with polygons once, and find where all of its instances are
+    cells, transforms, boxes = [], [], []
+    for node, T in layout_stats.instance_transforms(cell, lib):
+        packed = raster.cell_layers(node, layers)
+        if not packed:
+            continue
+        vertices = np.concatenate([v for v, _ in packed.values()])
+        lo, hi = vertices.min(axis=0), vertices.max(axis=0)
+        corners = np.array(((lo[0], lo[1]), (hi[0], lo[1]), (lo[0], hi[1]), (hi[0], hi[1])))
+        placed = corners@T[:, :2, :2].swapaxes(-1, -2) + T[:, np.newaxis, :2, 2]
+        transforms.extend((len(cells), t) for t in T)
+        boxes.append(np.stack((placed.min(axis=1), placed.max(axis=1)), axis=1))
+        cells.append(packed)
+    boxes = np.concatenate(boxes) if boxes else np.zeros((0, 2, 2))
+
+    written = []
+    with Pool(workers, _init_worker, (cells, origin, size, out_dir, tile_size, colors)) as pool:
+        for level in range(levels):
+            tiles, instance = tile_instances(boxes, origin, size, level, tile_size)
+            order = np.lexsort((tiles[:, 1], tiles[:, 0]))
+            tiles, instance = tiles[order], instance[order]
+            starts = np.concatenate(([0], np.nonzero(np.any(np.diff(tiles, axis=0) != 0, axis=1))[0] + 1))
+            jobs = [(level, tuple(tiles[s]), [transforms[i] for i in members])
+                    for s, members in zip(starts, np.split(instance, starts[1:]))]
+            for result in pool.imap_unordered(_render_tile, jobs, chunksize=4):
+                if result[3]:
+                    written.append(f"{result[0]}/{result[1]}/{result[2]}")
+
+    meta = {"levels": levels, "tile_size": tile_size, "origin": [float(x) for x in origin], "size": size,
+            "tiles": sorted(written)}
+    with open(os.path.join(out_dir, "index.html"), "w") as f:
+        f.write(VIEWER.format(title=cell.name, meta=json.dumps(meta)))
+    return len(written)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a GDS file as a deep-zoom tile pyramid with an HTML viewer.")
+    parser.add_argument("INPUT", type=str, help="GDS file")
+    parser.add_argument("OUTPUT", type=str, help="Output directory")
+    parser.add_argument("-c", "--cell", type=str, default=None, help="Cell to export (default: the top cell)")
+    parser.add_argument("-l", "--layers", type=int, nargs="+", default=None, help="Layers to render (default: all)")
+    parser.add_argument("-n", "--levels", type=int, default=8, help="Number of zoom levels")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of worker processes")
+    args = parser.parse_args()
+
+    lib = gdspy.GdsLibrary(infile=args.INPUT)
+    top = lib.cells[args.cell] if args.cell else lib.top_level()[0]
+    os.makedirs(args.OUTPUT, exist_ok=True)
+    n_tiles = export(top, args.OUTPUT, args.levels, lib, args.layers, workers=args.jobs)
+    print(f"Written {n_tiles} tiles to {args.OUTPUT}, open {os.path.join(args.OUTPUT, 'index.html')} to view.")
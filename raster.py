@@ -0,0 +1,211 @@
+"""
+Rasterize packed polygons (a (V, 2) vertex array and (P+1,) offsets into it) into
+images, at any pixel size, for previews, proximity correction and synthetic images.
+
+Rasterizing is done a scanline at a time for every edge at once: each edge adds its
+direction at the first sample to its right on every scanline it crosses, and a
+cumulative sum along each scanline then gives the winding number. Polygons are
+reoriented to be anticlockwise first, so overlaps are filled (not cancelled) and the
+holes of keyhole polygons are left empty. Antialiasing is by supersampling, with the
+samples of each pixel counted as the scanline is summed rather than one at a time.
+Large images are rendered as tiles across a process pool.
+"""
+
+import argparse
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+import gdspy
+
+import layout_stats
+import spatial_index
+
+def pack(polygons):
+    """
+    Pack a list of (N, 2) polygons into a (V, 2) vertex array and (P+1,) offsets.
+    """
+    offsets = np.concatenate(([0], np.cumsum([len(p) for p in polygons]))).astype(np.int64)
+    vertices = np.concatenate(polygons).astype(float) if polygons else np.zeros((0, 2))
+    return vertices, offsets
+
+def cell_polygons(cell, lib=None, layers=None):
+    """
+    Flatten the polygons of a cell on the given layers (default: all) into packed
+    arrays. Each unique cell's polygons are packed once and then transformed for all
+    of its instances together.
+    """
+    parts, lengths = [], []
+    for node, T in layout_stats.instance_transforms(cell, lib):
+        own = [points for polyset in node.polygons
+               for points, layer in zip(polyset.polygons, polyset.layers) if layers is None or layer in layers]
+        if not own:
+            continue
+        vertices, offsets = pack(own)
+        placed = vertices@T[:, :2, :2].swapaxes(-1, -2) + T[:, np.newaxis, :2, 2]
+        parts.append(placed.reshape(-1, 2))
+        lengths.append(np.tile(np.diff(offsets), len(T)))
+    if not parts:
+        return np.zeros((0, 2)), np.zeros(1, dtype=np.int64)
+    return np.concatenate(parts), np.concatenate(([0], np.cumsum(np.concatenate(lengths)))).astype(np.int64)
+
+def cell_layers(cell, layers=None):
+    """
+    The own polygons of a cell (ignoring references) on the given layers (default:
+    all), packed per layer, as a dictionary of layer to (vertices, offsets).
+    """
+    by_layer = {}
+    for polyset in cell.polygons:
+        for points, layer in zip(polyset.polygons, polyset.layers):
+            if layers is None or layer in layers:
+                by_layer.setdefault(int(layer), []).append(points)
+    return {layer: pack(polygons) for layer, polygons in sorted(by_layer.items())}
+
+def next_vertex(offsets):
+    """
+    For packed polygons with the given offsets, the index of the next vertex of each
+    vertex, wrapping around at the end of each polygon.
+    """
+    index = np.arange(1, offsets[-1] + 1)
+    index[offsets[1:] - 1] = offsets[:-1]
+    return index
+
+def polygon_bounds(vertices, offsets):
+    """
+    The (P, 2, 2) bounding box of each packed polygon.
+    """
+    starts = offsets[:-1]
+    return np.stack((np.minimum.reduceat(vertices, starts), np.maximum.reduceat(vertices, starts)), axis=1)
+
+def signed_areas(vertices, offsets):
+    """
+    Signed area of each packed polygon (positive if anticlockwise).
+    """
+    nxt = vertices[next_vertex(offsets)]
+    cross = vertices[:, 0]*nxt[:, 1] - nxt[:, 0]*vertices[:, 1]
+    return np.add.reduceat(cross, offsets[:-1])/2
+
+def rasterize(vertices, offsets, origin, shape, pixel_size=1.0, supersample=1, values=None):
+    """
+    Rasterize packed polygons into an image of shape (rows, columns), where pixel
+    (i, j) covers x from origin[0] + j*pixel_size and y from origin[1] + i*pixel_size
+    (so row 0 is at the bottom for layout coordinates, or at the top for image
+    coordinates with y down).
+
+    With values=None, returns the fraction of each pixel covered by any polygon. With a
+    value per polygon (e.g. its dose), returns the sum of the values of the polygons
+    covering each pixel, weighted by coverage. Each pixel is sampled supersample^2 times.
+    """
+    rows, cols = shape[0]*supersample, shape[1]*supersample
+    step = pixel_size/supersample
+    empty = np.zeros(shape, dtype=np.float32 if values is None else float)
+    if len(offsets) < 2:
+        return empty
+    lengths = np.diff(offsets)
+    polygon = np.repeat(np.arange(len(lengths)), lengths)
+    start = (vertices - origin)/step - 0.5 # in units of samples
+    nxt = np.roll(start, -1, axis=0)
+    nxt[offsets[1:] - 1] = start[offsets[:-1]]
+
+    # Every edge crosses the scanlines in [first, last), and adds its direction there
+    lo_y, hi_y = np.minimum(start[:, 1], nxt[:, 1]), np.maximum(start[:, 1], nxt[:, 1])
+    first = np.clip(np.ceil(lo_y), 0, rows).astype(np.int64)
+    last = np.clip(np.ceil(hi_y), 0, rows).astype(np.int64)
+    direction = np.where(nxt[:, 1] > start[:, 1], -1.0, 1.0)*np.sign(signed_areas(vertices, offsets))[polygon]
+    if values is not None:
+        direction *= np.asarray(values, dtype=float)[polygon]
+    count = last - first
+    edge = np.repeat(np.arange(len(start)), count)
+    if not len(edge):
+        return empty
+    row = first[edge] + np.arange(len(edge)) - np.repeat(np.cumsum(count) - count, count)
+    t = (row - start[edge, 1])/(nxt[edge, 1] - start[edge, 1])
+    x = start[edge, 0] + t*(nxt[edge, 0] - start[edge, 0])
+    col = np.clip(np.ceil(x), 0, cols).astype(np.int64)
+
+    # Rather than filling every sample, add up the samples right of each crossing in
+    # each pixel of its scanline: (supersample - r) in its own pixel, and the rest in the next
+    pixel, r = np.divmod(col, supersample)
+    weight = direction[edge]
+    index = row*(shape[1] + 2) + pixel
+    line = np.bincount(np.concatenate((index, index + 1)), np.concatenate((weight*(supersample - r), weight*r)),
+                       minlength=rows*(shape[1] + 2))
+    line = np.cumsum(line.reshape(rows, shape[1] + 2), axis=1)[:, :shape[1]]
+    if values is None:
+        # Count overlapping polygons once
+        line = np.clip(line, 0, supersample)
+    image = line.reshape(shape[0], supersample, shape[1]).sum(axis=1)/supersample**2
+    return image.astype(empty.dtype)
+
+# Worker state, set once per process by _init_worker
+_state = {}
+
+def _init_worker(vertices, offsets, values):
+    _state.update(vertices=vertices, offsets=offsets, values=values,
+                  index=spatial_index.RTree(polygon_bounds(vertices, offsets)))
+
+def _select(lo, hi):
+    """
+    The packed polygons whose bounding boxes overlap the box lo-hi, and their values.
+    """
+    vertices, offsets = _state["vertices"], _state["offsets"]
+    near = _state["index"].query(lo, hi)
+    lengths = np.diff(offsets)[near]
+    index = np.repeat(offsets[near] - np.cumsum(np.concatenate(([0], lengths[:-1]))), lengths) + np.arange(lengths.sum())
+    values = None if _state["values"] is None else _state["values"][near]
+    return vertices[index], np.concatenate(([0], np.cumsum(lengths))), values
+
+def _render_tile(args):
+    (i, j), origin, shape, pixel_size, supersample = args
+    lo = np.asarray(origin)
+    hi = lo + np.array((shape[1], shape[0]))*pixel_size
+    vertices, offsets, values = _select(lo, hi)
+    return (i, j), rasterize(vertices, offsets, origin, shape, pixel_size, supersample, values)
+
+def render_tiles(vertices, offsets, origin, shape, pixel_size=1.0, supersample=1, values=None, tile_size=2048,
+                 workers=None):
+    """
+    Rasterize packed polygons (as rasterize) in tiles of tile_size pixels, across a
+    process pool. Each tile only rasterizes the polygons that overlap it. Yields
+    ((row, column) of the tile's first pixel, tile image) as tiles are finished, so
+    images too large to hold in memory can be written out as they are made.
+    """
+    jobs = []
+    for i in range(0, shape[0], tile_size):
+        for j in range(0, shape[1], tile_size):
+            tile_origin = (origin[0] + j*pixel_size, origin[1] + i*pixel_size)
+            tile_shape = (min(tile_size, shape[0] - i), min(tile_size, shape[1] - j))
+            jobs.append(((i, j), tile_origin, tile_shape, pixel_size, supersample))
+    values = None if values is None else np.asarray(values, dtype=float)
+    with Pool(workers, _init_worker, (vertices, offsets, values)) as pool:
+        yield from pool.imap_unordered(_render_tile, jobs)
+
+def render(vertices, offsets, origin, shape, pixel_size=1.0, supersample=1, values=None, tile_size=2048, workers=None):
+    """
+    Rasterize packed polygons into a single image, in parallel tiles (see render_tiles).
+    """
+    image = np.zeros(shape, dtype=np.float32 if values is None else float)
+    for (i, j), tile in render_tiles(vertices, offsets, origin, shape, pixel_size, supersample, values, tile_size,
+                                     workers):
+        image[i:i + tile.shape[0], j:j + tile.shape[1]] = tile
+    return image
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render a preview image of a GDS file.")
+    parser.add_argument("INPUT", type=str, help="GDS file")
+    parser.add_argument("OUTPUT", type=str, help="Image file")
+    parser.add_argument("-c", "--cell", type=str, default=None, help="Cell to render (default: the top cell)")
+    parser.add_argument("-l", "--layers", type=int, nargs="+", default=None, help="Layers to render (default: all)")
+    parser.add_argument("-p", "--pixel-size", type=float, default=1.0, help="Pixel size (um)")
+    parser.add_argument("-s", "--supersample", type=int, default=2, help="Samples per pixel in each direction")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of worker processes")
+    args = parser.parse_args()
+
+    lib = gdspy.GdsLibrary(infile=args.INPUT)
+    top = lib.cells[args.cell] if args.cell else lib.top_level()[0]
+    vertices, offsets = cell_polygons(top, lib, args.layers)
+    lo, hi = vertices.min(axis=0), vertices.max(axis=0)
+    shape = tuple(np.ceil((hi - lo)/args.pixel_size).astype(int)[::-1])
+    image = render(vertices, offsets, lo, shape, args.pixel_size, args.supersample, workers=args.jobs)
+    # Flip y, so the image is the right way up
+    cv2.imwrite(args.OUTPUT, np.round(image[::-1]*255).astype(np.uint8))
@@ -0,0 +1,120 @@
+"""
+Snap generated layouts to the database grid before export.
+
+Beamer imports with DATABASE_GRID = 0.001 and MAXIMUM_SNAPPING_RANGE = 0.0005,
+and heals the result. Snapping here instead (all at once, on a single packed
+vertex array) means the import has nothing to fix, and lets us catch the slivers
+that snapping creates before they reach the writer.
+"""
+
+import numpy as np
+import gdspy
+
+import raster
+
+# Beamer database grid (um)
+GRID = 0.001
+
+def snap_points(points, grid=GRID):
+    """
+    Round points to the nearest multiple of grid.
+    """
+    return np.round(np.asarray(points, dtype=np.float64)/grid)*grid
+
+def polygon_metrics(vertices, offsets):
+    """
+    Signed area and perimeter of each of a set of packed polygons, given as a (V, 2)
+    vertex array and (P+1,) offsets into it.
+    """
+    nxt = vertices[raster.next_vertex(offsets)]
+    cross = vertices[:, 0]*nxt[:, 1] - nxt[:, 0]*vertices[:, 1]
+    edge = np.linalg.norm(nxt - vertices, axis=1)
+    starts = offsets[:-1]
+    return np.add.reduceat(cross, starts)/2, np.add.reduceat(edge, starts)
+
+def snap_polygons(polygons, grid=GRID, min_width=None):
+    """
+    Snap a list of polygons to grid in one pass, removing the repeated vertices that
+    snapping creates.
+
+    A polygon is reported as a sliver if it collapses to fewer than three vertices, if
+    snapping flips its orientation, or if its mean width (2*area/perimeter) is less than
+    min_width (default 2*grid). Collapsed polygons are removed.
+
+    Returns (snapped, keep, slivers): the snapped polygons that were kept, a boolean
+    mask of which input polygons were kept, and the indices of the sliver polygons.
+    """
+    if min_width is None:
+        min_width = 2*grid
+    if not polygons:
+        return [], np.zeros(0, dtype=bool), np.zeros(0, dtype=int)
+    lengths = np.array([len(p) for p in polygons])
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    vertices = np.concatenate(polygons).astype(np.float64)
+    area_before, _ = polygon_metrics(vertices, offsets)
+
+    # Snap, and remove vertices that land on the next one
+    snapped = snap_points(vertices, grid)
+    repeated = np.all(snapped == snapped[raster.next_vertex(offsets)], axis=1)
+    polygon_id = np.repeat(np.arange(len(polygons)), lengths)
+    lengths = np.bincount(polygon_id[~repeated], minlength=len(polygons))
+    snapped = snapped[~repeated]
+    keep = lengths >= 3
+
+    slivers = ~keep
+    if keep.any():
+        kept_vertices = snapped[np.repeat(keep, lengths)]
+        kept_offsets = np.concatenate(([0], np.cumsum(lengths[keep])))
+        area, perimeter = polygon_metrics(kept_vertices, kept_offsets)
+        flipped = np.sign(area) != np.sign(area_before[keep])
+        thin = 2*np.abs(area)/perimeter < min_width
+        slivers[keep] = flipped | thin
+        result = np.split(kept_vertices, kept_offsets[1:-1])
+    else:
+        result = []
+    return result, keep, np.nonzero(slivers)[0]
+
+def snap_library(lib, grid=GRID, min_width=None):
+    """
+    Snap every polygon, label and reference in a library to grid, in place. Each cell
+    is only visited once, however many times it is referenced.
+
+    Returns a list of (cell name, layer, datatype, area) for each sliver found (see
+    snap_polygons). Collapsed polygons are removed from their cells.
+    """
+    # Gather every polygon in the library, so they can be snapped in one go
+    owners = []
+    polygons = []
+    for cell in lib.cells.values():
+        for polyset in cell.polygons:
+            owners.extend((cell, polyset, i) for i in range(len(polyset.polygons)))
+            polygons.extend(polyset.polygons)
+    snapped, keep, sliver_index = snap_polygons(polygons, grid, min_width)
+
+    slivers = []
+    for i in sliver_index:
+        cell, polyset, j = owners[i]
+        area = abs(polygon_metrics(polygons[i], np.array((0, len(polygons[i]))))[0][0])
+        slivers.append((cell.name, polyset.layers[j], polyset.datatypes[j], float(area)))
+
+    # Write the snapped polygons back, dropping any that collapsed
+    snapped = iter(snapped)
+    rebuilt = {}
+    for (cell, polyset, j), kept in zip(owners, keep):
+        entry = rebuilt.setdefault(id(polyset), (polyset, [], [], []))
+        if kept:
+            entry[1].append(next(snapped))
+            entry[2].append(polyset.layers[j])
+            entry[3].append(polyset.datatypes[j])
+    for polyset, new_polygons, layers, datatypes in rebuilt.values():
+        polyset.polygons, polyset.layers, polyset.datatypes = new_polygons, layers, datatypes
+    for cell in lib.cells.values():
+        cell.polygons = [polyset for polyset in cell.polygons if polyset.polygons]
+
+        for label in cell.labels:
+            label.position = snap_points(label.position, grid)
+        for ref in cell.references:
+            ref.origin = snap_points(ref.origin, grid)
+            if isinstance(ref, gdspy.CellArray):
+                ref.spacing = snap_points(ref.spacing, grid)
+    return slivers
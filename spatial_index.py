@@ -0,0 +1,230 @@
+"""
+A packed R-tree over bounding boxes, for finding which features of a layout overlap
+(or come within some distance of) a region, or each other: plungers over etch
+windows, device polygons near alignment marks, shots near a write field.
+
+The tree is built bottom up with Sort-Tile-Recursive packing: the boxes are sorted
+into vertical slices by x, then by y within each slice, and every run of node_size
+boxes becomes a node. The nodes are packed the same way, level by level, up to a
+single root. Every level is a plain array of boxes and the first child of each
+node, so the tree can be saved with NumPy or sent to worker processes as it is.
+
+Queries are done for many boxes at once, walking down the tree a level at a time
+with every (query, node) pair that still overlaps, and pairs between two trees
+(e.g. two layers) are found by walking down both trees together.
+"""
+
+import argparse
+
+import numpy as np
+import gdspy
+
+import layout_stats
+
+NODE_SIZE = 16
+
+def _overlap(a, b, distance=0.0):
+    """
+    Whether each box of a ((N, 2, 2) arrays of ((xmin, ymin), (xmax, ymax))) comes
+    within distance of the matching box of b.
+    """
+    return np.all((a[:, 1] + distance >= b[:, 0]) & (a[:, 0] - distance <= b[:, 1]), axis=1)
+
+def _str_order(boxes, node_size):
+    """
+    Sort-Tile-Recursive order of boxes: sorted by x centre into slices of
+    about sqrt(N/node_size) nodes each, then by y centre within each slice.
+    """
+    centres = boxes.mean(axis=1)
+    n_slices = max(int(np.ceil(np.sqrt(len(boxes)/node_size))), 1)
+    per_slice = n_slices*node_size
+    order = np.argsort(centres[:, 0], kind="stable")
+    slice_of = np.arange(len(boxes))//per_slice
+    return order[np.lexsort((centres[order, 1], slice_of))]
+
+def _expand(start, count):
+    """
+    For runs of children [start, start + count), the index of every child and the run
+    it belongs to.
+    """
+    run = np.repeat(np.arange(len(start)), count)
+    return start[run] + np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count), run
+
+class RTree:
+    """
+    A packed R-tree over (N, 2, 2) boxes of ((xmin, ymin), (xmax, ymax)).
+
+    levels[0] holds the boxes in leaf order (items[i] is the index of the i-th leaf
+    box in the original array), and each higher level holds the boxes of its nodes
+    and where their children start and how many there are in the level below.
+    """
+    def __init__(self, boxes, node_size=NODE_SIZE):
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 2, 2)
+        self.node_size = node_size
+        self.items = _str_order(boxes, node_size)
+        self.levels = [boxes[self.items]]
+        self.starts, self.counts = [None], [None]
+        while len(self.levels[-1]) > 1:
+            below = self.levels[-1]
+            start = np.arange(0, len(below), node_size)
+            count = np.minimum(node_size, len(below) - start)
+            nodes = np.stack((np.minimum.reduceat(below[:, 0], start), np.maximum.reduceat(below[:, 1], start)), axis=1)
+            # Pack this level in turn, keeping each node's children together below it
+            order = _str_order(nodes, node_size)
+            self.levels.append(nodes[order])
+            self.starts.append(start[order])
+            self.counts.append(count[order])
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def boxes(self):
+        """
+        The boxes, in their original order.
+        """
+        boxes = np.empty_like(self.levels[0])
+        boxes[self.items] = self.levels[0]
+        return boxes
+
+    def save(self, filename):
+        """
+        Save the tree to a .npz file.
+        """
+        arrays = {"node_size": self.node_size, "items": self.items, "n_levels": len(self.levels)}
+        for level, boxes in enumerate(self.levels):
+            arrays[f"boxes_{level}"] = boxes
+            if level:
+                arrays[f"starts_{level}"], arrays[f"counts_{level}"] = self.starts[level], self.counts[level]
+        np.savez(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a tree saved with save.
+        """
+        tree = cls.__new__(cls)
+        with np.load(filename) as saved:
+            tree.node_size, tree.items = int(saved["node_size"]), saved["items"]
+            n_levels = int(saved["n_levels"])
+            tree.levels = [saved[f"boxes_{level}"] for level in range(n_levels)]
+            tree.starts = [None] + [saved[f"starts_{level}"] for level in range(1, n_levels)]
+            tree.counts = [None] + [saved[f"counts_{level}"] for level in range(1, n_levels)]
+        return tree
+
+    def _root(self):
+        return len(self.levels) - 1, np.zeros(1 if len(self.items) else 0, dtype=np.int64)
+
+    def _descend(self, level, nodes):
+        """
+        The children of nodes at a level, and which node each came from.
+        """
+        return _expand(self.starts[level][nodes], self.counts[level][nodes])
+
+    def query_boxes(self, boxes, distance=0.0):
+        """
+        Find every item that comes within distance of each of the (Q, 2, 2) query boxes.
+        Returns (query, item) index arrays, one entry per pair.
+        """
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 2, 2)
+        level, root = self._root()
+        query = np.repeat(np.arange(len(boxes)), len(root))
+        nodes = np.tile(root, len(boxes))
+        keep = _overlap(boxes[query], self.levels[level][nodes], distance)
+        query, nodes = query[keep], nodes[keep]
+        while level > 0:
+            nodes, parent = self._descend(level, nodes)
+            query = query[parent]
+            level -= 1
+            keep = _overlap(boxes[query], self.levels[level][nodes], distance)
+            query, nodes = query[keep], nodes[keep]
+        return query, self.items[nodes]
+
+    def query(self, lo, hi, distance=0.0):
+        """
+        The items that come within distance of the box lo-hi.
+        """
+        _, items = self.query_boxes(np.array((lo, hi), dtype=float), distance)
+        return np.sort(items)
+
+    def join(self, other, distance=0.0):
+        """
+        Find every pair of an item of this tree and an item of other that come within
+        distance of each other, walking down both trees together. Returns (ia, ib)
+        index arrays, one entry per pair. Joining a tree with itself gives every pair
+        twice (as (i, j) and (j, i)), and every item paired with itself.
+        """
+        level_a, a = self._root()
+        level_b, b = other._root()
+        a, b = np.repeat(a, len(b)), np.tile(b, len(a))
+        keep = _overlap(self.levels[level_a][a], other.levels[level_b][b], distance)
+        a, b = a[keep], b[keep]
+        while level_a > 0 or level_b > 0:
+            # Descend the taller tree, or this one if they are level
+            if level_a >= level_b:
+                a, parent = self._descend(level_a, a)
+                b = b[parent]
+                level_a -= 1
+            else:
+                b, parent = other._descend(level_b, b)
+                a = a[parent]
+                level_b -= 1
+            keep = _overlap(self.levels[level_a][a], other.levels[level_b][b], distance)
+            a, b = a[keep], b[keep]
+        return self.items[a], other.items[b]
+
+def layout_index(cell, lib=None, layers=None, node_size=NODE_SIZE):
+    """
+    Index the bounding box of every polygon instance under cell (see
+    layout_stats.instance_boxes), with one tree for each layer.
+
+    Returns a dictionary of layer to (tree, names, specs), where names and specs are the
+    cell and (layer, datatype) of each item in the tree.
+    """
+    boxes, names, specs = layout_stats.instance_boxes(cell, layers, lib)
+    names = np.array(names, dtype=object)
+    index = {}
+    for layer in np.unique(specs[:, 0]):
+        members = np.nonzero(specs[:, 0] == layer)[0]
+        index[int(layer)] = (RTree(boxes[members], node_size), names[members], specs[members])
+    return index
+
+def layer_pairs(index, layer_a, layer_b, distance=0.0):
+    """
+    Find every pair of polygon instances, one on layer_a and one on layer_b of a
+    layout_index, whose bounding boxes come within distance of each other (for the
+    same layer, each pair once). Returns (ia, ib), indices into each layer's tree.
+    """
+    if layer_a not in index or layer_b not in index:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+    ia, ib = index[layer_a][0].join(index[layer_b][0], distance)
+    if layer_a == layer_b:
+        ia, ib = ia[ia < ib], ib[ia < ib]
+    return ia, ib
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find features on two layers of a GDS file that overlap or come close.")
+    parser.add_argument("INPUT", type=str, help="GDS file")
+    parser.add_argument("LAYER_A", type=int, help="First layer")
+    parser.add_argument("LAYER_B", type=int, help="Second layer")
+    parser.add_argument("-c", "--cell", type=str, default=None, help="Cell to index (default: the top cell)")
+    parser.add_argument("-d", "--distance", type=float, default=0.0, help="Report boxes within this distance (um)")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Save the index of LAYER_A to this .npz file")
+    args = parser.parse_args()
+
+    lib = gdspy.GdsLibrary(infile=args.INPUT)
+    top = lib.cells[args.cell] if args.cell else lib.top_level()[0]
+    index = layout_index(top, lib, {args.LAYER_A, args.LAYER_B})
+    ia, ib = layer_pairs(index, args.LAYER_A, args.LAYER_B, args.distance)
+    print(f"{len(ia)} pairs of features on layers {args.LAYER_A} and {args.LAYER_B} within {args.distance:g} um.")
+    if len(ia):
+        (tree_a, names_a, _), (tree_b, names_b, _) = index[args.LAYER_A], index[args.LAYER_B]
+        boxes_a, boxes_b = tree_a.boxes, tree_b.boxes
+        for i, j in zip(ia, ib):
+            (ax0, ay0), (ax1, ay1) = boxes_a[i]
+            (bx0, by0), (bx1, by1) = boxes_b[j]
+            print(f"  {names_a[i]} ({ax0:.3f}, {ay0:.3f}) - ({ax1:.3f}, {ay1:.3f}) and "
+                  f"{names_b[j]} ({bx0:.3f}, {by0:.3f}) - ({bx1:.3f}, {by1:.3f})")
+    if args.output and args.LAYER_A in index:
+        index[args.LAYER_A][0].save(args.output)
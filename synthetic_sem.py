@@ -0,0 +1,190 @@
+"""
+Generate synthetic SEM images of a wire section with known ground truth, for
+benchmarking and regression testing the marker and wire detection in
+coordinate_transform.
+"""
+
+import argparse
+import os.path
+import time
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+
+import coordinate_transform
+import raster
+import transforms
+
+def field_polygons(fid="a", sec_size=300):
+    """
+    Get the flattened polygons of a wire section, packed (see
+    coordinate_transform.field_polygons).
+    """
+    return coordinate_transform.field_polygons(fid, sec_size)
+
+def wire_polygons(wires, width):
+    """
+    Convert (N, 2, 2) wire endpoints into (N, 4, 2) rectangles of the given width.
+    """
+    direction = wires[:, 1] - wires[:, 0]
+    normal = np.stack((-direction[:, 1], direction[:, 0]), axis=-1)
+    normal *= (width/2)/np.linalg.norm(normal, axis=-1, keepdims=True)
+    return np.stack((wires[:, 0] - normal, wires[:, 1] - normal,
+                     wires[:, 1] + normal, wires[:, 0] + normal), axis=1)
+
+def random_wires(rng, n_wires, sec_size=300, length=(5, 15), keep_out=40):
+    """
+    Place n_wires randomly in the field, keeping keep_out um away from the edges
+    (and therefore the alignment squares).
+    """
+    centers = rng.uniform(keep_out, sec_size - keep_out, (n_wires, 2))
+    angles = rng.uniform(0, np.pi, n_wires)
+    half = rng.uniform(*length, n_wires)/2
+    offset = np.stack((np.cos(angles), np.sin(angles)), axis=-1)*half[:, np.newaxis]
+    return np.stack((centers - offset, centers + offset), axis=1)
+
+def random_transform(rng, sec_size=300, img_size=(2200, 2000), margin=0.08, jitter=0.02):
+    """
+    Generate a random perspective transform from field coordinates (um, y up) to
+    image pixels (y down). The field fills the image, less a margin on each side,
+    and each corner is jittered by a fraction of the image size.
+    """
+    w, h = img_size
+    field_corners = np.array(((0, sec_size), (sec_size, sec_size), (0, 0), (sec_size, 0)), dtype=float)
+    img_corners = np.array(((margin*w, margin*h), ((1-margin)*w, margin*h),
+                            (margin*w, (1-margin)*h), ((1-margin)*w, (1-margin)*h)))
+    img_corners += rng.uniform(-jitter, jitter, (4, 2))*(w, h)
+    T, _ = transforms.fit_projective(field_corners, img_corners)
+    return T, img_corners
+
+def render(vertices, offsets, T, img_size, supersample=4):
+    """
+    Rasterize packed polygons in field coordinates into a float image with values in
+    [0, 1], antialiased by supersampling. All vertices are transformed at once.
+    """
+    w, h = img_size
+    pixels = transforms.apply_transform(T, vertices)
+    # Pixel centres are at integer coordinates
+    return raster.rasterize(pixels, offsets, (-0.5, -0.5), (h, w), 1.0, supersample)
+
+def synthesize(seed, n_wires=5, sec_size=300, img_size=(2200, 2000), wire_width=0.3,
+               blur=1.5, noise=0.05, contrast=(0.15, 0.8), fid="a"):
+    """
+    Generate a single synthetic SEM image.
+
+    Returns (img, markers, wires), where img is a uint8 grayscale image, markers are
+    the (tl, tr, bl, br) field corners in image pixels, and wires are the (n_wires, 2, 2)
+    wire endpoints in um with the origin at the bottom left of the field.
+    """
+    rng = np.random.default_rng(seed)
+    vertices, offsets = field_polygons(fid, sec_size)
+    wires = random_wires(rng, n_wires, sec_size)
+    wire_verts = wire_polygons(wires, wire_width).reshape(-1, 2)
+    wire_offsets = offsets[-1] + 4*np.arange(1, n_wires + 1)
+    vertices = np.concatenate((vertices, wire_verts))
+    offsets = np.concatenate((offsets, wire_offsets))
+
+    T, markers = random_transform(rng, sec_size, img_size)
+    img = render(vertices, offsets, T, img_size)
+
+    # Add SEM-like contrast, blur and noise
+    background, foreground = contrast
+    img = background + (foreground - background)*img
+    img = cv2.GaussianBlur(img, (0, 0), blur)
+    img += noise*rng.standard_normal(img.shape, dtype=np.float32)
+    img = (np.clip(img, 0, 1)*255).astype(np.uint8)
+
+    return img, markers, wires
+
+def _write_image(args):
+    out_dir, i, kwargs = args
+    img, markers, wires = synthesize(i, **kwargs)
+    cv2.imwrite(os.path.join(out_dir, f"synthetic_{i:05d}.tif"), img)
+    return markers, wires
+
+def generate_dataset(out_dir, n_images, workers=None, start=0, **kwargs):
+    """
+    Generate n_images synthetic images into out_dir, using a process pool. Image i
+    is generated from seed start+i, so datasets are reproducible. The ground truth
+    markers and wires are written to out_dir/ground_truth.npz.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = [(out_dir, start + i, kwargs) for i in range(n_images)]
+    with Pool(workers) as pool:
+        truth = pool.map(_write_image, jobs, chunksize=8)
+    markers, wires = (np.array(x) for x in zip(*truth))
+    np.savez(os.path.join(out_dir, "ground_truth.npz"), markers=markers, wires=wires,
+             seeds=np.arange(start, start + n_images))
+    return markers, wires
+
+def _match_wires(detected, truth, tolerance):
+    """
+    Count how many true wires have a detected wire with both endpoints (in either
+    order) within tolerance.
+    """
+    if len(detected) == 0:
+        return 0
+    fwd = np.linalg.norm(detected[:, np.newaxis] - truth[np.newaxis], axis=-1).max(axis=-1)
+    rev = np.linalg.norm(detected[:, np.newaxis, ::-1] - truth[np.newaxis], axis=-1).max(axis=-1)
+    return int((np.minimum(fwd, rev) < tolerance).any(axis=0).sum())
+
+def _benchmark_one(args):
+    seed, kwargs = args
+    img, markers, wires = synthesize(seed, **kwargs)
+    start = time.perf_counter()
+    try:
+        result = coordinate_transform.process_image(seed, img, die_dims=(kwargs.get("sec_size", 300),)*2)
+    except (ValueError, cv2.error):
+        # Degenerate images can fail in OpenCV as well, count them as missed detections
+        return None, len(wires), 0, 0, time.perf_counter() - start
+    elapsed = time.perf_counter() - start
+    marker_err = np.linalg.norm(result["markers"] - markers, axis=-1).max()
+    return marker_err, len(wires), len(result["wires"]), _match_wires(result["wires"], wires, 1.0), elapsed
+
+def benchmark(n_images=200, workers=None, **kwargs):
+    """
+    Benchmark detection against synthetic images, generated on the fly in a process pool.
+
+    Returns a dictionary with the fraction of images where markers were found,
+    the median and max marker error (pixels), wire recall and precision, and the
+    throughput in images per second (overall, and of detection alone per worker).
+    """
+    start = time.perf_counter()
+    with Pool(workers) as pool:
+        results = pool.map(_benchmark_one, [(i, kwargs) for i in range(n_images)], chunksize=4)
+    elapsed = time.perf_counter() - start
+
+    marker_err = np.array([r[0] for r in results if r[0] is not None])
+    n_true, n_found, n_matched = (sum(r[i] for r in results) for i in (1, 2, 3))
+    return {
+        "markers_found": len(marker_err)/n_images,
+        "marker_error_median": float(np.median(marker_err)) if len(marker_err) else np.nan,
+        "marker_error_max": float(marker_err.max()) if len(marker_err) else np.nan,
+        "wire_recall": n_matched/n_true if n_true else np.nan,
+        "wire_precision": n_matched/n_found if n_found else np.nan,
+        "images_per_second": n_images/elapsed,
+        "detection_per_second": n_images/sum(r[4] for r in results),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic SEM images of a wire section.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    generate = subparsers.add_parser("generate", help="Generate a dataset of images.")
+    generate.add_argument("OUTPUT", type=str, help="Output directory")
+    generate.add_argument("-n", type=int, default=1000, help="Number of images")
+    generate.add_argument("-j", "--jobs", type=int, default=None, help="Number of worker processes")
+    generate.add_argument("--start", type=int, default=0, help="Seed of the first image")
+    bench = subparsers.add_parser("benchmark", help="Benchmark marker and wire detection.")
+    bench.add_argument("-n", type=int, default=200, help="Number of images")
+    bench.add_argument("-j", "--jobs", type=int, default=None, help="Number of worker processes")
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        start = time.perf_counter()
+        generate_dataset(args.OUTPUT, args.n, args.jobs, args.start)
+        elapsed = time.perf_counter() - start
+        print(f"Generated {args.n} images in {elapsed:.1f}s ({args.n/elapsed:.1f} images/s).")
+    else:
+        for name, value in benchmark(args.n, args.jobs).items():
+            print(f"{name}: {value:.4g}")
@@ -0,0 +1,206 @@
+"""
+Fit coordinate transforms between sets of points, i.e. from marker positions
+picked out of an SEM image to their positions on the die.
+
+All fits are batched: points are given as (K, N, 2) stacks, and K independent
+transforms are returned as a (K, 3, 3) stack of homogeneous matrices. A single
+set of (N, 2) points may also be passed, in which case a single (3, 3) matrix is
+returned. Each fit also returns the residual distance of each point from its
+target, so that different models can be compared on the same data.
+"""
+
+import numpy as np
+
+def _as_stack(points):
+    """
+    Convert points to a float64 (K, N, 2) stack, returning whether a batch
+    dimension was added.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if points.ndim == 2:
+        return points[np.newaxis], True
+    if points.ndim != 3 or points.shape[-1] != 2:
+        raise ValueError(f"Points should have shape (N, 2) or (K, N, 2). Got: {points.shape}.")
+    return points, False
+
+def _unstack(added, *arrays):
+    """
+    Remove the batch dimension from each array if it was added by _as_stack.
+    """
+    if added:
+        arrays = tuple(a[0] for a in arrays)
+    return arrays
+
+def _normalize(points):
+    """
+    Find similarity transforms that move the centroid of each set of points to
+    the origin and scale the mean distance to sqrt(2), to condition the fits.
+    """
+    centroid = points.mean(axis=1)
+    dist = np.linalg.norm(points - centroid[:, np.newaxis], axis=2).mean(axis=1)
+    scale = np.sqrt(2)/np.where(dist > 0, dist, 1)
+    T = np.zeros((len(points), 3, 3))
+    T[:, 0, 0] = T[:, 1, 1] = scale
+    T[:, :2, 2] = -centroid*scale[:, np.newaxis]
+    T[:, 2, 2] = 1
+    return T
+
+def _solve(A, b):
+    """
+    Batched least squares solution of A x = b. Square systems are solved directly.
+    """
+    if A.shape[-2] == A.shape[-1]:
+        return np.linalg.solve(A, b[..., np.newaxis])[..., 0]
+    At = np.swapaxes(A, -1, -2)
+    return np.linalg.solve(At@A, (At@b[..., np.newaxis]))[..., 0]
+
+def apply_transform(T, points):
+    """
+    Apply a (3, 3) or (K, 3, 3) homogeneous transform to (N, 2) or (K, N, 2) points.
+    """
+    T = np.asarray(T, dtype=np.float64)
+    points = np.asarray(points, dtype=np.float64)
+    homog = points@np.swapaxes(T[..., :2], -1, -2) + T[..., np.newaxis, :, 2]
+    return homog[..., :2]/homog[..., 2:]
+
+def residuals(T, src, dst):
+    """
+    Distance between each transformed src point and its corresponding dst point.
+    """
+    return np.linalg.norm(apply_transform(T, src) - np.asarray(dst), axis=-1)
+
+def _fit(src, dst, build):
+    """
+    Common fitting code. Points are normalized, build is called to construct the
+    linear system for the normalized points, and the result is denormalized.
+    """
+    src, added = _as_stack(src)
+    dst, _ = _as_stack(dst)
+    if src.shape != dst.shape:
+        raise ValueError(f"src and dst must have the same shape ({src.shape} != {dst.shape}).")
+
+    Ts, Td = _normalize(src), _normalize(dst)
+    nsrc, ndst = apply_transform(Ts, src), apply_transform(Td, dst)
+    A, b, to_matrix = build(nsrc, ndst)
+    H = to_matrix(_solve(A, b))
+    T = np.linalg.inv(Td)@H@Ts
+    T /= T[:, 2:, 2:]
+    return _unstack(added, T, residuals(T, src, dst))
+
+def fit_similarity(src, dst):
+    """
+    Fit a similarity transform (rotation, uniform scale and translation).
+    Requires at least 2 points. Returns (T, residuals).
+    """
+    def build(src, dst):
+        K, N, _ = src.shape
+        x, y = src[..., 0], src[..., 1]
+        zeros, ones = np.zeros_like(x), np.ones_like(x)
+        A = np.empty((K, 2*N, 4))
+        A[:, 0::2] = np.stack((x, -y, ones, zeros), axis=-1)
+        A[:, 1::2] = np.stack((y, x, zeros, ones), axis=-1)
+        return A, dst.reshape(K, 2*N), _similarity_matrix
+    return _fit(src, dst, build)
+
+def _similarity_matrix(p):
+    a, b, tx, ty = np.moveaxis(p, -1, 0)
+    T = np.zeros((len(p), 3, 3))
+    T[:, 0] = np.stack((a, -b, tx), axis=-1)
+    T[:, 1] = np.stack((b, a, ty), axis=-1)
+    T[:, 2, 2] = 1
+    return T
+
+def fit_affine(src, dst):
+    """
+    Fit an affine transform (rotation, scale, skew and translation).
+    Requires at least 3 points. Returns (T, residuals).
+    """
+    def build(src, dst):
+        K, N, _ = src.shape
+        A = np.zeros((K, 2*N, 6))
+        A[:, 0::2, 0:2] = src
+        A[:, 0::2, 2] = 1
+        A[:, 1::2, 3:5] = src
+        A[:, 1::2, 5] = 1
+        return A, dst.reshape(K, 2*N), _affine_matrix
+    return _fit(src, dst, build)
+
+def _affine_matrix(p):
+    T = np.zeros((len(p), 3, 3))
+    T[:, :2] = p.reshape(-1, 2, 3)
+    T[:, 2, 2] = 1
+    return T
+
+def fit_projective(src, dst):
+    """
+    Fit a projective transform (homography), as with cv2.getPerspectiveTransform.
+    Requires at least 4 points. Returns (T, residuals).
+    """
+    def build(src, dst):
+        K, N, _ = src.shape
+        x, y = src[..., 0], src[..., 1]
+        u, v = dst[..., 0], dst[..., 1]
+        zeros, ones = np.zeros_like(x), np.ones_like(x)
+        A = np.empty((K, 2*N, 8))
+        A[:, 0::2] = np.stack((x, y, ones, zeros, zeros, zeros, -u*x, -u*y), axis=-1)
+        A[:, 1::2] = np.stack((zeros, zeros, zeros, x, y, ones, -v*x, -v*y), axis=-1)
+        return A, dst.reshape(K, 2*N), _projective_matrix
+    return _fit(src, dst, build)
+
+def _projective_matrix(p):
+    return np.concatenate((p, np.ones((len(p), 1))), axis=-1).reshape(-1, 3, 3)
+
+def fit_skew_scale(markers, die_dims=(300, 300)):
+    """
+    Fit the two stage skew and average scale model from coordinate_transformD.
+
+    markers are the (tl, tr, bl, br) corners of the die, with y increasing upwards.
+    The x axis is first deskewed so that tl lies above bl, then the y axis is deskewed
+    so that br lies level with bl, and finally each axis is scaled by the average
+    width and height of the deskewed corners. The origin is placed at bl.
+    Returns (T, residuals) where residuals are measured against the die corners.
+    """
+    markers, added = _as_stack(markers)
+    if markers.shape[1] != 4:
+        raise ValueError("markers should be a set of four (x, y) coordinates")
+    K = len(markers)
+    rel = markers - markers[:, 2:3]
+    tl, tr, br = rel[:, 0], rel[:, 1], rel[:, 3]
+
+    x_skew = np.tile(np.eye(3), (K, 1, 1))
+    x_skew[:, 0, 1] = -tl[:, 0]/tl[:, 1]
+    br_x = apply_transform(x_skew, br[:, np.newaxis])[:, 0]
+    y_skew = np.tile(np.eye(3), (K, 1, 1))
+    y_skew[:, 1, 0] = -br_x[:, 1]/br_x[:, 0]
+
+    shift = np.tile(np.eye(3), (K, 1, 1))
+    shift[:, :2, 2] = -markers[:, 2]
+    deskew = y_skew@x_skew@shift
+    tl, tr, bl, br = np.moveaxis(apply_transform(deskew, markers), 1, 0)
+    equiv_width = (np.abs(br[:, 0] - bl[:, 0]) + np.abs(tr[:, 0] - tl[:, 0]))/2
+    equiv_height = (np.abs(tr[:, 1] - br[:, 1]) + np.abs(tl[:, 1] - bl[:, 1]))/2
+    scale = np.zeros((K, 3, 3))
+    scale[:, 0, 0] = die_dims[0]/equiv_width
+    scale[:, 1, 1] = die_dims[1]/equiv_height
+    scale[:, 2, 2] = 1
+
+    T = scale@deskew
+    corners = np.array(((0, die_dims[1]), die_dims, (0, 0), (die_dims[0], 0)), dtype=np.float64)
+    return _unstack(added, T, residuals(T, markers, corners))
+
+FITS = {
+    "similarity": fit_similarity,
+    "affine": fit_affine,
+    "projective": fit_projective,
+}
+
+def compare_fits(src, dst):
+    """
+    Fit each model in FITS to the same data, returning a dictionary of
+    model name to RMS residual.
+    """
+    rms = {}
+    for name, fit in FITS.items():
+        _, res = fit(src, dst)
+        rms[name] = np.sqrt(np.mean(res**2, axis=-1))
+    return rms
@@ -0,0 +1,138 @@
+"""
+Partition a layout into e-beam write fields, and find features that straddle a field
+boundary (and so are stitched from two or more fields).
+
+Features are represented by the bounding boxes of their polygon instances (see
+layout_stats.instance_boxes), and every test is done on all of the boxes at once.
+The field grid can be shifted to minimise the number of crossings, which is
+separable by axis: for each axis, each feature rules out an interval of offsets,
+so the crossings for every candidate offset can be counted with one histogram.
+"""
+
+import argparse
+
+import numpy as np
+import gdspy
+
+import layout_stats
+
+FIELD_SIZE = 500 # um, as in Layout_Template.ftxt.templ
+
+def polygon_boxes(by_spec):
+    """
+    Bounding boxes of plain polygons (e.g. from the NW170926 device helpers), given as a
+    dictionary of (layer, datatype) to a list of (N, 2) vertex arrays. Returns (boxes,
+    specs) as in layout_stats.instance_boxes.
+    """
+    boxes, specs = [], []
+    for spec, polygons in by_spec.items():
+        boxes.extend((np.min(p, axis=0), np.max(p, axis=0)) for p in polygons)
+        specs.extend([spec]*len(polygons))
+    return np.array(boxes, dtype=float).reshape(-1, 2, 2), np.array(specs, dtype=int).reshape(-1, 2)
+
+def field_index(boxes, field_size=FIELD_SIZE, origin=(0, 0)):
+    """
+    Find the field containing the bottom left and top right corner of each box.
+    Returns (lo, hi), two (N, 2) integer arrays of field indices.
+    """
+    origin = np.asarray(origin, dtype=float)
+    lo = np.floor((boxes[:, 0] - origin)/field_size).astype(np.int64)
+    hi = np.floor((boxes[:, 1] - origin)/field_size).astype(np.int64)
+    return lo, hi
+
+def crossing(boxes, field_size=FIELD_SIZE, origin=(0, 0)):
+    """
+    Boolean mask of the boxes that cross a field boundary.
+    """
+    lo, hi = field_index(boxes, field_size, origin)
+    return np.any(hi != lo, axis=1)
+
+def partition(boxes, field_size=FIELD_SIZE, origin=(0, 0)):
+    """
+    Assign each box to the write field that contains its bottom left corner.
+
+    Returns (fields, members, crossing): an (F, 2) array of the occupied field indices,
+    a list of the box indices in each field, and a mask of the boxes that cross a boundary.
+    """
+    lo, hi = field_index(boxes, field_size, origin)
+    fields, inverse = np.unique(lo, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    order = np.argsort(inverse, kind="stable")
+    members = np.split(order, np.cumsum(np.bincount(inverse, minlength=len(fields)))[:-1])
+    return fields, members, np.any(hi != lo, axis=1)
+
+def _axis_crossings(lo, hi, field_size, offsets, weights):
+    """
+    Weighted number of intervals [lo, hi] that contain a field boundary, for field grids
+    starting at each of the given offsets (which are evenly spaced over one field).
+    A boundary at offset + k*field_size falls inside an interval when
+    (offset - lo) mod field_size lies in (0, hi - lo], so each interval rules out an arc
+    of offsets. Intervals at least a field long always cross.
+    """
+    n = len(offsets)
+    step = field_size/n
+    width = hi - lo
+    always = width >= field_size
+    counts = np.zeros(n + 1)
+    start = np.mod(lo[~always] - offsets[0], field_size)/step
+    first = np.floor(start).astype(np.int64) + 1
+    last = np.floor(start + width[~always]/step).astype(np.int64)
+    w = weights[~always]
+    # Add each arc to a difference array, wrapping arcs that go past the end
+    np.add.at(counts, np.minimum(first, n), w)
+    np.add.at(counts, np.minimum(last + 1, n), -w)
+    wrap = last >= n
+    np.add.at(counts, np.zeros(wrap.sum(), dtype=np.int64), w[wrap])
+    np.add.at(counts, np.minimum(last[wrap] - n + 1, n), -w[wrap])
+    return np.cumsum(counts)[:n] + weights[always].sum()
+
+def best_origin(boxes, field_size=FIELD_SIZE, step=0.5, weights=None, candidates=8):
+    """
+    Find the field grid origin (within one field of (0, 0)) that minimises the weighted
+    number of boxes crossing a field boundary. weights defaults to 1 for every box; a
+    larger weight for small critical features (e.g. plunger tips) makes crossing them
+    worse than crossing an alignment mark.
+
+    Each axis is swept separately over offsets in steps of step (um), then the best few
+    offsets of each axis are combined and scored exactly. Returns (origin, weighted crossings).
+    """
+    weights = np.ones(len(boxes)) if weights is None else np.asarray(weights, dtype=float)
+    offsets = np.arange(0, field_size, step)
+    best = []
+    for axis in range(2):
+        cost = _axis_crossings(boxes[:, 0, axis], boxes[:, 1, axis], field_size, offsets, weights)
+        best.append(offsets[np.argsort(cost, kind="stable")[:candidates]])
+    results = [((x, y), weights[crossing(boxes, field_size, (x, y))].sum()) for x in best[0] for y in best[1]]
+    return min(results, key=lambda result: result[1])
+
+def crossing_report(cell, field_size=FIELD_SIZE, origin=(0, 0), layers=None, lib=None):
+    """
+    List the polygon instances under cell that cross a write field boundary, as
+    (cell name, (layer, datatype), bounding box) tuples.
+    """
+    boxes, names, specs = layout_stats.instance_boxes(cell, layers, lib)
+    return [(names[i], tuple(specs[i]), boxes[i]) for i in np.nonzero(crossing(boxes, field_size, origin))[0]]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find features crossing write field boundaries in a GDS file.")
+    parser.add_argument("INPUT", type=str, help="GDS file")
+    parser.add_argument("-c", "--cell", type=str, default=None, help="Cell to partition (default: the top cell)")
+    parser.add_argument("-l", "--layers", type=int, nargs="+", default=None, help="Layers to check (default: all)")
+    parser.add_argument("-f", "--field-size", type=float, default=FIELD_SIZE, help="Write field size (um)")
+    parser.add_argument("--origin", type=float, nargs=2, default=(0, 0), help="Field grid origin (um)")
+    parser.add_argument("--optimise", action="store_true", help="Search for the origin with the fewest crossings")
+    args = parser.parse_args()
+
+    lib = gdspy.GdsLibrary(infile=args.INPUT)
+    top = lib.cells[args.cell] if args.cell else lib.top_level()[0]
+    boxes, names, specs = layout_stats.instance_boxes(top, args.layers, lib)
+    origin = args.origin
+    fields, _, crosses = partition(boxes, args.field_size, origin)
+    print(f"{len(boxes)} features in {len(fields)} fields, {crosses.sum()} crossing a boundary "
+          f"with the origin at ({origin[0]:g}, {origin[1]:g}).")
+    if args.optimise:
+        origin, n_crossing = best_origin(boxes, args.field_size)
+        print(f"Moving the origin to ({origin[0]:g}, {origin[1]:g}) gives {n_crossing:g} crossings.")
+    for i in np.nonzero(crossing(boxes, args.field_size, origin))[0]:
+        (x0, y0), (x1, y1) = boxes[i]
+        print(f"  {names[i]} on {specs[i][0]}/{specs[i][1]}: ({x0:.3f}, {y0:.3f}) - ({x1:.3f}, {y1:.3f})")
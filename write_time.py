@@ -0,0 +1,176 @@
+"""
+Estimate how long an e-beam write will take, before exporting to Beamer.
+
+The estimate works on the cell hierarchy (see layout_stats), so it is cheap even for
+a full wafer. For each layer the beam time is the number of shots (exposed area over
+the shot pitch squared) times the dwell per shot (set by the dose and beam current,
+but no shorter than one period of the maximum shot clock), plus a settling time per
+figure. Each occupied write field then adds a field and a stage move overhead, and
+each die a fixed overhead (mark detection, height measurement).
+"""
+
+import argparse
+
+import numpy as np
+import gdspy
+
+import fracture
+import layout_stats
+import nanowire_chip
+import write_fields
+
+# Defaults, matching Layout_Template.ftxt.templ where it has them
+FIELD_SIZE = 500 # um
+CURRENT = 1.0 # nA
+DOSE = 300.0 # uC/cm^2
+SHOT_PITCH = 0.005 # um
+MAX_FREQUENCY = 100e6 # Hz
+FIGURE_SETTLE = 1e-6 # s
+FIELD_OVERHEAD = 0.05 # s
+STAGE_OVERHEAD = 0.2 # s
+DIE_OVERHEAD = 10.0 # s
+
+def _per_layer(value, spec):
+    """
+    Look up a setting for (layer, datatype), which may be given as a single value or a
+    dictionary keyed by (layer, datatype) or by layer.
+    """
+    if not isinstance(value, dict):
+        return value
+    if spec in value:
+        return value[spec]
+    if spec[0] in value:
+        return value[spec[0]]
+    raise KeyError(f"No value given for layer {spec[0]}/{spec[1]}.")
+
+def beam_time(stats, current=CURRENT, dose=DOSE, shot_pitch=SHOT_PITCH,
+              max_frequency=MAX_FREQUENCY, figure_settle=FIGURE_SETTLE):
+    """
+    Calculate the beam-on time for each (layer, datatype) in stats (as returned by
+    layout_stats.layout_stats or polygon_stats). current (nA), dose (uC/cm^2) and
+    shot_pitch (um) may be given per layer (see _per_layer).
+
+    Returns a dictionary of (layer, datatype) to a dictionary of area (um^2), shots,
+    figures, dwell (s per shot) and time (s).
+    """
+    result = {}
+    for spec, layer in stats.items():
+        charge_density = _per_layer(dose, spec)*1e-6/1e8 # C/um^2
+        pitch = _per_layer(shot_pitch, spec)
+        dwell = max(charge_density*pitch**2/(_per_layer(current, spec)*1e-9), 1/max_frequency)
+        shots = layer["area"]/pitch**2
+        result[spec] = {"area": layer["area"], "shots": shots, "figures": layer["polygons"],
+                        "dwell": dwell, "time": shots*dwell + layer["polygons"]*figure_settle}
+    return result
+
+def _field_ids(boxes, field_size, origin):
+    """
+    Find the unique write fields touched by a set of (N, 2, 2) bounding boxes. Returns
+    an (F, 2) array of field indices.
+    """
+    if not len(boxes):
+        return np.zeros((0, 2), dtype=np.int64)
+    lo, hi = write_fields.field_index(boxes, field_size, origin)
+    ids = [lo]
+    # Most features sit in a single field, only expand the ones that cross a boundary
+    for span in np.nonzero(np.any(hi > lo, axis=1))[0]:
+        fx, fy = np.meshgrid(np.arange(lo[span, 0], hi[span, 0] + 1), np.arange(lo[span, 1], hi[span, 1] + 1))
+        ids.append(np.stack((fx.ravel(), fy.ravel()), axis=-1))
+    return np.unique(np.concatenate(ids), axis=0)
+
+def cell_fields(cell, field_size=FIELD_SIZE, layers=None, origin=(0, 0), lib=None):
+    """
+    Find the write fields that contain geometry on the given layers (default: all),
+    from the bounding box of each polygon instance. Only bounding boxes are
+    transformed, so the layout is not flattened. Returns an (F, 2) array of field indices.
+    """
+    boxes, _, _ = layout_stats.instance_boxes(cell, layers, lib)
+    return _field_ids(boxes, field_size, np.asarray(origin, dtype=float))
+
+def polygon_fields(by_spec, field_size=FIELD_SIZE, origin=(0, 0)):
+    """
+    As cell_fields, for plain polygons given as a dictionary of (layer, datatype) to a
+    list of (N, 2) vertex arrays.
+    """
+    boxes, _ = write_fields.polygon_boxes(by_spec)
+    return _field_ids(boxes, field_size, np.asarray(origin, dtype=float))
+
+def write_time(stats, n_fields, n_dies=1, field_overhead=FIELD_OVERHEAD, stage_overhead=STAGE_OVERHEAD,
+               die_overhead=DIE_OVERHEAD, **beam):
+    """
+    Combine the beam time for stats with the field, stage and die overheads. n_fields
+    is the number of occupied write fields per die, and n_dies is the number of times
+    the layout is written. Keyword arguments are passed on to beam_time.
+
+    Returns a dictionary with the per layer beam times (layers), the beam time,
+    overhead and total time of a single die, and the total time for all n_dies (s).
+    """
+    layers = beam_time(stats, **beam)
+    beam_total = sum(layer["time"] for layer in layers.values())
+    overhead = n_fields*(field_overhead + stage_overhead) + die_overhead
+    return {"layers": layers, "n_fields": n_fields, "n_dies": n_dies,
+            "beam": beam_total, "overhead": overhead, "die": beam_total + overhead,
+            "total": n_dies*(beam_total + overhead)}
+
+def estimate_cell(cell, layers=None, n_dies=1, field_size=FIELD_SIZE, origin=(0, 0), lib=None, fractured=False,
+                  **kwargs):
+    """
+    Estimate the write time of a gdspy cell on the given layers (default: all). For a
+    single die, n_dies would be the number of dies on the wafer (see wafer_die_count).
+    If fractured is set, the figure settling time is counted per trapezoid (see
+    fracture.shot_counts) rather than per polygon. Remaining keyword arguments are
+    passed on to write_time.
+    """
+    stats = layout_stats.layout_stats(cell, lib)
+    if fractured:
+        shots = fracture.shot_counts(cell, lib)
+        stats = {spec: dict(layer, polygons=shots[spec]["figures"]) for spec, layer in stats.items()}
+    if layers is not None:
+        stats = {spec: layer for spec, layer in stats.items() if spec[0] in layers}
+    fields = cell_fields(cell, field_size, layers, origin, lib)
+    return write_time(stats, len(fields), n_dies, **kwargs)
+
+def estimate_polygons(by_spec, n_dies=1, field_size=FIELD_SIZE, origin=(0, 0), **kwargs):
+    """
+    Estimate the write time of plain polygons, given as a dictionary of (layer, datatype)
+    to a list of (N, 2) vertex arrays (e.g. a device layer built with the NW170926
+    polygon helpers).
+    """
+    fields = polygon_fields(by_spec, field_size, origin)
+    return write_time(layout_stats.polygon_stats(by_spec), len(fields), n_dies, **kwargs)
+
+def wafer_die_count(wafer_size=150_000, die_size=7_500):
+    """
+    Number of dies placed on the wafer by nanowire_chip.
+    """
+    return len(nanowire_chip.die_positions(wafer_size, die_size))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Estimate the e-beam write time of a GDS file.")
+    parser.add_argument("INPUT", type=str, help="GDS file")
+    parser.add_argument("-c", "--cell", type=str, default=None, help="Cell to estimate (default: the top cell)")
+    parser.add_argument("-l", "--layers", type=int, nargs="+", default=None, help="Layers to write (default: all)")
+    parser.add_argument("--dies", type=int, default=None,
+                        help="Number of times the cell is written (default: 1, or the wafer die count with --wafer)")
+    parser.add_argument("--wafer", type=float, nargs=2, default=None, metavar=("WAFER_SIZE", "DIE_SIZE"),
+                        help="Count the dies on a wafer (um), as placed by nanowire_chip")
+    parser.add_argument("--current", type=float, default=CURRENT, help="Beam current (nA)")
+    parser.add_argument("--dose", type=float, default=DOSE, help="Dose (uC/cm^2)")
+    parser.add_argument("--shot-pitch", type=float, default=SHOT_PITCH, help="Shot pitch (um)")
+    parser.add_argument("--field-size", type=float, default=FIELD_SIZE, help="Write field size (um)")
+    parser.add_argument("--fractured", action="store_true", help="Count figures after fracturing into trapezoids")
+    args = parser.parse_args()
+
+    lib = gdspy.GdsLibrary(infile=args.INPUT)
+    top = lib.cells[args.cell] if args.cell else lib.top_level()[0]
+    n_dies = args.dies
+    if n_dies is None:
+        n_dies = wafer_die_count(*(int(x) for x in args.wafer)) if args.wafer else 1
+    estimate = estimate_cell(top, args.layers, n_dies, args.field_size, lib=lib, fractured=args.fractured,
+                             current=args.current, dose=args.dose, shot_pitch=args.shot_pitch)
+
+    for (layer, datatype), stats in estimate["layers"].items():
+        print(f"Layer {layer}/{datatype}: {stats['area']:.4g} um^2, {stats['shots']:.4g} shots, "
+              f"{stats['figures']} figures, {stats['time']:.1f} s")
+    print(f"{estimate['n_fields']} fields, {estimate['beam']:.1f} s beam + {estimate['overhead']:.1f} s overhead per write")
+    print(f"Total for {n_dies} write(s): {estimate['total']/3600:.2f} h")